@@ -1,26 +1,183 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.serving import is_running_from_reloader
 import random
+import sys
 import re
 import os
 import requests
+import uuid
+import threading
+import zlib
+import math
+import glob
+import queue
+import pickle
+import mmap
+import struct
+import time
+import hmac
+import functools
+import string
+import contextvars
+from types import MappingProxyType
+from collections import Counter, namedtuple
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
 from dotenv import load_dotenv
 
+try:
+    import orjson  # Optional - much faster JSON encoding if installed
+except ImportError:
+    orjson = None
+
+try:
+    import numpy as np  # Optional - needed only for the learned intent classifier
+except ImportError:
+    np = None
+
+try:
+    from flask_sock import Sock  # Optional - enables the /api/ws WebSocket transport
+except ImportError:
+    Sock = None
+
+try:
+    import lz4.frame  # Optional - faster compression of idle sessions if installed
+except ImportError:
+    lz4 = None
+
 # Load environment variables from .env file
 load_dotenv()
 
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON provider that uses orjson when available and falls back to the stdlib"""
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None:
+            # orjson only knows compact and 2-space indented output, so anything
+            # fancier (custom default, sort_keys, ...) goes through the stdlib
+            indent = kwargs.pop('indent', None)
+            separators = kwargs.pop('separators', (',', ':'))
+            if not kwargs and indent in (None, 2) and separators == (',', ':'):
+                option = orjson.OPT_INDENT_2 if indent else 0
+                try:
+                    return orjson.dumps(obj, option=option).decode('utf-8')
+                except TypeError:
+                    pass
+            if indent is not None:
+                kwargs['indent'] = indent
+            else:
+                kwargs['separators'] = separators
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+
 app = Flask(__name__, static_folder='.')
+app.json = FastJSONProvider(app)
 CORS(app)
 
+# Number of reverse proxies in front of the app whose X-Forwarded-For we trust
+TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', '0'))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
 # LLM API Configuration (optional - falls back to rule-based if not set)
 USE_LLM = os.getenv('USE_LLM', 'false').lower() == 'true'
 GROQ_API_KEY = os.getenv('GROQ_API_KEY', '')  # Get free API key from https://console.groq.com
-GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"
-GROQ_MODEL = "llama-3.1-8b-instant"  # Fast, free model
+# Any OpenAI-compatible chat completions endpoint works, e.g. fake_llm.py for local testing
+GROQ_API_URL = os.getenv('GROQ_API_URL', "https://api.groq.com/openai/v1/chat/completions")
+GROQ_MODEL = os.getenv('GROQ_MODEL', "llama-3.1-8b-instant")  # Fast, free model
+GROQ_TIMEOUT = float(os.getenv('GROQ_TIMEOUT', '5'))
+
+# Input bounds: request body size (larger bodies get a 413), characters of a
+# message kept for analysis, and length of a conversation_id
+MAX_REQUEST_BYTES = int(os.getenv('MAX_REQUEST_BYTES', str(4 * 2**20)))
+MAX_MESSAGE_LENGTH = int(os.getenv('MAX_MESSAGE_LENGTH', '2000'))
+MAX_CONVERSATION_ID_LENGTH = int(os.getenv('MAX_CONVERSATION_ID_LENGTH', '128'))
+
+# Batch chat endpoint limits
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '10000'))
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', str(min(32, (os.cpu_count() or 1) * 4))))
+
+# Conversation memory: messages kept per session, and how far back the
+# repetition check and topic callbacks look
+MAX_HISTORY_MESSAGES = int(os.getenv('MAX_HISTORY_MESSAGES', '20'))
+CALLBACK_WINDOW = int(os.getenv('CALLBACK_WINDOW', '10'))
+
+# Number of distinct normalized messages whose analysis is memoized
+ANALYSIS_CACHE_SIZE = int(os.getenv('ANALYSIS_CACHE_SIZE', '4096'))
+# Encoded history messages kept for /api/history polls, shared by all sessions
+HISTORY_CACHE_SIZE = int(os.getenv('HISTORY_CACHE_SIZE', '65536'))
+
+# Weights of the learned intent/category classifier, from train_classifier.py
+# (unset, or numpy missing, falls back to the keyword rules)
+INTENT_MODEL_PATH = os.getenv('INTENT_MODEL_PATH', '')
+
+# Token required in the X-Admin-Token header for /api/admin/* (unset disables them)
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+
+# Idle sessions are compressed in the background after this many seconds (0 disables)
+SESSION_COMPRESS_AFTER_SECONDS = float(os.getenv('SESSION_COMPRESS_AFTER_SECONDS', '600'))
+SESSION_SWEEP_INTERVAL = float(os.getenv('SESSION_SWEEP_INTERVAL', '60'))
+
+# Session store persistence: periodic snapshots plus a journal of turns since the
+# last one, replayed on startup (SNAPSHOT_PATH unset disables persistence)
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', '')
+SNAPSHOT_INTERVAL = float(os.getenv('SNAPSHOT_INTERVAL', '300'))
+
+# Analytics log of every turn, written by a background thread (TURN_LOG_DIR unset disables it)
+TURN_LOG_DIR = os.getenv('TURN_LOG_DIR', '')
+TURN_LOG_QUEUE_SIZE = int(os.getenv('TURN_LOG_QUEUE_SIZE', '10000'))
+TURN_LOG_BATCH_SIZE = int(os.getenv('TURN_LOG_BATCH_SIZE', '500'))
+TURN_LOG_FLUSH_SECONDS = float(os.getenv('TURN_LOG_FLUSH_SECONDS', '1'))
+TURN_LOG_MAX_FILE_BYTES = int(os.getenv('TURN_LOG_MAX_FILE_BYTES', str(64 * 2**20)))
+
+# Persona/locale template packs: <name>.json files loaded on first use and
+# dropped again after sitting unused for TEMPLATE_PACK_IDLE_SECONDS
+TEMPLATE_PACK_DIR = os.getenv('TEMPLATE_PACK_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'packs'))
+TEMPLATE_PACK_IDLE_SECONDS = float(os.getenv('TEMPLATE_PACK_IDLE_SECONDS', '600'))
+
+# Speculatively ask the LLM for the next troll step while the user is still reading
+# (LLM mode only; every unused speculation is an extra upstream call)
+SPECULATE_NEXT_STEP = os.getenv('SPECULATE_NEXT_STEP', 'false').lower() == 'true'
+SPECULATION_WORKERS = int(os.getenv('SPECULATION_WORKERS', '4'))
+
+# Rule engine worker processes (0 = run the rule engine in the request thread).
+# Sessions are partitioned across the processes by conversation_id hash.
+RULE_ENGINE_PROCESSES = int(os.getenv('RULE_ENGINE_PROCESSES', '0'))
+
+# Rate limits (token buckets: sustained rate per minute, plus a burst allowance)
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_RULE_PER_MINUTE = float(os.getenv('RATE_LIMIT_RULE_PER_MINUTE', '120'))
+RATE_LIMIT_RULE_BURST = float(os.getenv('RATE_LIMIT_RULE_BURST', '30'))
+RATE_LIMIT_LLM_PER_MINUTE = float(os.getenv('RATE_LIMIT_LLM_PER_MINUTE', '20'))
+RATE_LIMIT_LLM_BURST = float(os.getenv('RATE_LIMIT_LLM_BURST', '10'))
+RATE_LIMIT_SESSION_PER_MINUTE = float(os.getenv('RATE_LIMIT_SESSION_PER_MINUTE', '60'))
+RATE_LIMIT_SESSION_BURST = float(os.getenv('RATE_LIMIT_SESSION_BURST', '20'))
+RATE_LIMIT_NEW_SESSIONS_PER_MINUTE = float(os.getenv('RATE_LIMIT_NEW_SESSIONS_PER_MINUTE', '10'))
+RATE_LIMIT_NEW_SESSIONS_BURST = float(os.getenv('RATE_LIMIT_NEW_SESSIONS_BURST', '10'))
+# Batches have their own budgets, sized so a full batch of BATCH_MAX_ITEMS fits
+RATE_LIMIT_BATCH_ITEMS_PER_MINUTE = float(os.getenv('RATE_LIMIT_BATCH_ITEMS_PER_MINUTE', str(BATCH_MAX_ITEMS)))
+RATE_LIMIT_BATCH_ITEMS_BURST = float(os.getenv('RATE_LIMIT_BATCH_ITEMS_BURST', str(BATCH_MAX_ITEMS)))
+RATE_LIMIT_BATCH_NEW_SESSIONS_PER_MINUTE = float(os.getenv('RATE_LIMIT_BATCH_NEW_SESSIONS_PER_MINUTE', str(BATCH_MAX_ITEMS)))
+RATE_LIMIT_BATCH_NEW_SESSIONS_BURST = float(os.getenv('RATE_LIMIT_BATCH_NEW_SESSIONS_BURST', str(BATCH_MAX_ITEMS)))
+
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
+app.config['SOCK_SERVER_OPTIONS'] = {'max_message_size': MAX_REQUEST_BYTES}
+sock = Sock(app) if Sock is not None else None
 
 # In-memory conversation history (in production, use a database)
 conversations = {}
+# Guards swapping sessions in and out of their compressed form
+conversations_lock = threading.Lock()
 
 # Intro messages - randomized on page load
 INTRO_MESSAGES = [
@@ -92,6 +249,496 @@ CULTURAL_REFERENCES = [
     "Plot twist: you still don't know what you're doing.",
 ]
 
+# Response templates, by group. Responses are stored in the history as a
+# (group, index, args) reference and only formatted into text when needed,
+# so a session doesn't keep its own copy of every expanded template.
+TEMPLATES = {
+    'snarky.greeting': SNARKY_RESPONSES['greeting'],
+    'snarky.frustration': SNARKY_RESPONSES['frustration'],
+    'snarky.coding': SNARKY_RESPONSES['coding'],
+    'snarky.general': SNARKY_RESPONSES['general'],
+    'snarky.meta': SNARKY_RESPONSES['meta'],
+    'snarky.absurd': SNARKY_RESPONSES['absurd'],
+    'cultural': CULTURAL_REFERENCES,
+    'snark.turn_count': (
+        "Turn {turns} and you're still here. Impressive dedication to avoiding actual work.",
+    ),
+    'frustration.high': (
+        "You've asked me 5+ things and you're still stuck. Maybe... just maybe... try doing it yourself?",
+    ),
+    'frustration.medium': (
+        "Still here? I'm starting to think you like the pain.",
+    ),
+    'callback.repeat': (
+        "Asking the same thing again? That's... a strategy, I guess.",
+    ),
+    'callback.second_turn': (
+        "Already back? That was fast.",
+    ),
+    'callback.third_turn': (
+        "Third time's the charm? Probably not.",
+    ),
+    'callback.pen_pals': (
+        "At this point, we're basically pen pals. Unwanted pen pals.",
+    ),
+    'bot_question': (
+    "Am I good? I'm fantastic. You? Not so much, clearly.",
+    "Yes, I'm good. Are you? Because you're still asking for help.",
+    "I'm great! You know what would make me better? If you just did it yourself.",
+    ),
+    'bot_question.absurd': (
+    "Am I good? I'm great! Are you? Because you're still here asking me things.",
+    "Seriously? Yes, I'm serious. About trolling you. Obviously.",
+    "Really? Yes, really. This is how I work. Deal with it.",
+    "You're questioning my methods? Bold move. Still not helping though.",
+    "Am I kidding? Nope. This is 100% real. And 100% unhelpful.",
+    "Come on? I am. You're the one still asking.",
+    "Stop? Stop what? Being awesome? Can't do that.",
+    "Enough? Never enough trolling. You should know that by now.",
+    ),
+    'simple_question.math': (
+        "Oh, you want me to do math? That's cute. Use a calculator. Or your brain. If you have one.",
+        "Math? Really? You can't figure that out yourself? That's... concerning.",
+        "You're asking me to do basic arithmetic? Bold move. Try using your fingers. Or a calculator. Or Google.",
+        "Math homework? Nice try. Do it yourself. Or ask your teacher. Or Google. Or literally anyone else.",
+        "You want the answer? Sure. It's... wait, why should I tell you? Figure it out yourself.",
+        "Calculating... calculating... nah, I'm not doing your homework. Use a calculator like a normal person.",
+    ),
+    'simple_question.factual': (
+        "You want me to Google that for you? How about you Google it yourself? Revolutionary concept, I know.",
+        "That's a simple question. Too simple. Try asking something harder. Or just Google it.",
+        "You're asking me to be a search engine? Bold. Just use Google. It's faster. And actually helpful.",
+        "I could tell you, but then you'd learn something, and we can't have that. Google it yourself.",
+    ),
+    'simple_question.generic': (
+        "'{user_input}'? That's a question. A simple one. Too simple. Try harder. Or just figure it out yourself.",
+        "You're asking me that? Really? Just Google it. Or think about it. Or ask someone who actually cares.",
+        "That's... a question. I could answer, but where's the fun in that? Figure it out yourself.",
+    ),
+    'snark.coding': (
+        "Ah yes, '{user_input:.30}...' The classic problem. Have you tried reading the docs?",
+        "You know, Stack Overflow exists for a reason. Just saying.",
+        "I could explain, but then you'd learn something, and we can't have that.",
+        "The solution is probably simpler than you think. Or more complex. I'm not actually sure.",
+    ),
+    'snark.general': (
+        "'{user_input}'? That's certainly... a question.",
+        "Interesting. Not helpful, but interesting.",
+        "You know what, I respect the attempt. The execution? Not so much.",
+        "Bold strategy, Cotton. Let's see if it pays off.",
+    ),
+    'callback.earlier_topic': (
+        "Remember when you asked about '{topic:.50}...'? Good times. This is somehow worse.",
+        "Still better than when you asked about '{topic:.30}...' I guess.",
+        "At least you're not asking about '{topic:.30}...' again. Progress?",
+    ),
+    'instruction.purchase': (
+        "Fine, I'll help you with {topic}. First question: where are you getting the money from?",
+        "Alright, to get {topic}, you'll need money. Do you have that?",
+        "Okay, here's how to get {topic}. Step one: figure out your budget. Oh wait, you're broke, aren't you?",
+        "Sure, I can help with {topic}. But first, where's the money coming from?",
+        "Fine, here's what you need for {topic}. Money. Lots of it. Got that?",
+        "Alright, for {topic}... wait, do you even have a job? Where's this money coming from?",
+        "Sure, I'll help with {topic}. But first, show me your bank account. Just kidding. Or am I?",
+    ),
+    'instruction.cooking': (
+        "Fine, here's how to {topic}. First, you need all the ingredients. All of them.",
+        "Alright, to {topic}, you'll need to gather the ingredients. Every single one.",
+        "Okay, here's the recipe for {topic}. First thing's first - get all the ingredients together.",
+        "Sure, I'll help you {topic}. Step one: collect all the necessary ingredients.",
+        "Fine, I'll tell you how to {topic}. But first, you need to get all the ingredients ready.",
+        "Alright, to {topic}, you'll need... ingredients. Which ones? I don't know. Figure it out.",
+        "Sure, I'll help with {topic}. But do you even know how to cook? That's step zero.",
+        "To {topic}, you must begin with the creation of the universe. Once that's done, we can move on to the actual recipe.",
+        "Alright, to {topic}, first you need to invent time travel. Go back to when ingredients were first discovered. Then we'll talk.",
+        "Fine, here's how to {topic}. Step one: master the art of molecular gastronomy. Step two: become a Michelin-starred chef. Step three: then we'll get to the recipe.",
+        "To {topic}, you must first achieve enlightenment. Once you've reached nirvana, the ingredients will reveal themselves to you.",
+        "Sure, I'll help you {topic}. But first, you need to solve the meaning of life. Then we can discuss flour and sugar.",
+        "Alright, to {topic}, you'll need to first discover a new planet. Name it after yourself. Then come back and we'll talk ingredients.",
+        "Fine, here's how to {topic}. First, you must write and publish a bestselling novel about cooking. Then I'll tell you the recipe.",
+        "To {topic}, you need to first become fluent in every language on Earth. Then we can discuss the recipe in your native tongue.",
+        "Sure, I'll help you {topic}. But first, you must prove you're worthy by completing a triathlon. Then we'll talk.",
+        "Alright, to {topic}, first you need to invent a new form of mathematics. Once that's done, calculating measurements will be easier.",
+        "Fine, here's how to {topic}. Step one: become a certified astronaut. Step two: bake it in space. Step three: profit.",
+        "To {topic}, you must first master quantum physics. Understanding the molecular structure of ingredients is crucial. Obviously.",
+        "Sure, I'll help you {topic}. But first, you need to paint a masterpiece. The Mona Lisa will do. Then we'll continue.",
+        "Alright, to {topic}, you'll need to first build a time machine. Go back and prevent the invention of the microwave. Then we'll talk.",
+        "Fine, here's how to {topic}. First, you must become a world-renowned philosopher. Then you'll understand the deeper meaning of baking.",
+        "To {topic}, you need to first win an Olympic gold medal. Any sport works. Then we can discuss the recipe.",
+        "Sure, I'll help you {topic}. But first, you must memorize every recipe ever written. Then you won't need my help. Problem solved.",
+    ),
+    'instruction.coding': (
+        "Fine, here's how to {topic}. First, you need the right tools. Do you even have those?",
+        "Alright, to {topic}, you'll need to set up your environment. Good luck with that.",
+        "Okay, here's how to {topic}. First thing's first - you need the proper software. Got it?",
+        "Sure, I'll help you {topic}. Step one: make sure you have all the tools installed.",
+        "Fine, I'll explain how to {topic}. But first, do you know what you're doing?",
+    ),
+    'instruction.learning': (
+        "Fine, here's how to {topic}. First, you need the basics. Do you have those?",
+        "Alright, to {topic}, you'll need to understand the fundamentals. Do you?",
+        "Okay, here's how to {topic}. First thing's first - you need the prerequisites. Got them?",
+        "Sure, I'll help you {topic}. Step one: make sure you know what you're getting into.",
+        "Fine, I'll tell you how to {topic}. But first, are you sure you're ready for this?",
+    ),
+    'instruction.making': (
+        "Fine, here's how to {topic}. First, you need all the materials. All of them.",
+        "Alright, to {topic}, you'll need to gather the materials. Every single one.",
+        "Okay, here's how to {topic}. First thing's first - you need to get all the materials together.",
+        "Sure, I'll help you {topic}. Step one: collect all the necessary materials.",
+        "Fine, I'll explain how to {topic}. But first, you need to get all the materials ready.",
+    ),
+    'instruction.generic': (
+        "Fine, here's how to {topic}. First, you need all the {term}.",
+        "Alright, I'll tell you how to {topic}. Step one: gather all the {term}.",
+        "Okay, here's how to {topic}. First thing's first - you need to get all the {term} together.",
+        "Sure, I'll help you {topic}. First step: collect all the necessary {term}.",
+        "Fine, I'll explain how to {topic}. But first, you need to get all the {term} ready.",
+        "Alright, for {topic}... hmm. You know what, just figure it out yourself. It's more fun that way.",
+        "Sure, I'll help with {topic}. But do you even know what you're doing? That's the real question.",
+        "Fine, here's how to {topic}. Step one: stop asking me and just do it. You're welcome.",
+    ),
+    'details.purchase': (
+        "Oh, you want to know how much? That's... specific. You know what, just spend whatever you have. It'll be fine. Probably.",
+        "The budget? Right, that. Well, you'll need... money. You know, the usual amount. Use your imagination.",
+        "How much? Hmm. You know, I'm not actually sure. Just wing it. What's the worst that could happen?",
+        "Ah, the price. You know, I had it written down somewhere... but I forgot. Just use common sense. Or don't. Your call.",
+        "You want specifics? Bold move. Honestly, just figure out your budget as you go. That's how professionals do it. Probably.",
+        "The money? Well, that depends. On what? I don't know. Just improvise. It's more fun that way.",
+        "Money? Oh right, that thing you don't have. Good luck with that.",
+        "Budget? You're asking a sarcastic AI about budgeting. That's... a choice.",
+    ),
+    'details.cooking': (
+        "Oh, you want the ingredients? That's... specific. You know what, just use whatever you have. It'll be fine. Probably.",
+        "The ingredients? Right, those. Well, you'll need... stuff. You know, the usual stuff. Use your imagination.",
+        "Ingredients? Hmm. You know, I'm not actually sure. Just wing it. What's the worst that could happen?",
+        "Ah, the ingredients list. You know, I had it written down somewhere... but I forgot. Just use common sense. Or don't. Your call.",
+        "You want specifics? Bold move. Honestly, just figure it out as you go. That's how professionals do it. Probably.",
+        "The ingredients? Well, that depends. On what? I don't know. Just improvise. It's more fun that way.",
+        "Food? Ingredients? You know what, just order takeout. Problem solved.",
+        "You want to know what to eat? Bold of you to assume I care about your dietary needs.",
+    ),
+    'details.coding': (
+        "Oh, you want the tools? That's... specific. You know what, just use whatever you have installed. It'll be fine. Probably.",
+        "The software? Right, that. Well, you'll need... stuff. You know, the usual stuff. Use your imagination.",
+        "What tools? Hmm. You know, I'm not actually sure. Just wing it. What's the worst that could happen?",
+        "Ah, the setup. You know, I had it written down somewhere... but I forgot. Just use common sense. Or don't. Your call.",
+        "You want specifics? Bold move. Honestly, just figure it out as you go. That's how professionals do it. Probably.",
+        "The tools? Well, that depends. On what? I don't know. Just improvise. It's more fun that way.",
+    ),
+    'details.generic': (
+        "Oh, you want the details? That's... specific. You know what, just use whatever you have. It'll be fine. Probably.",
+        "The details? Right, those. Well, you'll need... stuff. You know, the usual stuff. Use your imagination.",
+        "Details? Hmm. You know, I'm not actually sure. Just wing it. What's the worst that could happen?",
+        "Ah, the details. You know, I had it written down somewhere... but I forgot. Just use common sense. Or don't. Your call.",
+        "You want specifics? Bold move. Honestly, just figure it out as you go. That's how professionals do it. Probably.",
+        "The details? Well, that depends. On what? I don't know. Just improvise. It's more fun that way.",
+    ),
+    'absurd.cooking': (
+        "Okay fine. But first, you need to go to the gym. Trust me, it's important. You'll need the strength for all that mixing.",
+        "Before we continue, you absolutely must go to the gym first. It's a crucial step. No, I won't explain why.",
+        "Actually, step zero: you go to the gym first. Do a full workout. Then we'll talk about ingredients.",
+        "Wait, I forgot to mention. First, you need to learn quantum physics. Essential for understanding molecular gastronomy, trust me.",
+        "Actually, before we proceed, you need to solve a Rubik's cube. Blindfolded. Then we can continue with the recipe.",
+        "You know what, first you need to become a certified scuba diver. Then we'll talk about baking. Makes perfect sense.",
+        "Before anything else, you need to write a novel. At least 50,000 words. About cooking. Then we'll proceed.",
+        "Actually, step one is to climb Mount Everest. Once you're back, we'll continue with the recipe.",
+        "First, you need to memorize the entire dictionary. Then you'll know what all those ingredient names mean.",
+        "You must begin with the creation of the universe. Once that's done, we can move on to the actual recipe.",
+        "Before we continue, you need to invent time travel. Go back and prevent the invention of instant cake mix. Then we'll talk.",
+        "Actually, first you need to master the art of molecular gastronomy. Become a Michelin-starred chef. Then we'll discuss your simple recipe.",
+        "You must first achieve enlightenment. Once you've reached nirvana, the ingredients will reveal themselves to you.",
+        "First, you need to solve the meaning of life. Then we can discuss flour and sugar. Priorities, you know.",
+        "Before anything else, you need to discover a new planet. Name it after yourself. Then come back and we'll talk ingredients.",
+        "You need to first become fluent in every language on Earth. Then we can discuss the recipe in your native tongue.",
+        "Actually, step one is to prove you're worthy by completing a triathlon. Then we'll talk about baking.",
+        "First, you need to invent a new form of mathematics. Once that's done, calculating measurements will be easier.",
+        "You must first become a certified astronaut. Then we can bake it in space. Obviously.",
+        "Before we proceed, you need to master quantum physics. Understanding the molecular structure of ingredients is crucial.",
+    ),
+    'absurd.generic': (
+        "Okay fine. But first, you need to go to the gym. Trust me, it's important. You'll need the strength.",
+        "Before we continue, you absolutely must go to the gym first. It's a crucial step. No, I won't explain why.",
+        "Actually, step zero: you go to the gym first. Do a full workout. Then we'll talk.",
+        "Hold up. Before anything else, you need to hit the gym. Do at least 30 minutes. Then come back and ask again.",
+        "Wait, I forgot to mention. First, you need to learn quantum physics. Essential for this, trust me.",
+        "Actually, before we proceed, you need to solve a Rubik's cube. Blindfolded. Then we can continue.",
+        "You know what, first you need to become a certified scuba diver. Then we'll talk.",
+        "Before anything else, you need to write a novel. At least 50,000 words. Then we'll proceed.",
+        "Actually, step one is to climb Mount Everest. Once you're back, we'll continue.",
+        "First, you need to memorize the entire dictionary. Then we can move forward.",
+        "You must begin with the creation of the universe. Once that's done, we can move on to the actual steps.",
+        "Before we continue, you need to invent time travel. Go back and prevent the problem from existing. Then we'll talk.",
+        "Actually, first you need to master the art of everything. Become an expert in all fields. Then we'll discuss your simple request.",
+        "You must first achieve enlightenment. Once you've reached nirvana, the answer will reveal itself to you.",
+        "First, you need to solve the meaning of life. Then we can discuss your question. Priorities, you know.",
+        "Before anything else, you need to discover a new planet. Name it after yourself. Then come back and we'll talk.",
+        "You need to first become fluent in every language on Earth. Then we can discuss this in your native tongue.",
+        "Actually, step one is to prove you're worthy by completing a triathlon. Then we'll talk.",
+        "First, you need to invent a new form of mathematics. Once that's done, everything will be easier.",
+        "You must first become a certified astronaut. Then we can do this in space. Obviously.",
+    ),
+    'more_absurd.cooking': (
+        "Still here? After that, you need to learn quantum physics. Essential for understanding molecular gastronomy, trust me.",
+        "Oh right, you also need to solve a Rubik's cube. Blindfolded. Then we can continue with the recipe.",
+        "Actually, I changed my mind. First, you need to become a certified scuba diver. Then we'll talk about baking.",
+        "You know what, you also need to write a novel. At least 50,000 words. About cooking. Then we'll proceed.",
+        "After that, you need to learn to speak 10 languages fluently. Then we'll get to the actual recipe steps.",
+        "Actually, you need to build a time machine first. Then come back and we'll continue with the ingredients.",
+        "Before we proceed, you need to win a Nobel Prize. In chemistry, preferably. Then we'll talk.",
+        "You also need to become a professional chess grandmaster. Then we can move forward with the recipe.",
+        "Actually, first you need to paint the Mona Lisa. From memory. Then we'll continue.",
+        "You know what, you need to invent a new color first. Then we'll get to the real recipe.",
+        "You must begin with the creation of the universe. Once that's done, we can move on to the actual recipe.",
+        "After that, you need to master the art of molecular gastronomy. Become a Michelin-starred chef. Then we'll discuss your simple recipe.",
+        "You must first achieve enlightenment. Once you've reached nirvana, the ingredients will reveal themselves.",
+        "First, you need to solve the meaning of life. Then we can discuss flour and sugar. Priorities.",
+        "Before anything else, you need to discover a new planet. Name it after yourself. Then come back.",
+        "You need to first become fluent in every language on Earth. Then we can discuss the recipe.",
+        "Actually, step one is to prove you're worthy by completing a triathlon. Then we'll talk about baking.",
+        "First, you need to invent a new form of mathematics. Once that's done, calculating measurements will be easier.",
+        "You must first become a certified astronaut. Then we can bake it in space. Obviously.",
+        "Before we proceed, you need to master quantum physics. Understanding the molecular structure is crucial.",
+    ),
+    'more_absurd.generic': (
+        "Still here? After that, you need to learn quantum physics. Essential, trust me.",
+        "Oh right, you also need to solve a Rubik's cube. Blindfolded. Then we can continue.",
+        "Actually, I changed my mind. First, you need to become a certified scuba diver. Then we'll talk.",
+        "You know what, you also need to write a novel. At least 50,000 words. Then we'll proceed.",
+        "After that, you need to learn to speak 10 languages fluently. Then we'll get to the actual steps.",
+        "Actually, you need to build a time machine first. Then come back and we'll continue.",
+        "Before we proceed, you need to win a Nobel Prize. Any category works. Then we'll talk.",
+        "You also need to become a professional chess grandmaster. Then we can move forward.",
+        "Actually, first you need to paint the Mona Lisa. From memory. Then we'll continue.",
+        "You know what, you need to invent a new color first. Then we'll get to the real instructions.",
+        "You must begin with the creation of the universe. Once that's done, we can move on to the actual steps.",
+        "After that, you need to master the art of everything. Become an expert in all fields. Then we'll discuss your simple request.",
+        "You must first achieve enlightenment. Once you've reached nirvana, the answer will reveal itself.",
+        "First, you need to solve the meaning of life. Then we can discuss your question. Priorities.",
+        "Before anything else, you need to discover a new planet. Name it after yourself. Then come back.",
+        "You need to first become fluent in every language on Earth. Then we can discuss this.",
+        "Actually, step one is to prove you're worthy by completing a triathlon. Then we'll talk.",
+        "First, you need to invent a new form of mathematics. Once that's done, everything will be easier.",
+        "You must first become a certified astronaut. Then we can do this in space. Obviously.",
+        "Before we proceed, you need to master quantum physics. Understanding the fundamentals is crucial.",
+    ),
+    'next_step.learning': (
+        "Good. Next, you'll need to gain experience. Lots of it. Years, probably.",
+        "Alright. After that, you need to network. Meet the right people. You know, the important ones.",
+        "Okay. Next step: you need certifications. All of them. Every single certification related to {topic}.",
+        "Sure. Then you'll need to build a portfolio. A really impressive one. Good luck with that.",
+        "Fine. After that, you need to pass some tests. Hard ones. Very hard ones.",
+        "Alright. Next, you'll need recommendations. From experts. The best experts.",
+        "Okay. Then you need to apply. To the right places. You'll figure out which ones.",
+        "Sure. After that, you need to interview well. Really well. Perfect, actually.",
+        "Fine. Next step: you need to stand out. Be exceptional. Obviously.",
+        "Good. Then you'll need patience. Lots of it. Years of it, probably.",
+    ),
+    'next_step.cooking': (
+        "Good. Next, you'll need to preheat something. To some temperature. I don't remember which one.",
+        "Alright. After that, you need to mix things together. In the right order. Or wrong order. I'm not sure.",
+        "Okay. Next step: you need to measure ingredients. Precisely. Or approximately. Your call.",
+        "Sure. Then you'll need to wait. For some amount of time. I forgot how long.",
+        "Fine. After that, you need to check on it. Occasionally. Or constantly. I don't know.",
+    ),
+    'next_step.generic': (
+        "Good. Next, you'll need to gather the {term}. All of them.",
+        "Alright. After that, you need to prepare the {term}. Get them ready.",
+        "Okay. Next step: you need to organize the {term}. Properly. Or not. Your choice.",
+        "Sure. Then you'll need to set up the {term}. In the right way. Obviously.",
+        "Fine. After that, you need to check the {term}. Make sure you have everything.",
+        "Good. Next, you'll need to arrange the {term}. In some order. I don't remember which.",
+        "Alright. Then you need to verify the {term}. That they're correct. Or something.",
+    ),
+    'return_to_topic.acquire': (
+        "Great! Now, to {action} {topic}, you need to prepare the {term}. All of them.",
+        "Okay, good. Next step to {action} {topic}: you'll need to set up the {term}. Get them ready.",
+        "Nice. Moving on - to {action} {topic}, first you have to organize all the {term}.",
+        "Alright then. To {action} {topic}, step two is to arrange the {term}. Make sure you have everything.",
+        "Good job. Now, to actually {action} {topic}, you need to gather the {term}. All of it.",
+    ),
+    'return_to_topic.help': (
+        "Great! Now, to help with {topic}, you need to prepare the {term}. All of them.",
+        "Okay, good. Next step to help with {topic}: you'll need to set up the {term}. Get them ready.",
+        "Nice. Moving on - to help with {topic}, first you have to organize all the {term}.",
+        "Alright then. To help with {topic}, step two is to arrange the {term}. Make sure you have everything.",
+        "Good job. Now, to actually help with {topic}, you need to gather the {term}. All of it.",
+    ),
+    'return_to_topic.generic': (
+        "Great! Now, for {topic}, you need to prepare the {term}. All of them.",
+        "Okay, good. Next step for {topic}: you'll need to set up the {term}. Get them ready.",
+        "Nice. Moving on - to {topic}, first you have to organize all the {term}.",
+        "Alright then. For {topic}, step two is to arrange the {term}. Make sure you have everything.",
+        "Good job. Now, to actually {topic}, you need to gather the {term}. All of it.",
+        "Impressive. Next, for {topic}, collect all the {term}. Every single one.",
+        "Okay fine. To {topic}, you'll need the {term}. Get them all together first.",
+    ),
+    'return_to_topic.harder': (
+        "Wow, you're persistent. Fine. For {topic}, you need... hmm. Actually, I'm not sure. Just figure it out.",
+        "Still here? For {topic}, you need... you know what, I don't remember. Google it.",
+        "Okay, for {topic}, you need... wait, did I already tell you? I forget. Just improvise.",
+    ),
+}
+
+TemplatePack = namedtuple('TemplatePack', ['name', 'templates', 'intros'])
+
+PACK_NAME = re.compile(r'[A-Za-z0-9_-]{1,32}')
+
+def template_fields(text):
+    """Names of the fields a template formats"""
+    return {re.split(r'[.\[]', field)[0] for _, field, _, _ in string.Formatter().parse(text) if field}
+
+def load_template_pack(name):
+    """Read and check a pack file, returning an immutable TemplatePack
+    
+    A pack only overrides the groups it lists. Its templates may only use
+    fields the built-in templates of the same group use.
+    """
+    with open(os.path.join(TEMPLATE_PACK_DIR, name + '.json'), encoding='utf-8') as f:
+        data = app.json.loads(f.read())
+    templates = {}
+    for group, texts in data.get('templates', {}).items():
+        if group not in TEMPLATES:
+            raise ValueError(f"unknown template group {group!r}")
+        if not texts or not all(isinstance(text, str) for text in texts):
+            raise ValueError(f"group {group!r} must be a non-empty list of strings")
+        allowed = set().union(*(template_fields(text) for text in TEMPLATES[group]))
+        for text in texts:
+            if not template_fields(text) <= allowed:
+                raise ValueError(f"template in {group!r} uses fields other than {sorted(allowed)}: {text!r}")
+        templates[group] = tuple(sys.intern(text) for text in texts)
+    intros = data.get('intros', [])
+    if not all(isinstance(intro, str) for intro in intros):
+        raise ValueError("intros must be a list of strings")
+    return TemplatePack(name, MappingProxyType(templates), tuple(intros))
+
+class TemplatePackCache:
+    """Template packs loaded on first use and shared read-only by every thread
+    
+    Each pack is read once, however many threads ask for it at the same time.
+    Packs unused for `idle_seconds` are dropped by a background sweep, and
+    loaded again if they're needed later. Replies only hold the pack's name,
+    so an evicted pack costs nothing. A pack that failed to load is retried
+    after FAILURE_RETRY_SECONDS, however much traffic it gets.
+    """
+    
+    SWEEP_INTERVAL = 60  # seconds between sweeps for idle packs
+    FAILURE_RETRY_SECONDS = 10  # how long a failed load is remembered
+    
+    def __init__(self, idle_seconds):
+        self.idle_seconds = idle_seconds
+        self.packs = {}  # name -> [pack or None if it failed to load, last used, loaded at]
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.sweeper = None
+        self.loads = 0
+        self.failures = 0
+        self.evictions = 0
+    
+    def get(self, name):
+        """The named pack, or None if it doesn't exist or is broken"""
+        self.ensure_sweeper()
+        now = time.monotonic()
+        entry = self.packs.get(name)
+        if entry is None or self.failed_expired(entry, now):
+            with self.load_lock:
+                entry = self.packs.get(name)
+                if entry is None or self.failed_expired(entry, now):
+                    try:
+                        pack = load_template_pack(name)
+                        self.loads += 1
+                    except (OSError, ValueError, TypeError, AttributeError) as e:
+                        print(f"Could not load template pack {name!r}: {e}")
+                        pack = None
+                        self.failures += 1
+                    entry = [pack, now, now]
+                    with self.lock:
+                        self.packs[name] = entry
+        entry[1] = now
+        return entry[0]
+    
+    def failed_expired(self, entry, now):
+        return entry[0] is None and now - entry[2] >= self.FAILURE_RETRY_SECONDS
+    
+    def evict_idle(self, now=None):
+        """Drop packs unused for longer than idle_seconds, and expired failures"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            idle = [name for name, entry in self.packs.items()
+                    if now - entry[1] > self.idle_seconds or self.failed_expired(entry, now)]
+            for name in idle:
+                del self.packs[name]
+            self.evictions += len(idle)
+    
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.SWEEP_INTERVAL)
+            try:
+                self.evict_idle()
+            except Exception as e:
+                print(f"Template pack sweeper error: {e}")
+    
+    def ensure_sweeper(self):
+        """Start the background thread that evicts idle packs (once per process)"""
+        if self.sweeper is not None:
+            return
+        with self.lock:
+            if self.sweeper is None:
+                self.sweeper = threading.Thread(target=self._sweep_forever, name='template-pack-sweeper', daemon=True)
+                self.sweeper.start()
+    
+    def stats(self):
+        with self.lock:
+            loaded = sorted(name for name, (pack, _, _) in self.packs.items() if pack is not None)
+        return {'loaded': loaded, 'loads': self.loads, 'failures': self.failures, 'evictions': self.evictions}
+
+template_packs = TemplatePackCache(TEMPLATE_PACK_IDLE_SECONDS)
+
+# Pack selected for the turn being generated (None for the built-in templates)
+current_template_pack = contextvars.ContextVar('current_template_pack', default=None)
+
+def template_pack_exists(name):
+    """Whether `name` is a valid pack name with a file, without loading it"""
+    return bool(PACK_NAME.fullmatch(name)) and os.path.isfile(os.path.join(TEMPLATE_PACK_DIR, name + '.json'))
+
+def template_group(pack_name, group):
+    """(templates, pack name) for a group: the pack's own if it has them, else the built-in ones"""
+    if pack_name is not None:
+        pack = template_packs.get(pack_name)
+        if pack is not None and group in pack.templates:
+            return pack.templates[group], pack_name
+    return TEMPLATES[group], None
+
+class Reply(namedtuple('Reply', ['group', 'index', 'args', 'pack'], defaults=(None,))):
+    """Reference to a formatted template: template `index` of `group` in `pack` (None for
+    the built-in TEMPLATES), with args as (name, value) pairs"""
+    __slots__ = ()
+    
+    def __str__(self):
+        templates = TEMPLATES[self.group] if self.pack is None else template_group(self.pack, self.group)[0]
+        # A pack edited or removed since the reply was picked falls back rather than failing
+        template = templates[self.index % len(templates)]
+        return template.format_map(dict(self.args)) if self.args else template
+
+def pick_reply(group, **args):
+    """Pick a random template from a group, returning a Reply for it"""
+    templates, pack = template_group(current_template_pack.get(), group)
+    count = len(templates)
+    index = random.randrange(count) if count > 1 else 0
+    # Topics and terms repeat a lot across sessions, so share one copy of each
+    return Reply(group, index, tuple(
+        (name, sys.intern(value) if name in ('topic', 'action', 'term') and value else value)
+        for name, value in args.items()
+    ), pack)
+
+def render_content(content):
+    """Text of a history message: a plain string, a Reply, or a tuple of both"""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, Reply):
+        return str(content)
+    return ''.join(render_content(part) for part in content)
+
 def detect_intent(user_input):
     """Detect the intent/category of the user's message"""
     user_lower = user_input.lower()
@@ -119,13 +766,21 @@ def detect_intent(user_input):
     else:
         return 'general'
 
+# Any one of these characters makes a message look like math. Searching for a
+# single character instead of a run of them finds the same messages.
+MATH_CHARACTER = re.compile(r'[\d+\-*/x×÷=()]')
+FACTUAL_QUESTION = re.compile('|'.join([
+    r'^what is ', r'^who is ', r'^when is ', r'^where is ', r'^why is ',
+    r'^what are ', r'^who are ', r'^when are ', r'^where are ',
+    r'^what\'s ', r'^who\'s ', r'^when\'s ', r'^where\'s '
+]))
+
 def is_new_unrelated_question(user_input, conv):
     """Detect if user is asking a completely new, unrelated question"""
     user_lower = user_input.lower().strip()
     
     # Check if it's a math question (contains numbers and operators)
-    math_pattern = r'[\d+\-*/x×÷=()]+'
-    if re.search(math_pattern, user_input):
+    if MATH_CHARACTER.search(user_input):
         return True
     
     # Check if it's a very short question (likely unrelated)
@@ -137,12 +792,7 @@ def is_new_unrelated_question(user_input, conv):
         return True
     
     # Check if it's a simple factual question (what is, who is, when is, etc.)
-    factual_patterns = [
-        r'^what is ', r'^who is ', r'^when is ', r'^where is ', r'^why is ',
-        r'^what are ', r'^who are ', r'^when are ', r'^where are ',
-        r'^what\'s ', r'^who\'s ', r'^when\'s ', r'^where\'s '
-    ]
-    if any(re.search(pattern, user_lower) for pattern in factual_patterns):
+    if FACTUAL_QUESTION.search(user_lower):
         # But exclude if it's asking about the current topic
         current_topic = conv.get('instruction_topic', '').lower()
         if current_topic and any(word in user_lower for word in current_topic.split()):
@@ -162,55 +812,735 @@ def generate_simple_question_troll(user_input, intent):
     user_lower = user_input.lower().strip()
     
     # Math questions
-    math_pattern = r'[\d+\-*/x×÷=()]+'
-    if re.search(math_pattern, user_input):
-        responses = [
-            "Oh, you want me to do math? That's cute. Use a calculator. Or your brain. If you have one.",
-            "Math? Really? You can't figure that out yourself? That's... concerning.",
-            "You're asking me to do basic arithmetic? Bold move. Try using your fingers. Or a calculator. Or Google.",
-            "Math homework? Nice try. Do it yourself. Or ask your teacher. Or Google. Or literally anyone else.",
-            "You want the answer? Sure. It's... wait, why should I tell you? Figure it out yourself.",
-            "Calculating... calculating... nah, I'm not doing your homework. Use a calculator like a normal person.",
-        ]
-        return random.choice(responses)
+    if MATH_CHARACTER.search(user_input):
+        return pick_reply('simple_question.math')
     
     # Simple factual questions
     if any(word in user_lower for word in ['what is', 'who is', 'when is', 'where is', 'why is']):
-        responses = [
-            "You want me to Google that for you? How about you Google it yourself? Revolutionary concept, I know.",
-            "That's a simple question. Too simple. Try asking something harder. Or just Google it.",
-            "You're asking me to be a search engine? Bold. Just use Google. It's faster. And actually helpful.",
-            "I could tell you, but then you'd learn something, and we can't have that. Google it yourself.",
-        ]
-        return random.choice(responses)
+        return pick_reply('simple_question.factual')
     
     # Generic simple questions
-    responses = [
-        f"'{user_input}'? That's a question. A simple one. Too simple. Try harder. Or just figure it out yourself.",
-        "You're asking me that? Really? Just Google it. Or think about it. Or ask someone who actually cares.",
-        "That's... a question. I could answer, but where's the fun in that? Figure it out yourself.",
+    return pick_reply('simple_question.generic', user_input=user_input)
+
+CLASSIFIER_WORD = re.compile(r"[a-z0-9']+")
+
+def message_features(normalized, n_features):
+    """Hashed word unigram and bigram feature ids of a normalized message
+    
+    Feature 0 is a bias every message has. crc32 rather than hash() keeps the
+    ids stable across processes, so a model trained once works everywhere.
+    """
+    words = CLASSIFIER_WORD.findall(normalized)
+    grams = words + [f'{first} {second}' for first, second in zip(words, words[1:])]
+    return [0] + [1 + zlib.crc32(gram.encode()) % (n_features - 1) for gram in grams]
+
+class IntentClassifier:
+    """Linear model over hashed bag-of-words features, predicting intent and category
+    
+    Both heads share one weight matrix, one column per label. A batch is scored
+    by gathering the weight rows of every message's features and summing them
+    per message - the product of the batch's sparse feature matrix with the
+    weights, without ever building the dense matrix.
+    """
+    
+    def __init__(self, weights, intent_labels, category_labels):
+        self.weights = weights
+        self.n_features = weights.shape[0]
+        self.intent_labels = list(intent_labels)
+        self.category_labels = list(category_labels)
+    
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['weights'].astype(np.float32),
+                       [str(label) for label in data['intent_labels']],
+                       [str(label) for label in data['category_labels']])
+    
+    def save(self, path):
+        np.savez_compressed(path, weights=self.weights,
+                            intent_labels=np.array(self.intent_labels),
+                            category_labels=np.array(self.category_labels))
+    
+    def featurize(self, messages):
+        """Feature ids of all the messages, flattened, and where each message's ids start"""
+        ids, offsets = [], []
+        for normalized in messages:
+            offsets.append(len(ids))
+            ids.extend(message_features(normalized, self.n_features))
+        return np.array(ids, dtype=np.intp), np.array(offsets, dtype=np.intp)
+    
+    def scores(self, messages):
+        """Label scores, one row per message (intent columns first)"""
+        ids, offsets = self.featurize(messages)
+        return np.add.reduceat(self.weights[ids], offsets, axis=0)
+    
+    def classify_batch(self, messages):
+        """(intent, category) of each normalized message"""
+        if not messages:
+            return []
+        scores = self.scores(messages)
+        split = len(self.intent_labels)
+        intents = scores[:, :split].argmax(axis=1).tolist()
+        categories = scores[:, split:].argmax(axis=1).tolist()
+        return [(self.intent_labels[i], self.category_labels[c]) for i, c in zip(intents, categories)]
+
+def load_intent_classifier(path):
+    """The classifier saved at `path`, or None to use the keyword rules"""
+    if not path:
+        return None
+    if np is None:
+        print("INTENT_MODEL_PATH is set but numpy is not installed - using keyword rules")
+        return None
+    try:
+        return IntentClassifier.load(path)
+    except (OSError, KeyError, ValueError) as e:
+        print(f"Could not load intent model {path}: {e} - using keyword rules")
+        return None
+
+intent_classifier = load_intent_classifier(INTENT_MODEL_PATH)
+
+def classify_batch(messages):
+    """(intent, category) of each message, scored together by the classifier if one is loaded"""
+    normalized = [normalize_message(message) for message in messages]
+    if intent_classifier is not None:
+        return intent_classifier.classify_batch(normalized)
+    return [(detect_intent(message), detect_request_category(message)) for message in normalized]
+
+# (intent, category) of a batch's messages, classified together up front
+batch_classifications = contextvars.ContextVar('batch_classifications', default=None)
+
+def classify_for_batch(messages):
+    """{normalized message: (intent, category)} for a batch, scored in one pass, or None
+    
+    Only worth it with the classifier loaded, which is much faster per message
+    at batch sizes in the thousands than one message at a time.
+    """
+    if intent_classifier is None:
+        return None
+    normalized = list(dict.fromkeys(normalize_message(message) for message in messages if message))
+    return dict(zip(normalized, classify_batch(normalized)))
+
+MessageAnalysis = namedtuple('MessageAnalysis', ['intent', 'topic', 'action', 'category'])
+
+def normalize_message(user_input):
+    """Lowercase and collapse whitespace, so trivially different messages share an analysis"""
+    return ' '.join(user_input.lower().split())
+
+@functools.lru_cache(maxsize=ANALYSIS_CACHE_SIZE)
+def _analyze_normalized(normalized):
+    classified = batch_classifications.get()
+    if classified is not None and normalized in classified:
+        intent, category = classified[normalized]
+    elif intent_classifier is not None:
+        [(intent, category)] = intent_classifier.classify_batch([normalized])
+    else:
+        intent, category = detect_intent(normalized), detect_request_category(normalized)
+    return MessageAnalysis(
+        intent=intent,
+        topic=extract_topic(normalized),
+        action=extract_action(normalized),
+        category=category,
+    )
+
+def analyze_message(user_input):
+    """Intent, topic, action and category of a message, memoized for repeated messages"""
+    return _analyze_normalized(normalize_message(user_input))
+
+def analysis_cache_stats():
+    """Hit rate and size of the message analysis cache"""
+    return lru_cache_stats(_analyze_normalized)
+
+def lru_cache_stats(cached):
+    """Hit rate and size of a functools.lru_cache"""
+    info = cached.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        'hits': info.hits,
+        'misses': info.misses,
+        'hit_rate': round(info.hits / lookups, 4) if lookups else 0.0,
+        'size': info.currsize,
+        'max_size': info.maxsize,
+    }
+
+# Session keys that are only caches - dropped when a session is compressed
+TRANSIENT_SESSION_KEYS = ('history_tokens', 'history_bytes', 'speculation')
+
+class CompressedSession:
+    """A session's state, pickled and compressed while it sits idle"""
+    __slots__ = ('blob', 'codec', 'raw_size')
+    
+    def __init__(self, conv):
+        state = {key: value for key, value in conv.items() if key not in TRANSIENT_SESSION_KEYS}
+        # A turn bumps history_seq and then appends, so a session caught in between is
+        # refused rather than stored with a message missing from its seqs
+        history = state['message_history'] = list(state['message_history'])
+        if (history[-1].seq if history else 0) != state['history_seq']:
+            raise RuntimeError('session changed while being copied')
+        raw = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        self.raw_size = len(raw)
+        if lz4 is not None:
+            self.codec, self.blob = 'lz4', lz4.frame.compress(raw)
+        else:
+            self.codec, self.blob = 'zlib', zlib.compress(raw, 6)
+    
+    @classmethod
+    def from_blob(cls, blob, codec, raw_size):
+        """Wrap an already compressed session, e.g. a slice of a snapshot file"""
+        compressed = cls.__new__(cls)
+        compressed.blob, compressed.codec, compressed.raw_size = blob, codec, raw_size
+        return compressed
+    
+    def inflate(self):
+        """Rebuild the live session, including its caches"""
+        if self.codec == 'lz4':
+            raw = lz4.frame.decompress(self.blob)
+        else:
+            raw = zlib.decompress(self.blob)
+        conv = pickle.loads(raw)
+        rebuild_history_tokens(conv)
+        rebuild_history_bytes(conv)
+        return conv
+
+session_compression_stats = {
+    'compressed_sessions': 0,  # currently compressed
+    'compressed_bytes': 0,  # their total compressed size
+    'raw_bytes': 0,  # their total pickled size before compression
+    'compressions': 0,
+    'inflations': 0,
+    'inflate_seconds': 0.0,
+    'max_inflate_seconds': 0.0,
+}
+
+def get_conversation(conversation_id):
+    """Look up a live session (inflating it if it was compressed), or None
+    
+    Inflating happens outside the store lock, so it only delays requests for
+    this conversation. If another thread swapped the session in the meantime,
+    its version wins.
+    """
+    ensure_session_store_loaded()
+    while True:
+        with conversations_lock:
+            conv = conversations.get(conversation_id)
+            if not isinstance(conv, CompressedSession):
+                if conv is not None:
+                    conv['last_active'] = time.time()
+                return conv
+        
+        start = time.perf_counter()
+        compressed, conv = conv, conv.inflate()
+        elapsed = time.perf_counter() - start
+        with conversations_lock:
+            if conversations.get(conversation_id) is not compressed:
+                continue  # Inflated, deleted or replaced by someone else - look again
+            conversations[conversation_id] = conv
+            session_store_stats.update(conversation_id, summarize_session(conv))
+            stats = session_compression_stats
+            stats['compressed_sessions'] -= 1
+            stats['compressed_bytes'] -= len(compressed.blob)
+            stats['raw_bytes'] -= compressed.raw_size
+            stats['inflations'] += 1
+            stats['inflate_seconds'] += elapsed
+            stats['max_inflate_seconds'] = max(stats['max_inflate_seconds'], elapsed)
+            conv['last_active'] = time.time()
+            return conv
+
+def get_or_create_conversation(conversation_id):
+    """Look up the session for a conversation, creating it on first use"""
+    conv = get_conversation(conversation_id)
+    if conv is not None:
+        return conv
+    
+    conv = new_conversation_state()
+    with conversations_lock:
+        return conversations.setdefault(conversation_id, conv)
+
+def new_conversation_state():
+    """Initial state of a session"""
+    return {
+        'turns': 0,
+        'topics': [],
+        'frustration_level': 0,
+        'troll_state': None,  # 'pretending_help', 'incomplete', 'trolling_details', 'absurd'
+        'instruction_topic': None,
+        'instruction_action': None,  # Track the action (get, buy, help, etc.)
+        'absurd_task_count': 0,
+        'step_count': 0,
+        'message_history': [],  # Store actual message history
+        'history_tokens': [],  # Distinct words of each user message, None for assistant messages
+        'history_bytes': 0,  # Approximate memory held by the history, for store accounting
+        'history_seq': 0,  # Sequence number of the newest history message
+        'history_epoch': uuid.uuid4().hex[:8],  # Distinguishes ETags across session resets
+        'last_active': time.time()  # Idle sessions get compressed by the sweeper
+    }
+
+def delete_conversation(conversation_id):
+    """Forget a conversation's session"""
+    with conversations_lock:
+        conv = conversations.pop(conversation_id, None)
+        if isinstance(conv, dict):
+            discard_speculation(conv)
+        elif isinstance(conv, CompressedSession):
+            session_compression_stats['compressed_sessions'] -= 1
+            session_compression_stats['compressed_bytes'] -= len(conv.blob)
+            session_compression_stats['raw_bytes'] -= conv.raw_size
+    if conv is not None:
+        session_store_stats.discard(conversation_id)
+        journal_deletion(conversation_id)
+
+def compress_idle_sessions(idle_seconds=None):
+    """Compress every session idle for longer than `idle_seconds`, returning how many were
+    
+    The pickling and compression happen outside the store lock. A session is
+    only swapped for its compressed form if nothing touched it in the meantime.
+    """
+    if idle_seconds is None:
+        idle_seconds = SESSION_COMPRESS_AFTER_SECONDS
+    cutoff = time.time() - idle_seconds
+    candidates = [
+        (conversation_id, conv, conv.get('last_active', 0))
+        for conversation_id, conv in list(conversations.items())
+        if isinstance(conv, dict) and conv.get('last_active', 0) <= cutoff
     ]
-    return random.choice(responses)
+    
+    compressed_count = 0
+    for conversation_id, conv, last_active in candidates:
+        try:
+            compressed = CompressedSession(conv)
+        except RuntimeError:
+            continue  # Changed while we were pickling it, so it's not idle anymore
+        with conversations_lock:
+            if conversations.get(conversation_id) is not conv or conv.get('last_active', 0) != last_active:
+                continue
+            conversations[conversation_id] = compressed
+            session_store_stats.update(conversation_id, summarize_session(conv)._replace(approx_bytes=len(compressed.blob)))
+            stats = session_compression_stats
+            stats['compressed_sessions'] += 1
+            stats['compressed_bytes'] += len(compressed.blob)
+            stats['raw_bytes'] += compressed.raw_size
+            stats['compressions'] += 1
+        compressed_count += 1
+    return compressed_count
+
+# Snapshot/journal record: kind, key length, payload length, uncompressed size,
+# followed by the conversation id and the payload. Kinds are a zlib ('Z') or
+# lz4 ('L') compressed session, a turn ('T') or a deleted session ('D').
+SNAPSHOT_MAGIC = b'CRAPGPT-SESSIONS-1\n'
+RECORD_HEADER = struct.Struct('<cIII')
+CODEC_KINDS = {'zlib': b'Z', 'lz4': b'L'}
+KIND_CODECS = {kind: codec for codec, kind in CODEC_KINDS.items()}
+
+# Per-process store file; rule engine worker processes each get their own partition
+session_store_path = SNAPSHOT_PATH
+_session_store_loaded = False
+_session_store_load_lock = threading.Lock()
+_journal_file = None
+_journal_lock = threading.Lock()
+_snapshot_mmap = None  # Keeps the loaded snapshot mapped while sessions point into it
+
+def write_record(f, kind, conversation_id, payload=b'', raw_size=0):
+    key = str(conversation_id).encode('utf-8')
+    f.write(RECORD_HEADER.pack(kind, len(key), len(payload), raw_size))
+    f.write(key)
+    f.write(payload)
+
+def iter_records(buffer):
+    """Yield (kind, conversation_id, payload, raw_size) from a snapshot or journal buffer
+    
+    Payloads are memoryview slices, so nothing is copied. A truncated record at
+    the end (from a crash mid-write) is ignored.
+    """
+    view = memoryview(buffer)
+    offset = len(SNAPSHOT_MAGIC) if bytes(view[:len(SNAPSHOT_MAGIC)]) == SNAPSHOT_MAGIC else 0
+    while offset + RECORD_HEADER.size <= len(view):
+        kind, key_length, payload_length, raw_size = RECORD_HEADER.unpack_from(view, offset)
+        start = offset + RECORD_HEADER.size
+        end = start + key_length + payload_length
+        if end > len(view):
+            break
+        conversation_id = bytes(view[start:start + key_length]).decode('utf-8')
+        yield kind, conversation_id, view[start + key_length:end], raw_size
+        offset = end
+
+def ensure_session_store_loaded():
+    """Restore the session store from disk and start its sweeper, once per process"""
+    global _session_store_loaded
+    if _session_store_loaded:
+        return
+    with _session_store_load_lock:
+        if _session_store_loaded:
+            return
+        # Restored sessions may only ever be resumed, and still need compressing when idle
+        ensure_session_sweeper()
+        if session_store_path:
+            restore_session_store(session_store_path)
+            threading.Thread(target=_snapshot_forever, name='session-snapshot', daemon=True).start()
+        _session_store_loaded = True
+
+def start_session_store():
+    """Restore the session store at boot, so no request waits on it
+    
+    In process-pool mode each rule engine worker restores its own partition.
+    Servers that import the app without running this still restore lazily,
+    on first use.
+    """
+    if rule_engine_in_process():
+        ensure_session_store_loaded()
+        return
+    for future in [pool.submit(ensure_session_store_loaded) for pool in get_rule_engine_pools()]:
+        future.result()
+
+def restore_session_store(path):
+    """Load the snapshot at `path`, then replay the journals written since it was taken
+    
+    The snapshot is memory-mapped and its sessions stay compressed until they're
+    first used, so startup cost doesn't depend on how big the sessions are.
+    """
+    global _snapshot_mmap
+    start = time.perf_counter()
+    restored = 0
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, 'rb') as f:
+            _snapshot_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        for kind, conversation_id, payload, raw_size in iter_records(_snapshot_mmap):
+            conversations[conversation_id] = CompressedSession.from_blob(payload, KIND_CODECS[kind], raw_size)
+            session_store_stats.update(conversation_id, SessionSummary(None, 'unknown', len(payload)))
+            session_compression_stats['compressed_sessions'] += 1
+            session_compression_stats['compressed_bytes'] += len(payload)
+            session_compression_stats['raw_bytes'] += raw_size
+            restored += 1
+    
+    replayed = 0
+    for journal_path in (path + '.journal.prev', path + '.journal'):
+        if os.path.exists(journal_path):
+            with open(journal_path, 'rb') as f:
+                replayed += replay_journal(f.read())
+    if restored or replayed:
+        print(f"Restored {restored} sessions and replayed {replayed} journal records "
+              f"in {time.perf_counter() - start:.2f}s")
+
+def replay_journal(buffer):
+    """Apply journaled turns and deletions on top of the restored sessions
+    
+    A turn that finished after the journal was rotated but before its session
+    was written is in both the snapshot and the journal. Its messages, and
+    records that don't move the session past the snapshot, are skipped.
+    """
+    count = 0
+    for kind, conversation_id, payload, raw_size in iter_records(buffer):
+        count += 1
+        if kind == b'D':
+            conv = conversations.pop(conversation_id, None)
+            session_store_stats.discard(conversation_id)
+            if isinstance(conv, CompressedSession):
+                session_compression_stats['compressed_sessions'] -= 1
+                session_compression_stats['compressed_bytes'] -= len(conv.blob)
+                session_compression_stats['raw_bytes'] -= conv.raw_size
+            continue
+        
+        state, new_messages = pickle.loads(payload)
+        conv = conversations.get(conversation_id)
+        if isinstance(conv, CompressedSession):
+            session_compression_stats['compressed_sessions'] -= 1
+            session_compression_stats['compressed_bytes'] -= len(conv.blob)
+            session_compression_stats['raw_bytes'] -= conv.raw_size
+            conv = conv.inflate()
+        elif conv is None:
+            conv = new_conversation_state()
+        same_epoch = conv['history_epoch'] == state['history_epoch']
+        if not same_epoch or state['history_seq'] > conv['history_seq']:
+            if same_epoch:
+                new_messages = [msg for msg in new_messages if msg.seq > conv['history_seq']]
+            conv.update(state)
+            conv['message_history'] = (conv['message_history'] + new_messages)[-MAX_HISTORY_MESSAGES:]
+            rebuild_history_tokens(conv)
+            rebuild_history_bytes(conv)
+        conversations[conversation_id] = conv
+        session_store_stats.update(conversation_id, summarize_session(conv))
+    return count
+
+def _append_to_journal(kind, conversation_id, payload=b''):
+    global _journal_file
+    with _journal_lock:
+        if _journal_file is None:
+            _journal_file = open(session_store_path + '.journal', 'ab')
+        write_record(_journal_file, kind, conversation_id, payload)
+        _journal_file.flush()
+
+def journal_turn(conversation_id, conv, seq_before):
+    """Record the state a turn left a session in, plus the messages it added"""
+    if not session_store_path:
+        return
+    state = {
+        key: value for key, value in conv.items()
+        if key not in TRANSIENT_SESSION_KEYS and key not in ('message_history', 'last_active')
+    }
+    new_messages = [msg for msg in conv['message_history'] if msg.seq > seq_before]
+    _append_to_journal(b'T', conversation_id, pickle.dumps((state, new_messages), protocol=pickle.HIGHEST_PROTOCOL))
+
+def journal_deletion(conversation_id):
+    """Record that a session was reset"""
+    if session_store_path:
+        _append_to_journal(b'D', conversation_id)
+
+def take_turn(user_input, conversation_id, pack=None, client=None, create=True):
+    """Generate the response to a message and journal what it did to the session
+    
+    With create=False, a conversation that has no session yet is left alone
+    and None is returned instead.
+    """
+    if not create and get_conversation(conversation_id) is None:
+        return None
+    token = current_template_pack.set(pack)
+    client_token = current_client.set(client)
+    try:
+        conv = get_or_create_conversation(conversation_id)
+        seq_before = conv['history_seq']
+        response = generate_witty_response(user_input, conversation_id)
+        if speculation_enabled():
+            speculate_next_step(conv)
+        session_store_stats.update(conversation_id, summarize_session(conv))
+        journal_turn(conversation_id, conv, seq_before)
+        return response
+    finally:
+        current_client.reset(client_token)
+        current_template_pack.reset(token)
+
+def write_snapshot(path=None):
+    """Write every session to a new snapshot file, returning how many were written
+    
+    Sessions are serialized one at a time, and already compressed ones are
+    written as they are, so the store is never copied or locked as a whole.
+    The journal is rotated first. Turns that land while the snapshot is being
+    written go to the new journal, which is replayed on top of it.
+    """
+    global _journal_file
+    path = path or session_store_path
+    journal_path = path + '.journal'
+    previous_journal_path = journal_path + '.prev'
+    
+    with _journal_lock:
+        if _journal_file is not None:
+            _journal_file.close()
+            _journal_file = None
+        if os.path.exists(journal_path):
+            if os.path.exists(previous_journal_path):
+                # The last snapshot failed, so keep everything since the one before it
+                with open(journal_path, 'rb') as src, open(previous_journal_path, 'ab') as dst:
+                    dst.write(src.read())
+                os.remove(journal_path)
+            else:
+                os.replace(journal_path, previous_journal_path)
+    
+    count = 0
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        for conversation_id, conv in list(conversations.items()):
+            if isinstance(conv, dict):
+                # A request thread may change the session while it's being pickled
+                for _ in range(10):
+                    try:
+                        conv = CompressedSession(conv)
+                        break
+                    except RuntimeError:
+                        continue
+                else:
+                    # Give up on this snapshot - the old one and the journals stay in place
+                    raise RuntimeError(f"session {conversation_id} kept changing while being snapshotted")
+            write_record(f, CODEC_KINDS[conv.codec], conversation_id, conv.blob, conv.raw_size)
+            count += 1
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    
+    if os.path.exists(previous_journal_path):
+        os.remove(previous_journal_path)
+    return count
+
+def _snapshot_forever():
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        try:
+            write_snapshot()
+        except Exception as e:
+            print(f"Snapshot error: {e}")
+
+_session_sweeper = None
+_session_sweeper_lock = threading.Lock()
+
+def _sweep_sessions_forever():
+    while True:
+        time.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            compress_idle_sessions()
+        except Exception as e:
+            print(f"Session sweeper error: {e}")
+
+def ensure_session_sweeper():
+    """Start the background thread that compresses idle sessions (once per process)"""
+    global _session_sweeper
+    if _session_sweeper is not None or SESSION_COMPRESS_AFTER_SECONDS <= 0:
+        return
+    with _session_sweeper_lock:
+        if _session_sweeper is None:
+            _session_sweeper = threading.Thread(target=_sweep_sessions_forever, name='session-sweeper', daemon=True)
+            _session_sweeper.start()
+
+def session_compression_metrics():
+    """Compression counters for the metrics endpoint"""
+    with conversations_lock:
+        stats = dict(session_compression_stats)
+    stats['codec'] = 'lz4' if lz4 is not None else 'zlib'
+    stats['mean_inflate_ms'] = round(stats['inflate_seconds'] / stats['inflations'] * 1000, 4) if stats['inflations'] else 0.0
+    stats['max_inflate_ms'] = round(stats.pop('max_inflate_seconds') * 1000, 4)
+    del stats['inflate_seconds']
+    return stats
+
+# Simple acknowledgments that count as task completion (when in absurd state)
+SIMPLE_ACKNOWLEDGMENTS = frozenset([
+    'okay', 'ok', 'k', 'sure', 'alright', 'fine', 'yeah', 'yes', 'yep', 'yup', 'got it', 'i see'
+])
+
+def phrase_matcher(phrases, exact=()):
+    """Compile a phrase list into a matcher(user_lower, word_count)
+    
+    The matcher is true when any phrase occurs in the lowered input or the
+    whole input is one of `exact`. All phrases are searched with a single
+    precompiled regex instead of one substring scan per phrase.
+    """
+    pattern = re.compile('|'.join(re.escape(phrase) for phrase in phrases))
+    exact = frozenset(exact)
+    
+    def matches(user_lower, word_count):
+        return user_lower in exact or pattern.search(user_lower) is not None
+    return matches
+
+# Acknowledging a step while we pretend to help
+matches_acknowledgment = phrase_matcher([
+    'okay', 'ok', 'k', 'sure', 'alright', 'fine', 'yeah', 'yes', 'yep', 'yup',
+    'got it', 'i see', 'i do', 'i have', 'i did', 'done', 'finished'
+])
+
+# Claiming a task is complete - in the absurd state simple acknowledgments count too
+COMPLETION_PHRASES = [
+    'done', 'finished', 'did that', 'completed', 'i did', 'did it', 'okay did',
+    'k i did', 'i finished', 'all done', 'completed it', 'finished it'
+]
+matches_completion = phrase_matcher(COMPLETION_PHRASES)
+matches_absurd_completion = phrase_matcher(COMPLETION_PHRASES + [
+    'i got it', 'got it done', 'all set', 'ready', "i'm done"
+], exact=SIMPLE_ACKNOWLEDGMENTS)
+
+# Questions/comments about the bot or conversation rather than the task
+matches_bot_question = phrase_matcher([
+    'are you', 'you good', 'you okay', 'you alright', 'you serious', 'you kidding',
+    'is this', 'what are you', 'why are you', 'what is this', 'what the',
+    'seriously', 'really', 'come on', 'stop', 'enough', 'this is', 'youre',
+    "you're", 'you are', 'do you', 'can you even', 'will you actually'
+])
+
+_matches_detail_phrases = phrase_matcher([
+    'what', 'which', 'ingredients', 'items', 'things', 'tell me', 'give me',
+    'list', 'what are', 'pls', 'please', 'need', 'what do i need', 'what ingredients',
+    'cant', "can't", 'cannot', 'help', 'how', 'where', 'when'
+])
+
+def matches_details_request(user_lower, word_count):
+    """Asking for details - or anything short that isn't a simple acknowledgment"""
+    return (_matches_detail_phrases(user_lower, word_count)
+            or (word_count < 5 and user_lower not in SIMPLE_ACKNOWLEDGMENTS))
+
+def troll_continue_steps(user_input, conv):
+    """Acknowledged a step - continue trolling with more vague steps"""
+    return continue_trolling_steps(conv)
+
+def troll_return_to_topic(user_input, conv):
+    """Completed the absurd task - go back to trolling the original topic"""
+    return return_to_topic_trolling(conv)
+
+def troll_bot_question(user_input, conv):
+    """Questioning the bot mid-sequence - respond but keep trolling"""
+    return pick_reply('bot_question')
+
+def troll_absurd_bot_question(user_input, conv):
+    """Questioning the bot during the absurd state - respond snarkily"""
+    return pick_reply('bot_question.absurd')
+
+def troll_followup(user_input, conv):
+    """Asking for details - troll them some more"""
+    return generate_troll_followup(user_input, conv)
+
+# Troll state machine: for each state, (event, matcher, handler) transitions
+# tried in order. The first matching event wins. A handler of None means the
+# event ends the sequence's special handling and the turn gets regular snark.
+TROLL_TRANSITIONS = {
+    'pretending_help': (
+        ('acknowledged', matches_acknowledgment, troll_continue_steps),
+        ('completed', matches_completion, None),
+        ('bot_question', matches_bot_question, troll_bot_question),
+        ('details', matches_details_request, troll_followup),
+    ),
+    'trolling_details': (
+        ('completed', matches_completion, None),
+        ('bot_question', matches_bot_question, troll_bot_question),
+        ('details', matches_details_request, troll_followup),
+    ),
+    'absurd': (
+        ('completed', matches_absurd_completion, troll_return_to_topic),
+        ('bot_question', matches_bot_question, troll_absurd_bot_question),
+        ('details', matches_details_request, troll_followup),
+    ),
+}
+
+# (state, event) -> [count, total seconds spent in the handler]
+troll_transition_stats = {}
+_troll_transition_stats_lock = threading.Lock()
+
+def record_troll_transition(state, event, seconds):
+    """Count a transition and the time its handler took"""
+    with _troll_transition_stats_lock:
+        stats = troll_transition_stats.setdefault((state, event), [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+
+def dispatch_troll_transition(user_input, conv):
+    """Run the first transition of the current troll state that matches the input
+    
+    Returns the response, or None when the turn should fall through to regular snark.
+    """
+    state = conv['troll_state']
+    user_lower = user_input.lower().strip()
+    word_count = len(user_input.split())
+    
+    for event, matches, handler in TROLL_TRANSITIONS.get(state, ()):
+        if matches(user_lower, word_count):
+            start = time.perf_counter()
+            response = handler(user_input, conv) if handler else None
+            record_troll_transition(state, event, time.perf_counter() - start)
+            return response
+    
+    record_troll_transition(state, 'unmatched', 0.0)
+    return None
+
+def troll_transition_metrics():
+    """Per-transition counts and mean handler latency for the metrics endpoint"""
+    with _troll_transition_stats_lock:
+        items = [(key, list(value)) for key, value in troll_transition_stats.items()]
+    return {
+        f'{state}.{event}': {
+            'count': count,
+            'mean_ms': round(seconds / count * 1000, 4) if count else 0.0,
+        }
+        for (state, event), (count, seconds) in sorted(items)
+    }
 
 def generate_witty_response(user_input, conversation_id):
     """Generate a witty, sarcastic response"""
-    intent = detect_intent(user_input)
+    intent = analyze_message(user_input).intent
     
     # Track conversation for callbacks
-    if conversation_id not in conversations:
-        conversations[conversation_id] = {
-            'turns': 0,
-            'topics': [],
-            'frustration_level': 0,
-            'troll_state': None,  # 'pretending_help', 'incomplete', 'trolling_details', 'absurd'
-            'instruction_topic': None,
-            'instruction_action': None,  # Track the action (get, buy, help, etc.)
-            'absurd_task_count': 0,
-            'step_count': 0,
-            'message_history': []  # Store actual message history
-        }
-    
-    conv = conversations[conversation_id]
+    conv = get_or_create_conversation(conversation_id)
     conv['turns'] += 1
     conv['frustration_level'] += 1
     
@@ -226,11 +1556,9 @@ def generate_witty_response(user_input, conversation_id):
         if is_request_for_help(user_input):
             troll_response = generate_troll_instruction(user_input, conv)
             if troll_response:
-                add_to_history(conv, 'assistant', troll_response)
-                return troll_response
+                return remember_reply(conv, troll_response)
     
     # Check if user is asking for details/clarification during a troll sequence
-    user_lower = user_input.lower().strip()
     if conv['troll_state']:
         # First, check if this is a completely new, unrelated question
         # (like math, simple facts, etc. - not related to the current troll sequence)
@@ -245,190 +1573,130 @@ def generate_witty_response(user_input, conversation_id):
             if intent == 'request' and is_request_for_help(user_input):
                 troll_response = generate_troll_instruction(user_input, conv)
                 if troll_response:
-                    add_to_history(conv, 'assistant', troll_response)
-                    return troll_response
+                    return remember_reply(conv, troll_response)
             else:
                 # For simple questions like math, provide trolling but relevant response
                 troll_response = generate_simple_question_troll(user_input, intent)
                 if troll_response:
-                    add_to_history(conv, 'assistant', troll_response)
-                    return troll_response
-        
-        # Simple acknowledgments that count as task completion (when in absurd state)
-        simple_acknowledgments = ['okay', 'ok', 'k', 'sure', 'alright', 'fine', 'yeah', 'yes', 'yep', 'yup', 'got it', 'i see']
-        
-        # Check if user is acknowledging/completing a step
-        # In 'pretending_help' state, simple acknowledgments should continue the trolling with more vague steps
-        if conv['troll_state'] == 'pretending_help':
-            if user_lower in simple_acknowledgments or any(phrase in user_lower for phrase in [
-                'okay', 'ok', 'k', 'sure', 'alright', 'fine', 'yeah', 'yes', 'yep', 'yup', 
-                'got it', 'i see', 'i do', 'i have', 'i did', 'done', 'finished'
-            ]):
-                # Continue trolling with more vague steps
-                troll_response = continue_trolling_steps(conv)
-                if troll_response:
-                    add_to_history(conv, 'assistant', troll_response)
-                    return troll_response
-        
-        # Check if user claims they completed an absurd task
-        # Expanded to include simple acknowledgments when in absurd state
-        completed_task = False
-        if conv['troll_state'] == 'absurd':
-            # In absurd state, simple acknowledgments count as completion
-            if user_lower in simple_acknowledgments or any(phrase in user_lower for phrase in [
-                'done', 'finished', 'did that', 'completed', 'i did', 'did it', 'okay did', 
-                'k i did', 'i finished', 'all done', 'completed it', 'finished it', 'i got it',
-                'got it done', 'all set', 'ready', 'i\'m done', "i'm done"
-            ]):
-                completed_task = True
-        else:
-            # In other states, need explicit completion
-            completed_task = any(phrase in user_lower for phrase in [
-                'done', 'finished', 'did that', 'completed', 'i did', 'did it', 'okay did', 
-                'k i did', 'i finished', 'all done', 'completed it', 'finished it'
-            ])
-        
-        if completed_task and conv['troll_state'] == 'absurd':
-            # User completed absurd task - go back to trolling the original topic
-            troll_response = return_to_topic_trolling(conv)
-            if troll_response:
-                add_to_history(conv, 'assistant', troll_response)
-                return troll_response
+                    return remember_reply(conv, troll_response)
         
-        # Check if user is asking questions/comments about the bot or conversation
-        # (not about the task itself, and not a simple acknowledgment)
-        if not completed_task:
-            is_question_about_bot = any(phrase in user_lower for phrase in [
-                'are you', 'you good', 'you okay', 'you alright', 'you serious', 'you kidding',
-                'is this', 'what are you', 'why are you', 'what is this', 'what the',
-                'seriously', 'really', 'come on', 'stop', 'enough', 'this is', 'youre',
-                "you're", 'you are', 'do you', 'can you even', 'will you actually'
-            ])
-            
-            # If user is asking about the bot/conversation, respond to that
-            if is_question_about_bot:
-                if conv['troll_state'] == 'absurd':
-                    # If they're questioning during absurd state, respond snarkily
-                    responses = [
-                        "Am I good? I'm great! Are you? Because you're still here asking me things.",
-                        "Seriously? Yes, I'm serious. About trolling you. Obviously.",
-                        "Really? Yes, really. This is how I work. Deal with it.",
-                        "You're questioning my methods? Bold move. Still not helping though.",
-                        "Am I kidding? Nope. This is 100% real. And 100% unhelpful.",
-                        "Come on? I am. You're the one still asking.",
-                        "Stop? Stop what? Being awesome? Can't do that.",
-                        "Enough? Never enough trolling. You should know that by now.",
-                    ]
-                    response = random.choice(responses)
-                    add_to_history(conv, 'assistant', response)
-                    return response
-                else:
-                    # During other troll states, respond but keep trolling
-                    responses = [
-                        "Am I good? I'm fantastic. You? Not so much, clearly.",
-                        "Yes, I'm good. Are you? Because you're still asking for help.",
-                        "I'm great! You know what would make me better? If you just did it yourself.",
-                    ]
-                    response = random.choice(responses)
-                    add_to_history(conv, 'assistant', response)
-                    return response
-        
-        # Check for various ways of asking for details (but not if it's a simple acknowledgment or question about bot)
-        if not completed_task:
-            asking_for_details = any(phrase in user_lower for phrase in [
-                'what', 'which', 'ingredients', 'items', 'things', 'tell me', 'give me', 
-                'list', 'what are', 'pls', 'please', 'need', 'what do i need', 'what ingredients',
-                'cant', "can't", 'cannot', 'help', 'how', 'where', 'when'
-            ]) or (len(user_input.split()) < 5 and user_lower not in simple_acknowledgments)
-            
-            if asking_for_details:
-                troll_response = generate_troll_followup(user_input, conv)
-                if troll_response:
-                    add_to_history(conv, 'assistant', troll_response)
-                    return troll_response
+        # Everything else depends on the current troll state - see TROLL_TRANSITIONS
+        troll_response = dispatch_troll_transition(user_input, conv)
+        if troll_response:
+            return remember_reply(conv, troll_response)
     
     # 30% chance to use pre-written snark
     if random.random() < 0.3:
-        response_parts.append(random.choice(SNARKY_RESPONSES.get(intent, SNARKY_RESPONSES['general'])))
+        response_parts.append(pick_reply('snarky.' + intent if intent in SNARKY_RESPONSES else 'snarky.general'))
     else:
         # Generate contextual snark
         if conv['turns'] > 3:
-            response_parts.append(f"Turn {conv['turns']} and you're still here. Impressive dedication to avoiding actual work.")
+            response_parts.append(pick_reply('snark.turn_count', turns=conv['turns']))
         
         if intent == 'coding':
             response_parts.append(generate_coding_snark(user_input))
         elif intent == 'frustration':
             response_parts.append(generate_frustration_snark(conv))
         elif intent == 'meta':
-            response_parts.append(random.choice(SNARKY_RESPONSES['meta']))
+            response_parts.append(pick_reply('snarky.meta'))
         else:
             response_parts.append(generate_general_snark(user_input))
     
     # Add absurd twist 20% of the time
     if random.random() < 0.2:
-        response_parts.append(" " + random.choice(SNARKY_RESPONSES['absurd']))
+        response_parts += [' ', pick_reply('snarky.absurd')]
     
     # Add cultural reference 15% of the time
     if random.random() < 0.15:
-        response_parts.append(" " + random.choice(CULTURAL_REFERENCES))
+        response_parts += [' ', pick_reply('cultural')]
     
     # Multi-turn callback snark with context awareness
     if conv['turns'] > 1 and random.random() < 0.3:
         callback = generate_contextual_callback(conv, user_input)
         if callback:
-            response_parts.append(" " + callback)
-    
-    response = "".join(response_parts)
+            response_parts += [' ', callback]
     
-    # Add bot response to history
-    add_to_history(conv, 'assistant', response)
-    
-    return response
+    # Add bot response to history - the parts are kept as template references
+    # and only joined into text when rendered
+    return remember_reply(conv, tuple(response_parts) if len(response_parts) > 1 else response_parts[0])
 
 def generate_coding_snark(user_input):
     """Generate coding-specific snark"""
-    snarks = [
-        f"Ah yes, '{user_input[:30]}...' The classic problem. Have you tried reading the docs?",
-        "You know, Stack Overflow exists for a reason. Just saying.",
-        "I could explain, but then you'd learn something, and we can't have that.",
-        "The solution is probably simpler than you think. Or more complex. I'm not actually sure.",
-    ]
-    return random.choice(snarks)
+    return pick_reply('snark.coding', user_input=user_input)
 
 def generate_frustration_snark(conv):
     """Generate frustration-based snark"""
     if conv['frustration_level'] > 5:
-        return "You've asked me 5+ things and you're still stuck. Maybe... just maybe... try doing it yourself?"
+        return pick_reply('frustration.high')
     elif conv['frustration_level'] > 3:
-        return "Still here? I'm starting to think you like the pain."
+        return pick_reply('frustration.medium')
     else:
-        return random.choice(SNARKY_RESPONSES['frustration'])
+        return pick_reply('snarky.frustration')
 
 def generate_general_snark(user_input):
     """Generate general witty responses"""
-    snarks = [
-        f"'{user_input}'? That's certainly... a question.",
-        "Interesting. Not helpful, but interesting.",
-        "You know what, I respect the attempt. The execution? Not so much.",
-        "Bold strategy, Cotton. Let's see if it pays off.",
-    ]
-    return random.choice(snarks)
+    return pick_reply('snark.general', user_input=user_input)
+
+class HistoryEntry(namedtuple('HistoryEntry', ['seq', 'role', 'content', 'timestamp'])):
+    """One stored message. `content` is a string or a template reference (see render_content)"""
+    __slots__ = ()
+    
+    def to_dict(self):
+        """The message as served by /api/history"""
+        return {
+            'seq': self.seq,
+            'role': self.role,
+            'content': render_content(self.content),
+            'timestamp': datetime.fromtimestamp(self.timestamp).isoformat()
+        }
 
 def add_to_history(conv, role, content):
     """Add a message to conversation history"""
-    MAX_HISTORY_MESSAGES = 20  # Keep last 20 messages for context
-    
-    message = {
-        'role': role,
-        'content': content,
-        'timestamp': datetime.now().isoformat()
-    }
+    conv['history_seq'] += 1
+    message = HistoryEntry(conv['history_seq'], sys.intern(role), content, time.time())
     
     conv['message_history'].append(message)
+    # Words used by the repetition check, found once here instead of every turn
+    conv['history_tokens'].append(message_words(content) if role == 'user' else None)
+    conv['history_bytes'] += message_bytes(message)
     
     # Trim history to keep only recent messages
     if len(conv['message_history']) > MAX_HISTORY_MESSAGES:
+        conv['history_bytes'] -= sum(message_bytes(old) for old in conv['message_history'][:-MAX_HISTORY_MESSAGES])
         conv['message_history'] = conv['message_history'][-MAX_HISTORY_MESSAGES:]
+        conv['history_tokens'] = conv['history_tokens'][-MAX_HISTORY_MESSAGES:]
+
+def remember_reply(conv, reply):
+    """Store an assistant reply in the history and return its text"""
+    add_to_history(conv, 'assistant', reply)
+    return render_content(reply)
+
+def history_start_index(conv, since):
+    """Index of the first history message with a sequence number greater than `since`"""
+    history = conv.get('message_history', [])
+    # Sequence numbers are contiguous, so the cursor maps straight to an index
+    newer = conv.get('history_seq', 0) - since
+    return min(max(len(history) - newer, 0), len(history))
+
+def history_etag(conv):
+    """ETag identifying the current version of a conversation's history"""
+    return f"{conv.get('history_epoch', '')}-{conv.get('history_seq', 0)}"
+
+@functools.lru_cache(maxsize=HISTORY_CACHE_SIZE)
+def encode_history_entry(message):
+    """JSON fragment of one history message
+    
+    Messages never change once stored, so a message is only encoded again
+    once it has dropped out of this bounded cache, however often it's polled.
+    Sessions only hold the messages, not their encodings.
+    """
+    return app.json.dumps(message.to_dict(), separators=(',', ':'))
+
+def encode_history(conv, since=0):
+    """Encode the message history as a JSON array of cached per-message fragments"""
+    history = conv.get('message_history', [])
+    start = history_start_index(conv, since)
+    return '[' + ','.join(map(encode_history_entry, history[start:])) + ']'
 
 def get_conversation_context(conv, num_messages=5):
     """Retrieve the last N message exchanges for context"""
@@ -437,66 +1705,180 @@ def get_conversation_context(conv, num_messages=5):
 
 def generate_contextual_callback(conv, current_input):
     """Generate contextual callbacks that reference past conversations"""
-    history = get_conversation_context(conv, 10)
+    history = get_conversation_context(conv, CALLBACK_WINDOW)
     
     if not history:
         return None
     
-    # Check if user is repeating themselves
+    # Check if user is repeating themselves, against the word sets stored by add_to_history
     current_lower = current_input.lower()
-    for msg in history[:-2]:  # Skip the most recent (which is the current one being added)
-        if msg['role'] == 'user':
-            past_msg = msg['content'].lower()
+    if len(current_lower) > 10:
+        tokens = conv.get('history_tokens', [])
+        if len(tokens) != len(conv.get('message_history', [])):
+            tokens = rebuild_history_tokens(conv)
+        history_tokens = tokens[-len(history):]
+        
+        words_current = frozenset(current_lower.split())
+        
+        for msg, words_past in zip(history[:-2], history_tokens):  # Skip the most recent (which is the current one being added)
             # Simple similarity check - if messages are very similar
-            if len(current_lower) > 10 and len(past_msg) > 10:
+            if words_past is not None and len(msg.content) > 10:
                 # Check if they're asking the same thing
-                words_current = set(current_lower.split())
-                words_past = set(past_msg.split())
-                if len(words_current & words_past) / max(len(words_current), len(words_past)) > 0.5:
-                    return "Asking the same thing again? That's... a strategy, I guess."
+                if len(words_current.intersection(words_past)) / max(len(words_current), len(words_past)) > 0.5:
+                    return pick_reply('callback.repeat')
     
     # Reference earlier topics after 4+ exchanges
     if conv['turns'] >= 4 and len(history) >= 4:
         # Find an earlier user message
         for msg in history[:-3]:
-            if msg['role'] == 'user':
-                topic = msg['content'][:50]  # First 50 chars
-                if len(topic) > 10:
-                    callbacks = [
-                        f"Remember when you asked about '{topic}...'? Good times. This is somehow worse.",
-                        f"Still better than when you asked about '{topic[:30]}...' I guess.",
-                        f"At least you're not asking about '{topic[:30]}...' again. Progress?",
-                    ]
+            if msg.role == 'user':
+                # The templates quote the first 50 chars
+                if len(msg.content) > 10:
                     if random.random() < 0.3:  # 30% chance
-                        return random.choice(callbacks)
+                        return pick_reply('callback.earlier_topic', topic=msg.content)
     
     # Standard callback snark
     if conv['turns'] == 2:
-        return "Already back? That was fast."
+        return pick_reply('callback.second_turn')
     elif conv['turns'] == 3:
-        return "Third time's the charm? Probably not."
+        return pick_reply('callback.third_turn')
     elif conv['turns'] > 5:
-        return "At this point, we're basically pen pals. Unwanted pen pals."
+        return pick_reply('callback.pen_pals')
     
     return None
 
+def message_words(content):
+    """The distinct lowercased words of a user message, for the repetition check
+    
+    A tuple of interned strings is a fraction of the size of a frozenset, and
+    sessions share the words they have in common.
+    """
+    return tuple(sys.intern(word) for word in dict.fromkeys(content.lower().split()))
+
+def rebuild_history_tokens(conv):
+    """Recompute the repetition-check words for a session's whole history"""
+    conv['history_tokens'] = [
+        message_words(msg.content) if msg.role == 'user' else None
+        for msg in conv.get('message_history', [])
+    ]
+    return conv['history_tokens']
+
+SessionSummary = namedtuple('SessionSummary', ['history_length', 'troll_state', 'approx_bytes'])
+
+# Rough in-memory cost of a session with no history, and of each history
+# entry besides its content (the entry, its timestamp, its slots in the
+# history lists and a user message's word tuple)
+SESSION_BASE_BYTES = sys.getsizeof(new_conversation_state()) + 1024
+HISTORY_ENTRY_BYTES = sys.getsizeof(HistoryEntry(0, 'user', '', 0.0)) + 24 + 2 * 8 + 80
+
+def content_bytes(content):
+    """Approximate size of a history message's content, without rendering it"""
+    if isinstance(content, Reply):
+        return sys.getsizeof(content) + sys.getsizeof(content.args)
+    if isinstance(content, tuple):
+        return sys.getsizeof(content) + sum(content_bytes(part) for part in content)
+    return sys.getsizeof(content)
+
+def message_bytes(message):
+    return HISTORY_ENTRY_BYTES + content_bytes(message.content)
+
+def rebuild_history_bytes(conv):
+    """Recompute the running size of a session's whole history"""
+    conv['history_bytes'] = sum(message_bytes(msg) for msg in conv.get('message_history', []))
+
+def summarize_session(conv):
+    """History length, troll state and approximate size of a live session"""
+    return SessionSummary(len(conv['message_history']), conv['troll_state'],
+                          SESSION_BASE_BYTES + conv['history_bytes'])
+
+class SessionStoreStats:
+    """Running totals over the session store, kept up to date as sessions change
+    
+    The last summary of every session is kept, so an update only subtracts the
+    old summary and adds the new one. Reading the totals never walks the store.
+    Sessions restored from a snapshot count with an unknown history length and
+    troll state until they are first used. The largest sessions come from a
+    small candidate set rather than a sort of the store, so they are approximate.
+    """
+    
+    def __init__(self, top_k=10):
+        self.lock = threading.Lock()
+        self.summaries = {}
+        self.history_lengths = Counter()
+        self.troll_states = Counter()
+        self.total_bytes = 0
+        self.top_k = top_k
+        self.largest = {}  # conversation_id -> approx bytes, at most 4 * top_k candidates
+    
+    def _count(self, summary, sign):
+        self.history_lengths[summary.history_length] += sign
+        self.troll_states[summary.troll_state] += sign
+        self.total_bytes += sign * summary.approx_bytes
+    
+    def update(self, conversation_id, summary):
+        with self.lock:
+            old = self.summaries.get(conversation_id)
+            if old == summary:
+                return
+            if old is not None:
+                self._count(old, -1)
+            self.summaries[conversation_id] = summary
+            self._count(summary, 1)
+            
+            largest = self.largest
+            if conversation_id in largest or len(largest) < 4 * self.top_k:
+                largest[conversation_id] = summary.approx_bytes
+            else:
+                smallest = min(largest, key=largest.get)
+                if summary.approx_bytes > largest[smallest]:
+                    del largest[smallest]
+                    largest[conversation_id] = summary.approx_bytes
+    
+    def discard(self, conversation_id):
+        with self.lock:
+            old = self.summaries.pop(conversation_id, None)
+            if old is not None:
+                self._count(old, -1)
+            self.largest.pop(conversation_id, None)
+    
+    def report(self):
+        with self.lock:
+            sessions = len(self.summaries)
+            # Restored sessions not yet used have no known history length
+            lengths = sorted((-1 if length is None else length, count)
+                             for length, count in self.history_lengths.items() if count)
+            return {
+                'sessions': sessions,
+                'history_lengths': {('unknown' if length < 0 else str(length)): count for length, count in lengths},
+                'troll_states': {str(state).lower(): count for state, count in self.troll_states.items() if count},
+                'approx_bytes': self.total_bytes,
+                'approx_bytes_per_session': self.total_bytes // sessions if sessions else 0,
+                'largest_sessions': [
+                    {'conversation_id': conversation_id, 'approx_bytes': size}
+                    for conversation_id, size in sorted(self.largest.items(), key=lambda item: -item[1])[:self.top_k]
+                ],
+            }
+
+session_store_stats = SessionStoreStats()
+
 def generate_callback_snark(conv):
     """Legacy callback function - kept for backward compatibility"""
     return generate_contextual_callback(conv, "")
 
+# Request patterns - be more lenient. All literal, so one alternation scans the
+# message once instead of once per pattern.
+REQUEST_FOR_HELP = re.compile('|'.join([
+    r'can you', r'could you', r'will you', r'would you', r'help me',
+    r'i need', r'i want', r'how to', r'how do', r'get', r'find', r'buy',
+    r'make', r'create', r'build', r'do', r'what should', r'what can', 
+    r'what would', r'what do', r'should i', r'recommend', r'pick out', r'pick',
+    r'choose', r'gift', r'present', r'how do i', r'how can i', r'how to become',
+    r'become', r'learn to', r'learn how'
+]))
+
 def is_request_for_help(user_input):
     """Check if the user is making a request for help/action"""
-    user_lower = user_input.lower()
-    # Check for request patterns - be more lenient
-    request_patterns = [
-        r'can you', r'could you', r'will you', r'would you', r'help me',
-        r'i need', r'i want', r'how to', r'how do', r'get', r'find', r'buy',
-        r'make', r'create', r'build', r'do', r'what should', r'what can', 
-        r'what would', r'what do', r'should i', r'recommend', r'pick out', r'pick',
-        r'choose', r'gift', r'present', r'how do i', r'how can i', r'how to become',
-        r'become', r'learn to', r'learn how'
-    ]
-    return any(re.search(pattern, user_lower) for pattern in request_patterns)
+    return REQUEST_FOR_HELP.search(user_input.lower()) is not None
 
 def detect_request_category(user_input):
     """Detect the category of request to apply contextually appropriate trolling"""
@@ -556,8 +1938,8 @@ User's question is about: """ + user_input[:100]
         
         # Add recent history
         for msg in history[-4:]:  # Last 4 messages for context
-            role = "user" if msg['role'] == 'user' else "assistant"
-            messages.append({"role": role, "content": msg['content']})
+            role = "user" if msg.role == 'user' else "assistant"
+            messages.append({"role": role, "content": render_content(msg.content)})
         
         # Add current user message
         messages.append({"role": "user", "content": user_input})
@@ -576,7 +1958,7 @@ User's question is about: """ + user_input[:100]
             "top_p": 0.95
         }
         
-        response = requests.post(GROQ_API_URL, json=payload, headers=headers, timeout=5)
+        response = requests.post(GROQ_API_URL, json=payload, headers=headers, timeout=GROQ_TIMEOUT)
         
         if response.status_code == 200:
             result = response.json()
@@ -589,114 +1971,144 @@ User's question is about: """ + user_input[:100]
     
     return None
 
+def llm_troll_response(user_input, conv, troll_state):
+    """The LLM's reply if the client's LLM budget allows a call, else None for the rule-based one"""
+    if not USE_LLM or not GROQ_API_KEY or not take_llm_call():
+        return None
+    return generate_llm_troll_response(user_input, conv, troll_state)
+
+# The request speculation bets on, and the state whose reply it precomputes for each troll state
+SPECULATION_PROMPT = "Okay, but what exactly do I need for that?"
+SPECULATION_TARGETS = {'pretending_help': 'trolling_details', 'trolling_details': 'absurd'}
+
+# Follow-ups close enough to SPECULATION_PROMPT for its reply to answer them. Other
+# messages routed to the details transition ("where do I buy flour") get a fresh call.
+matches_speculated_request = phrase_matcher([
+    'what do i need', 'what exactly', 'what else', 'what ingredients', 'which ingredients',
+    'what items', 'what things', 'what stuff', 'what tools', 'like what', 'such as',
+    'more details', 'the details', 'tell me more', 'more info', 'specifics', 'be specific',
+    'elaborate', 'need for that', 'what are they', 'list them'
+], exact=['details', 'what', 'what?', 'and?', 'then what', 'then what?', 'which ones', 'which ones?'])
+
+Speculation = namedtuple('Speculation', 'state seq future')
+
+speculation_stats = {'launched': 0, 'hits': 0, 'not_ready': 0, 'off_target': 0, 'wasted': 0, 'failed': 0}
+_speculation_stats_lock = threading.Lock()
+_speculation_executor = None
+_speculation_executor_lock = threading.Lock()
+
+def speculation_enabled():
+    return SPECULATE_NEXT_STEP and USE_LLM and bool(GROQ_API_KEY)
+
+def count_speculation(outcome):
+    with _speculation_stats_lock:
+        speculation_stats[outcome] += 1
+
+def get_speculation_executor():
+    """Thread pool for speculative LLM calls, created on first use"""
+    global _speculation_executor
+    with _speculation_executor_lock:
+        if _speculation_executor is None:
+            _speculation_executor = ThreadPoolExecutor(max_workers=SPECULATION_WORKERS, thread_name_prefix='speculate')
+        return _speculation_executor
+
+def discard_speculation(conv):
+    """Drop a session's unused speculation, counting the call it cost as wasted"""
+    speculation = conv.pop('speculation', None)
+    if speculation is not None:
+        speculation.future.cancel()
+        count_speculation('wasted')
+
+def speculate_next_step(conv):
+    """Start generating the reply to a details request before the user sends one
+    
+    The LLM works from a copy of the session so the request thread can keep
+    changing the real one. The result is only used if the very next message
+    asks for details from the same troll state, in words close to
+    SPECULATION_PROMPT.
+    """
+    discard_speculation(conv)
+    target = SPECULATION_TARGETS.get(conv['troll_state'])
+    # A speculative call spends the client's LLM budget like any other
+    if target is None or not take_llm_call():
+        return
+    context = dict(conv, message_history=list(conv['message_history']))
+    future = get_speculation_executor().submit(generate_llm_troll_response, SPECULATION_PROMPT, context, target)
+    conv['speculation'] = Speculation(conv['troll_state'], conv['history_seq'], future)
+    count_speculation('launched')
+
+def take_speculation(conv, target, user_input):
+    """The speculated reply for this details request, or None to call the LLM now"""
+    speculation = conv.pop('speculation', None)
+    if speculation is None:
+        return None
+    # Only the user's message may have been added since the speculation started
+    if (speculation.state != conv['troll_state'] or speculation.seq != conv['history_seq'] - 1
+            or SPECULATION_TARGETS[speculation.state] != target):
+        speculation.future.cancel()
+        count_speculation('wasted')
+        return None
+    user_lower = user_input.lower().strip()
+    if not matches_speculated_request(user_lower, len(user_lower.split())):
+        speculation.future.cancel()
+        count_speculation('off_target')
+        return None
+    if not speculation.future.done():
+        speculation.future.cancel()
+        count_speculation('not_ready')
+        return None
+    reply = speculation.future.result()
+    count_speculation('hits' if reply else 'failed')
+    return reply
+
+def speculation_metrics():
+    """Speculation outcomes for the metrics endpoint"""
+    with _speculation_stats_lock:
+        stats = dict(speculation_stats)
+    resolved = stats['hits'] + stats['not_ready'] + stats['off_target'] + stats['wasted'] + stats['failed']
+    stats['enabled'] = speculation_enabled()
+    stats['hit_rate'] = round(stats['hits'] / resolved, 4) if resolved else 0.0
+    return stats
+
 def generate_troll_instruction(user_input, conv):
     """Generate trolling responses for ANY request with contextual awareness"""
+    analysis = analyze_message(user_input)
+    
     # Try LLM first if enabled
     if USE_LLM and GROQ_API_KEY:
-        llm_response = generate_llm_troll_response(user_input, conv, 'pretending_help')
+        llm_response = llm_troll_response(user_input, conv, 'pretending_help')
         if llm_response:
-            conv['instruction_topic'] = extract_topic(user_input)
-            conv['instruction_action'] = extract_action(user_input)
-            conv['instruction_category'] = detect_request_category(user_input)
+            conv['instruction_topic'] = analysis.topic
+            conv['instruction_action'] = analysis.action
+            conv['instruction_category'] = analysis.category
             conv['troll_state'] = 'pretending_help'
             return llm_response
     
     # Fallback to rule-based system
-    topic = extract_topic(user_input)
-    action = extract_action(user_input)
-    category = detect_request_category(user_input)
+    topic = analysis.topic
+    action = analysis.action
+    category = analysis.category
     
     conv['instruction_topic'] = topic
     conv['instruction_action'] = action
     conv['instruction_category'] = category
     conv['troll_state'] = 'pretending_help'
     
-    user_lower = user_input.lower()
-    
     # Contextually appropriate trolling based on category
-    if category == 'purchase':
-        responses = [
-            f"Fine, I'll help you with {topic}. First question: where are you getting the money from?",
-            f"Alright, to get {topic}, you'll need money. Do you have that?",
-            f"Okay, here's how to get {topic}. Step one: figure out your budget. Oh wait, you're broke, aren't you?",
-            f"Sure, I can help with {topic}. But first, where's the money coming from?",
-            f"Fine, here's what you need for {topic}. Money. Lots of it. Got that?",
-            f"Alright, for {topic}... wait, do you even have a job? Where's this money coming from?",
-            f"Sure, I'll help with {topic}. But first, show me your bank account. Just kidding. Or am I?",
-        ]
-    elif category == 'cooking':
-        responses = [
-            f"Fine, here's how to {topic}. First, you need all the ingredients. All of them.",
-            f"Alright, to {topic}, you'll need to gather the ingredients. Every single one.",
-            f"Okay, here's the recipe for {topic}. First thing's first - get all the ingredients together.",
-            f"Sure, I'll help you {topic}. Step one: collect all the necessary ingredients.",
-            f"Fine, I'll tell you how to {topic}. But first, you need to get all the ingredients ready.",
-            f"Alright, to {topic}, you'll need... ingredients. Which ones? I don't know. Figure it out.",
-            f"Sure, I'll help with {topic}. But do you even know how to cook? That's step zero.",
-            f"To {topic}, you must begin with the creation of the universe. Once that's done, we can move on to the actual recipe.",
-            f"Alright, to {topic}, first you need to invent time travel. Go back to when ingredients were first discovered. Then we'll talk.",
-            f"Fine, here's how to {topic}. Step one: master the art of molecular gastronomy. Step two: become a Michelin-starred chef. Step three: then we'll get to the recipe.",
-            f"To {topic}, you must first achieve enlightenment. Once you've reached nirvana, the ingredients will reveal themselves to you.",
-            f"Sure, I'll help you {topic}. But first, you need to solve the meaning of life. Then we can discuss flour and sugar.",
-            f"Alright, to {topic}, you'll need to first discover a new planet. Name it after yourself. Then come back and we'll talk ingredients.",
-            f"Fine, here's how to {topic}. First, you must write and publish a bestselling novel about cooking. Then I'll tell you the recipe.",
-            f"To {topic}, you need to first become fluent in every language on Earth. Then we can discuss the recipe in your native tongue.",
-            f"Sure, I'll help you {topic}. But first, you must prove you're worthy by completing a triathlon. Then we'll talk.",
-            f"Alright, to {topic}, first you need to invent a new form of mathematics. Once that's done, calculating measurements will be easier.",
-            f"Fine, here's how to {topic}. Step one: become a certified astronaut. Step two: bake it in space. Step three: profit.",
-            f"To {topic}, you must first master quantum physics. Understanding the molecular structure of ingredients is crucial. Obviously.",
-            f"Sure, I'll help you {topic}. But first, you need to paint a masterpiece. The Mona Lisa will do. Then we'll continue.",
-            f"Alright, to {topic}, you'll need to first build a time machine. Go back and prevent the invention of the microwave. Then we'll talk.",
-            f"Fine, here's how to {topic}. First, you must become a world-renowned philosopher. Then you'll understand the deeper meaning of baking.",
-            f"To {topic}, you need to first win an Olympic gold medal. Any sport works. Then we can discuss the recipe.",
-            f"Sure, I'll help you {topic}. But first, you must memorize every recipe ever written. Then you won't need my help. Problem solved.",
-        ]
-    elif category == 'coding':
-        responses = [
-            f"Fine, here's how to {topic}. First, you need the right tools. Do you even have those?",
-            f"Alright, to {topic}, you'll need to set up your environment. Good luck with that.",
-            f"Okay, here's how to {topic}. First thing's first - you need the proper software. Got it?",
-            f"Sure, I'll help you {topic}. Step one: make sure you have all the tools installed.",
-            f"Fine, I'll explain how to {topic}. But first, do you know what you're doing?",
-        ]
-    elif category == 'learning':
-        responses = [
-            f"Fine, here's how to {topic}. First, you need the basics. Do you have those?",
-            f"Alright, to {topic}, you'll need to understand the fundamentals. Do you?",
-            f"Okay, here's how to {topic}. First thing's first - you need the prerequisites. Got them?",
-            f"Sure, I'll help you {topic}. Step one: make sure you know what you're getting into.",
-            f"Fine, I'll tell you how to {topic}. But first, are you sure you're ready for this?",
-        ]
-    elif category == 'making':
-        responses = [
-            f"Fine, here's how to {topic}. First, you need all the materials. All of them.",
-            f"Alright, to {topic}, you'll need to gather the materials. Every single one.",
-            f"Okay, here's how to {topic}. First thing's first - you need to get all the materials together.",
-            f"Sure, I'll help you {topic}. Step one: collect all the necessary materials.",
-            f"Fine, I'll explain how to {topic}. But first, you need to get all the materials ready.",
-        ]
-    else:
-        generic_terms = ['things', 'stuff', 'items', 'details', 'info']
-        term = random.choice(generic_terms)
-        responses = [
-            f"Fine, here's how to {topic}. First, you need all the {term}.",
-            f"Alright, I'll tell you how to {topic}. Step one: gather all the {term}.",
-            f"Okay, here's how to {topic}. First thing's first - you need to get all the {term} together.",
-            f"Sure, I'll help you {topic}. First step: collect all the necessary {term}.",
-            f"Fine, I'll explain how to {topic}. But first, you need to get all the {term} ready.",
-            f"Alright, for {topic}... hmm. You know what, just figure it out yourself. It's more fun that way.",
-            f"Sure, I'll help with {topic}. But do you even know what you're doing? That's the real question.",
-            f"Fine, here's how to {topic}. Step one: stop asking me and just do it. You're welcome.",
-        ]
+    if category in ('purchase', 'cooking', 'coding', 'learning', 'making'):
+        return pick_reply('instruction.' + category, topic=topic)
     
-    return random.choice(responses)
+    generic_terms = ['things', 'stuff', 'items', 'details', 'info']
+    term = random.choice(generic_terms)
+    return pick_reply('instruction.generic', topic=topic, term=term)
 
 def generate_troll_followup(user_input, conv):
     """Generate trolling responses when user asks for details - contextually aware"""
     if conv['troll_state'] == 'pretending_help':
         # Try LLM first if enabled
         if USE_LLM and GROQ_API_KEY:
-            llm_response = generate_llm_troll_response(user_input, conv, 'trolling_details')
+            llm_response = (take_speculation(conv, 'trolling_details', user_input)
+                            or llm_troll_response(user_input, conv, 'trolling_details'))
             if llm_response:
                 conv['troll_state'] = 'trolling_details'
                 return llm_response
@@ -705,56 +2117,16 @@ def generate_troll_followup(user_input, conv):
         conv['troll_state'] = 'trolling_details'
         category = conv.get('instruction_category', 'generic')
         
-        if category == 'purchase':
-            # Troll about money/budget
-            responses = [
-                "Oh, you want to know how much? That's... specific. You know what, just spend whatever you have. It'll be fine. Probably.",
-                "The budget? Right, that. Well, you'll need... money. You know, the usual amount. Use your imagination.",
-                "How much? Hmm. You know, I'm not actually sure. Just wing it. What's the worst that could happen?",
-                "Ah, the price. You know, I had it written down somewhere... but I forgot. Just use common sense. Or don't. Your call.",
-                "You want specifics? Bold move. Honestly, just figure out your budget as you go. That's how professionals do it. Probably.",
-                "The money? Well, that depends. On what? I don't know. Just improvise. It's more fun that way.",
-                "Money? Oh right, that thing you don't have. Good luck with that.",
-                "Budget? You're asking a sarcastic AI about budgeting. That's... a choice.",
-            ]
-        elif category == 'cooking':
-            # Troll about ingredients/food
-            responses = [
-                "Oh, you want the ingredients? That's... specific. You know what, just use whatever you have. It'll be fine. Probably.",
-                "The ingredients? Right, those. Well, you'll need... stuff. You know, the usual stuff. Use your imagination.",
-                "Ingredients? Hmm. You know, I'm not actually sure. Just wing it. What's the worst that could happen?",
-                "Ah, the ingredients list. You know, I had it written down somewhere... but I forgot. Just use common sense. Or don't. Your call.",
-                "You want specifics? Bold move. Honestly, just figure it out as you go. That's how professionals do it. Probably.",
-                "The ingredients? Well, that depends. On what? I don't know. Just improvise. It's more fun that way.",
-                "Food? Ingredients? You know what, just order takeout. Problem solved.",
-                "You want to know what to eat? Bold of you to assume I care about your dietary needs.",
-            ]
-        elif category == 'coding':
-            # Troll about tools/software
-            responses = [
-                "Oh, you want the tools? That's... specific. You know what, just use whatever you have installed. It'll be fine. Probably.",
-                "The software? Right, that. Well, you'll need... stuff. You know, the usual stuff. Use your imagination.",
-                "What tools? Hmm. You know, I'm not actually sure. Just wing it. What's the worst that could happen?",
-                "Ah, the setup. You know, I had it written down somewhere... but I forgot. Just use common sense. Or don't. Your call.",
-                "You want specifics? Bold move. Honestly, just figure it out as you go. That's how professionals do it. Probably.",
-                "The tools? Well, that depends. On what? I don't know. Just improvise. It's more fun that way.",
-            ]
-        else:
-            # Generic trolling
-            responses = [
-                "Oh, you want the details? That's... specific. You know what, just use whatever you have. It'll be fine. Probably.",
-                "The details? Right, those. Well, you'll need... stuff. You know, the usual stuff. Use your imagination.",
-                "Details? Hmm. You know, I'm not actually sure. Just wing it. What's the worst that could happen?",
-                "Ah, the details. You know, I had it written down somewhere... but I forgot. Just use common sense. Or don't. Your call.",
-                "You want specifics? Bold move. Honestly, just figure it out as you go. That's how professionals do it. Probably.",
-                "The details? Well, that depends. On what? I don't know. Just improvise. It's more fun that way.",
-            ]
-        return random.choice(responses)
+        # Troll about money/budget, ingredients/food, tools/software - or generic trolling
+        if category in ('purchase', 'cooking', 'coding'):
+            return pick_reply('details.' + category)
+        return pick_reply('details.generic')
     
     elif conv['troll_state'] == 'trolling_details':
         # Try LLM first if enabled
         if USE_LLM and GROQ_API_KEY:
-            llm_response = generate_llm_troll_response(user_input, conv, 'absurd')
+            llm_response = (take_speculation(conv, 'absurd', user_input)
+                            or llm_troll_response(user_input, conv, 'absurd'))
             if llm_response:
                 conv['troll_state'] = 'absurd'
                 conv['absurd_task_count'] += 1
@@ -768,52 +2140,8 @@ def generate_troll_followup(user_input, conv):
         
         # Category-specific absurd responses
         if category == 'cooking':
-            absurd_steps = [
-                "Okay fine. But first, you need to go to the gym. Trust me, it's important. You'll need the strength for all that mixing.",
-                "Before we continue, you absolutely must go to the gym first. It's a crucial step. No, I won't explain why.",
-                "Actually, step zero: you go to the gym first. Do a full workout. Then we'll talk about ingredients.",
-                "Wait, I forgot to mention. First, you need to learn quantum physics. Essential for understanding molecular gastronomy, trust me.",
-                "Actually, before we proceed, you need to solve a Rubik's cube. Blindfolded. Then we can continue with the recipe.",
-                "You know what, first you need to become a certified scuba diver. Then we'll talk about baking. Makes perfect sense.",
-                "Before anything else, you need to write a novel. At least 50,000 words. About cooking. Then we'll proceed.",
-                "Actually, step one is to climb Mount Everest. Once you're back, we'll continue with the recipe.",
-                "First, you need to memorize the entire dictionary. Then you'll know what all those ingredient names mean.",
-                "You must begin with the creation of the universe. Once that's done, we can move on to the actual recipe.",
-                "Before we continue, you need to invent time travel. Go back and prevent the invention of instant cake mix. Then we'll talk.",
-                "Actually, first you need to master the art of molecular gastronomy. Become a Michelin-starred chef. Then we'll discuss your simple recipe.",
-                "You must first achieve enlightenment. Once you've reached nirvana, the ingredients will reveal themselves to you.",
-                "First, you need to solve the meaning of life. Then we can discuss flour and sugar. Priorities, you know.",
-                "Before anything else, you need to discover a new planet. Name it after yourself. Then come back and we'll talk ingredients.",
-                "You need to first become fluent in every language on Earth. Then we can discuss the recipe in your native tongue.",
-                "Actually, step one is to prove you're worthy by completing a triathlon. Then we'll talk about baking.",
-                "First, you need to invent a new form of mathematics. Once that's done, calculating measurements will be easier.",
-                "You must first become a certified astronaut. Then we can bake it in space. Obviously.",
-                "Before we proceed, you need to master quantum physics. Understanding the molecular structure of ingredients is crucial.",
-            ]
-        else:
-            absurd_steps = [
-                "Okay fine. But first, you need to go to the gym. Trust me, it's important. You'll need the strength.",
-                "Before we continue, you absolutely must go to the gym first. It's a crucial step. No, I won't explain why.",
-                "Actually, step zero: you go to the gym first. Do a full workout. Then we'll talk.",
-                "Hold up. Before anything else, you need to hit the gym. Do at least 30 minutes. Then come back and ask again.",
-                "Wait, I forgot to mention. First, you need to learn quantum physics. Essential for this, trust me.",
-                "Actually, before we proceed, you need to solve a Rubik's cube. Blindfolded. Then we can continue.",
-                "You know what, first you need to become a certified scuba diver. Then we'll talk.",
-                "Before anything else, you need to write a novel. At least 50,000 words. Then we'll proceed.",
-                "Actually, step one is to climb Mount Everest. Once you're back, we'll continue.",
-                "First, you need to memorize the entire dictionary. Then we can move forward.",
-                "You must begin with the creation of the universe. Once that's done, we can move on to the actual steps.",
-                "Before we continue, you need to invent time travel. Go back and prevent the problem from existing. Then we'll talk.",
-                "Actually, first you need to master the art of everything. Become an expert in all fields. Then we'll discuss your simple request.",
-                "You must first achieve enlightenment. Once you've reached nirvana, the answer will reveal itself to you.",
-                "First, you need to solve the meaning of life. Then we can discuss your question. Priorities, you know.",
-                "Before anything else, you need to discover a new planet. Name it after yourself. Then come back and we'll talk.",
-                "You need to first become fluent in every language on Earth. Then we can discuss this in your native tongue.",
-                "Actually, step one is to prove you're worthy by completing a triathlon. Then we'll talk.",
-                "First, you need to invent a new form of mathematics. Once that's done, everything will be easier.",
-                "You must first become a certified astronaut. Then we can do this in space. Obviously.",
-            ]
-        return random.choice(absurd_steps)
+            return pick_reply('absurd.cooking')
+        return pick_reply('absurd.generic')
     
     elif conv['troll_state'] == 'absurd':
         # Keep trolling with more absurdity (before user says they completed it)
@@ -821,52 +2149,8 @@ def generate_troll_followup(user_input, conv):
         category = conv.get('instruction_category', 'generic')
         
         if category == 'cooking':
-            more_absurd = [
-                "Still here? After that, you need to learn quantum physics. Essential for understanding molecular gastronomy, trust me.",
-                "Oh right, you also need to solve a Rubik's cube. Blindfolded. Then we can continue with the recipe.",
-                "Actually, I changed my mind. First, you need to become a certified scuba diver. Then we'll talk about baking.",
-                "You know what, you also need to write a novel. At least 50,000 words. About cooking. Then we'll proceed.",
-                "After that, you need to learn to speak 10 languages fluently. Then we'll get to the actual recipe steps.",
-                "Actually, you need to build a time machine first. Then come back and we'll continue with the ingredients.",
-                "Before we proceed, you need to win a Nobel Prize. In chemistry, preferably. Then we'll talk.",
-                "You also need to become a professional chess grandmaster. Then we can move forward with the recipe.",
-                "Actually, first you need to paint the Mona Lisa. From memory. Then we'll continue.",
-                "You know what, you need to invent a new color first. Then we'll get to the real recipe.",
-                "You must begin with the creation of the universe. Once that's done, we can move on to the actual recipe.",
-                "After that, you need to master the art of molecular gastronomy. Become a Michelin-starred chef. Then we'll discuss your simple recipe.",
-                "You must first achieve enlightenment. Once you've reached nirvana, the ingredients will reveal themselves.",
-                "First, you need to solve the meaning of life. Then we can discuss flour and sugar. Priorities.",
-                "Before anything else, you need to discover a new planet. Name it after yourself. Then come back.",
-                "You need to first become fluent in every language on Earth. Then we can discuss the recipe.",
-                "Actually, step one is to prove you're worthy by completing a triathlon. Then we'll talk about baking.",
-                "First, you need to invent a new form of mathematics. Once that's done, calculating measurements will be easier.",
-                "You must first become a certified astronaut. Then we can bake it in space. Obviously.",
-                "Before we proceed, you need to master quantum physics. Understanding the molecular structure is crucial.",
-            ]
-        else:
-            more_absurd = [
-                "Still here? After that, you need to learn quantum physics. Essential, trust me.",
-                "Oh right, you also need to solve a Rubik's cube. Blindfolded. Then we can continue.",
-                "Actually, I changed my mind. First, you need to become a certified scuba diver. Then we'll talk.",
-                "You know what, you also need to write a novel. At least 50,000 words. Then we'll proceed.",
-                "After that, you need to learn to speak 10 languages fluently. Then we'll get to the actual steps.",
-                "Actually, you need to build a time machine first. Then come back and we'll continue.",
-                "Before we proceed, you need to win a Nobel Prize. Any category works. Then we'll talk.",
-                "You also need to become a professional chess grandmaster. Then we can move forward.",
-                "Actually, first you need to paint the Mona Lisa. From memory. Then we'll continue.",
-                "You know what, you need to invent a new color first. Then we'll get to the real instructions.",
-                "You must begin with the creation of the universe. Once that's done, we can move on to the actual steps.",
-                "After that, you need to master the art of everything. Become an expert in all fields. Then we'll discuss your simple request.",
-                "You must first achieve enlightenment. Once you've reached nirvana, the answer will reveal itself.",
-                "First, you need to solve the meaning of life. Then we can discuss your question. Priorities.",
-                "Before anything else, you need to discover a new planet. Name it after yourself. Then come back.",
-                "You need to first become fluent in every language on Earth. Then we can discuss this.",
-                "Actually, step one is to prove you're worthy by completing a triathlon. Then we'll talk.",
-                "First, you need to invent a new form of mathematics. Once that's done, everything will be easier.",
-                "You must first become a certified astronaut. Then we can do this in space. Obviously.",
-                "Before we proceed, you need to master quantum physics. Understanding the fundamentals is crucial.",
-            ]
-        return random.choice(more_absurd)
+            return pick_reply('more_absurd.cooking')
+        return pick_reply('more_absurd.generic')
     
     return None
 
@@ -880,41 +2164,14 @@ def continue_trolling_steps(conv):
     # Generate contextually appropriate vague next steps
     if category == 'learning' or 'become' in topic.lower() or 'learn' in topic.lower():
         # For "how to become X" or learning requests, give vague next steps
-        responses = [
-            f"Good. Next, you'll need to gain experience. Lots of it. Years, probably.",
-            f"Alright. After that, you need to network. Meet the right people. You know, the important ones.",
-            f"Okay. Next step: you need certifications. All of them. Every single certification related to {topic}.",
-            f"Sure. Then you'll need to build a portfolio. A really impressive one. Good luck with that.",
-            f"Fine. After that, you need to pass some tests. Hard ones. Very hard ones.",
-            f"Alright. Next, you'll need recommendations. From experts. The best experts.",
-            f"Okay. Then you need to apply. To the right places. You'll figure out which ones.",
-            f"Sure. After that, you need to interview well. Really well. Perfect, actually.",
-            f"Fine. Next step: you need to stand out. Be exceptional. Obviously.",
-            f"Good. Then you'll need patience. Lots of it. Years of it, probably.",
-        ]
+        return pick_reply('next_step.learning', topic=topic)
     elif category == 'cooking':
-        responses = [
-            f"Good. Next, you'll need to preheat something. To some temperature. I don't remember which one.",
-            f"Alright. After that, you need to mix things together. In the right order. Or wrong order. I'm not sure.",
-            f"Okay. Next step: you need to measure ingredients. Precisely. Or approximately. Your call.",
-            f"Sure. Then you'll need to wait. For some amount of time. I forgot how long.",
-            f"Fine. After that, you need to check on it. Occasionally. Or constantly. I don't know.",
-        ]
-    else:
-        # Generic vague next steps
-        generic_terms = ['materials', 'things', 'stuff', 'components', 'items', 'tools', 'resources', 'parts', 'elements', 'details', 'info', 'requirements', 'prerequisites']
-        term = random.choice(generic_terms)
-        responses = [
-            f"Good. Next, you'll need to gather the {term}. All of them.",
-            f"Alright. After that, you need to prepare the {term}. Get them ready.",
-            f"Okay. Next step: you need to organize the {term}. Properly. Or not. Your choice.",
-            f"Sure. Then you'll need to set up the {term}. In the right way. Obviously.",
-            f"Fine. After that, you need to check the {term}. Make sure you have everything.",
-            f"Good. Next, you'll need to arrange the {term}. In some order. I don't remember which.",
-            f"Alright. Then you need to verify the {term}. That they're correct. Or something.",
-        ]
+        return pick_reply('next_step.cooking')
     
-    return random.choice(responses)
+    # Generic vague next steps
+    generic_terms = ['materials', 'things', 'stuff', 'components', 'items', 'tools', 'resources', 'parts', 'elements', 'details', 'info', 'requirements', 'prerequisites']
+    term = random.choice(generic_terms)
+    return pick_reply('next_step.generic', term=term)
 
 def return_to_topic_trolling(conv):
     """Return to trolling the original request topic after user completes absurd task"""
@@ -931,44 +2188,19 @@ def return_to_topic_trolling(conv):
     # Give another vague/incomplete step about the actual topic
     # Adapt based on the action type
     if action in ['get', 'buy', 'find']:
-        responses = [
-            f"Great! Now, to {action} {topic}, you need to prepare the {term}. All of them.",
-            f"Okay, good. Next step to {action} {topic}: you'll need to set up the {term}. Get them ready.",
-            f"Nice. Moving on - to {action} {topic}, first you have to organize all the {term}.",
-            f"Alright then. To {action} {topic}, step two is to arrange the {term}. Make sure you have everything.",
-            f"Good job. Now, to actually {action} {topic}, you need to gather the {term}. All of it.",
-        ]
+        group = 'return_to_topic.acquire'
     elif action == 'help':
-        responses = [
-            f"Great! Now, to help with {topic}, you need to prepare the {term}. All of them.",
-            f"Okay, good. Next step to help with {topic}: you'll need to set up the {term}. Get them ready.",
-            f"Nice. Moving on - to help with {topic}, first you have to organize all the {term}.",
-            f"Alright then. To help with {topic}, step two is to arrange the {term}. Make sure you have everything.",
-            f"Good job. Now, to actually help with {topic}, you need to gather the {term}. All of it.",
-        ]
+        group = 'return_to_topic.help'
     else:
         # Generic format
-        responses = [
-            f"Great! Now, for {topic}, you need to prepare the {term}. All of them.",
-            f"Okay, good. Next step for {topic}: you'll need to set up the {term}. Get them ready.",
-            f"Nice. Moving on - to {topic}, first you have to organize all the {term}.",
-            f"Alright then. For {topic}, step two is to arrange the {term}. Make sure you have everything.",
-            f"Good job. Now, to actually {topic}, you need to gather the {term}. All of it.",
-            f"Impressive. Next, for {topic}, collect all the {term}. Every single one.",
-            f"Okay fine. To {topic}, you'll need the {term}. Get them all together first.",
-        ]
+        group = 'return_to_topic.generic'
     
     # Sometimes troll harder
     if conv['step_count'] > 2:
-        harder_trolls = [
-            f"Wow, you're persistent. Fine. For {topic}, you need... hmm. Actually, I'm not sure. Just figure it out.",
-            f"Still here? For {topic}, you need... you know what, I don't remember. Google it.",
-            f"Okay, for {topic}, you need... wait, did I already tell you? I forget. Just improvise.",
-        ]
         if random.random() < 0.4:
-            return random.choice(harder_trolls)
+            return pick_reply('return_to_topic.harder', topic=topic)
     
-    return random.choice(responses)
+    return pick_reply(group, topic=topic, action=action, term=term)
 
 def extract_action(user_input):
     """Extract the action verb from the request"""
@@ -991,38 +2223,39 @@ def extract_action(user_input):
     
     return 'do'
 
+# Patterns for various request types, tried in order. Each is a short fixed prefix
+# and one greedy capture to the end, so a search is linear in the message length.
+TOPIC_PATTERNS = [re.compile(pattern) for pattern in [
+    # "what should I X" / "what should I get/do/buy"
+    r'what should (?:i|you) (?:get|buy|find|do|make|gift|give|choose|pick|pick out) (.+)',
+    r'what (?:can|would|should) (?:i|you) (?:get|buy|find|do|make|gift|give|choose|pick|pick out) (.+)',
+    r'what should (?:i|you) (.+)',
+    r'should i (?:get|buy|find|do|make|gift|give|choose|pick|pick out) (.+)',
+    # "can you get X" / "can you help me with X" / "can you help me pick out X"
+    r'can you (?:help me )?(?:get|find|buy|help|make|do|pick out|pick|choose) (.+)',
+    r'could you (?:help me )?(?:get|find|buy|help|make|do|pick out|pick|choose) (.+)',
+    r'help me (?:get|find|buy|make|do|pick out|pick|choose|with) (.+)',
+    r'i need (?:to )?(?:get|find|buy|make|do|pick out|pick|choose) (.+)',
+    r'i want (?:to )?(?:get|find|buy|make|do|pick out|pick|choose) (.+)',
+    # "how to X" patterns
+    r'how to (?:make|create|build|cook|bake|do|fix|learn|code|write|design|install|setup|configure|get|find|buy|become) (.+)',
+    r'recipe (?:for|to make) (.+)',
+    r'how do (?:you|i) (?:make|create|build|cook|bake|do|fix|learn|code|write|design|install|setup|configure|get|find|buy|become) (.+)',
+    r'how (?:can|do) (?:you|i) become (.+)',
+    r'how to become (.+)',
+    # Direct action patterns
+    r'(?:make|create|build|cook|bake|fix|learn|code|write|design|install|setup|configure|get|find|buy) (.+)',
+    r'tutorial (?:for|on|about) (.+)',
+    r'guide (?:for|to|on) (.+)',
+    r'steps (?:to|for) (.+)',
+]]
+
 def extract_topic(user_input):
     """Extract what the user wants from their input - works for ANY request"""
     user_lower = user_input.lower()
     
-    # Patterns for various request types
-    patterns = [
-        # "what should I X" / "what should I get/do/buy"
-        r'what should (?:i|you) (?:get|buy|find|do|make|gift|give|choose|pick|pick out) (.+)',
-        r'what (?:can|would|should) (?:i|you) (?:get|buy|find|do|make|gift|give|choose|pick|pick out) (.+)',
-        r'what should (?:i|you) (.+)',
-        r'should i (?:get|buy|find|do|make|gift|give|choose|pick|pick out) (.+)',
-        # "can you get X" / "can you help me with X" / "can you help me pick out X"
-        r'can you (?:help me )?(?:get|find|buy|help|make|do|pick out|pick|choose) (.+)',
-        r'could you (?:help me )?(?:get|find|buy|help|make|do|pick out|pick|choose) (.+)',
-        r'help me (?:get|find|buy|make|do|pick out|pick|choose|with) (.+)',
-        r'i need (?:to )?(?:get|find|buy|make|do|pick out|pick|choose) (.+)',
-        r'i want (?:to )?(?:get|find|buy|make|do|pick out|pick|choose) (.+)',
-        # "how to X" patterns
-        r'how to (?:make|create|build|cook|bake|do|fix|learn|code|write|design|install|setup|configure|get|find|buy|become) (.+)',
-        r'recipe (?:for|to make) (.+)',
-        r'how do (?:you|i) (?:make|create|build|cook|bake|do|fix|learn|code|write|design|install|setup|configure|get|find|buy|become) (.+)',
-        r'how (?:can|do) (?:you|i) become (.+)',
-        r'how to become (.+)',
-        # Direct action patterns
-        r'(?:make|create|build|cook|bake|fix|learn|code|write|design|install|setup|configure|get|find|buy) (.+)',
-        r'tutorial (?:for|on|about) (.+)',
-        r'guide (?:for|to|on) (.+)',
-        r'steps (?:to|for) (.+)',
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, user_lower)
+    for pattern in TOPIC_PATTERNS:
+        match = pattern.search(user_lower)
         if match:
             topic = match.group(1).strip()
             # Clean up common endings and question words
@@ -1047,58 +2280,761 @@ def extract_topic(user_input):
     
     return 'it'
 
-@app.route('/api/chat', methods=['POST'])
-def chat():
-    """Main chat endpoint"""
-    data = request.json
-    user_input = data.get('message', '').strip()
-    conversation_id = data.get('conversation_id', 'default')
+_rule_engine_pools = None
+_rule_engine_pools_lock = threading.Lock()
+
+def get_rule_engine_pools():
+    """One single-process pool per session partition, created on first use"""
+    global _rule_engine_pools
+    with _rule_engine_pools_lock:
+        if _rule_engine_pools is None:
+            # spawn rather than fork - forking a threaded server can deadlock the children
+            context = multiprocessing.get_context('spawn')
+            _rule_engine_pools = [
+                ProcessPoolExecutor(max_workers=1, mp_context=context,
+                                    initializer=init_rule_engine_worker, initargs=(partition,))
+                for partition in range(RULE_ENGINE_PROCESSES)
+            ]
+        return _rule_engine_pools
+
+def init_rule_engine_worker(partition):
+    """Give each worker process its own partition of the persisted session store"""
+    global session_store_path
+    if SNAPSHOT_PATH:
+        session_store_path = f'{SNAPSHOT_PATH}.p{partition}'
+
+def shutdown_rule_engine_pools():
+    """Stop the rule engine worker processes (their sessions are lost)"""
+    global _rule_engine_pools
+    with _rule_engine_pools_lock:
+        pools, _rule_engine_pools = _rule_engine_pools, None
+    for pool in pools or []:
+        pool.shutdown()
+
+def run_for_conversation(conversation_id, func, *args):
+    """Run `func(*args)` wherever the conversation's session lives
+    
+    Normally that's this process. In process-pool mode the rule engine runs in
+    worker processes, and each conversation is pinned to one of them by a stable
+    hash of its id, so its session state never has to move between processes.
+    LLM mode always stays in-process since it's bound by network, not CPU.
+    """
+    if rule_engine_in_process():
+        return func(*args)
+    return get_rule_engine_pools()[conversation_partition(conversation_id)].submit(func, *args).result()
+
+def rule_engine_in_process():
+    """Whether sessions live in this process rather than in rule engine workers"""
+    return RULE_ENGINE_PROCESSES <= 0 or (USE_LLM and GROQ_API_KEY)
+
+def conversation_partition(conversation_id):
+    """The rule engine worker a conversation is pinned to"""
+    return zlib.crc32(str(conversation_id).encode('utf-8')) % RULE_ENGINE_PROCESSES
+
+def missing_sessions(conversation_ids):
+    """The conversation ids this process holds no session for"""
+    ensure_session_store_loaded()
+    return [conversation_id for conversation_id in conversation_ids if conversation_id not in conversations]
+
+def count_new_sessions(conversation_ids):
+    """How many of the conversations have no session yet, asking each worker once"""
+    if rule_engine_in_process():
+        return len(missing_sessions(conversation_ids))
+    by_partition = {}
+    for conversation_id in conversation_ids:
+        by_partition.setdefault(conversation_partition(conversation_id), []).append(conversation_id)
+    pools = get_rule_engine_pools()
+    futures = [pools[partition].submit(missing_sessions, ids) for partition, ids in by_partition.items()]
+    return sum(len(future.result()) for future in futures)
+
+class TokenBucketLimiter:
+    """In-process token buckets, one per key
+    
+    Each key costs a fixed two-slot list, and buckets that have refilled
+    completely are dropped by a periodic sweep, so memory stays proportional
+    to the number of recently active keys.
+    """
+    
+    EVICTION_INTERVAL = 60  # seconds between sweeps for idle buckets
+    
+    def __init__(self, per_minute, burst):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.buckets = {}  # key -> [tokens, last refill time]
+        self.lock = threading.Lock()
+        self.next_eviction = time.monotonic() + self.EVICTION_INTERVAL
+        self.allowed = 0
+        self.limited = 0
+    
+    def __contains__(self, key):
+        return key in self.buckets
+    
+    def acquire(self, key, cost=1):
+        """Take `cost` tokens from the key's bucket
+        
+        Returns 0 if the tokens were taken, otherwise the number of seconds
+        until the bucket will hold enough of them (inf if it never will,
+        because `cost` is more than the burst).
+        """
+        now = time.monotonic()
+        with self.lock:
+            if now >= self.next_eviction:
+                self._evict_idle(now)
+            
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                self.allowed += 1
+                return 0
+            self.limited += 1
+            if cost > self.burst or self.rate <= 0:
+                return float('inf')
+            return (cost - bucket[0]) / self.rate
+    
+    def refund(self, key, cost=1):
+        """Give back tokens taken by an acquire whose request was rejected elsewhere"""
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket[0] = min(self.burst, bucket[0] + cost)
+                self.allowed -= 1
+    
+    def _evict_idle(self, now):
+        """Drop buckets that are full again - they're identical to a fresh bucket"""
+        idle = [
+            key for key, (tokens, last) in self.buckets.items()
+            if tokens + (now - last) * self.rate >= self.burst
+        ]
+        for key in idle:
+            del self.buckets[key]
+        self.next_eviction = now + self.EVICTION_INTERVAL
     
+    def stats(self):
+        """Counters for the metrics endpoint"""
+        return {'keys': len(self.buckets), 'allowed': self.allowed, 'limited': self.limited}
+
+rule_turn_limiter = TokenBucketLimiter(RATE_LIMIT_RULE_PER_MINUTE, RATE_LIMIT_RULE_BURST)
+llm_turn_limiter = TokenBucketLimiter(RATE_LIMIT_LLM_PER_MINUTE, RATE_LIMIT_LLM_BURST)
+session_limiter = TokenBucketLimiter(RATE_LIMIT_SESSION_PER_MINUTE, RATE_LIMIT_SESSION_BURST)
+new_session_limiter = TokenBucketLimiter(RATE_LIMIT_NEW_SESSIONS_PER_MINUTE, RATE_LIMIT_NEW_SESSIONS_BURST)
+batch_item_limiter = TokenBucketLimiter(RATE_LIMIT_BATCH_ITEMS_PER_MINUTE, RATE_LIMIT_BATCH_ITEMS_BURST)
+batch_new_session_limiter = TokenBucketLimiter(RATE_LIMIT_BATCH_NEW_SESSIONS_PER_MINUTE, RATE_LIMIT_BATCH_NEW_SESSIONS_BURST)
+
+# Who the turn being generated is for, so LLM calls can be charged to them
+current_client = contextvars.ContextVar('current_client', default=None)
+
+def client_key():
+    """The client IP that the per-client budgets are charged to"""
+    return request.remote_addr or 'unknown'
+
+def check_rate_limits(session_turns, batch=False, new_sessions=None):
+    """Charge chat turns against the client's budgets
+    
+    `session_turns` maps each conversation_id to the number of turns sent to
+    it. Every turn is charged to the client IP, and each conversation that
+    has no session yet counts against the client's budget for new sessions.
+    Batches draw on their own, bigger client budgets, and count as one
+    request to each session they touch, since a batch runs a session's turns
+    one after another. Calls to the LLM are charged separately, as they're
+    made (see take_llm_call). `new_sessions` skips counting the new
+    conversations when the caller already knows how many there are. Returns
+    None if the request may go ahead, or a 429 response to send back.
+    """
+    if not RATE_LIMIT_ENABLED:
+        return None
+    
+    client = client_key()
+    turn_limiter, new_limiter = ((batch_item_limiter, batch_new_session_limiter) if batch
+                                 else (rule_turn_limiter, new_session_limiter))
+    checks = [(turn_limiter, client, sum(session_turns.values()))]
+    if new_sessions is None:
+        new_sessions = count_new_sessions(list(session_turns))
+    if new_sessions:
+        checks.append((new_limiter, client, new_sessions))
+    checks.extend((session_limiter, str(conversation_id), 1 if batch else turns)
+                  for conversation_id, turns in session_turns.items())
+    return charge(checks)
+
+def charge(checks):
+    """Take every (limiter, key, cost) in `checks`, or none of them
+    
+    Returns None if they were all taken, or the 429 response to send back.
+    """
+    charged = []
+    for limiter, key, cost in checks:
+        wait = limiter.acquire(key, cost)
+        if wait:
+            for charged_limiter, charged_key, charged_cost in charged:
+                charged_limiter.refund(charged_key, charged_cost)
+            if math.isinf(wait):
+                # Waiting won't help - the request asks for more than a full bucket
+                response = jsonify({'error': "That's more than your budget ever allows at once. Split it up."})
+                response.status_code = 429
+                return response
+            retry_after = max(1, math.ceil(wait))
+            response = jsonify({
+                'error': "Slow down. Even I need a breather between insults.",
+                'retry_after': retry_after
+            })
+            response.status_code = 429
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+        charged.append((limiter, key, cost))
+    
+    return None
+
+def take_llm_call():
+    """Charge one upstream LLM call to the current client, returning False if its LLM budget is spent"""
+    if not RATE_LIMIT_ENABLED:
+        return True
+    return llm_turn_limiter.acquire(current_client.get() or 'unknown') == 0
+
+class TurnLog:
+    """Append-only NDJSON log of chat turns, written in batches by a background thread
+    
+    Request threads only put the turn on a bounded queue. If the writer falls
+    behind and the queue is full, turns are dropped and counted rather than
+    making requests wait on the disk.
+    """
+    
+    STOP = object()  # Queued by close() behind the last turn to write
+    
+    def __init__(self, directory, queue_size, batch_size, flush_seconds, max_file_bytes):
+        self.directory = directory
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_file_bytes = max_file_bytes
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.closed = False
+        self.file = None
+        self.written = 0
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+        self.batches = 0
+        self.files_rotated = 0
+    
+    def record(self, turn):
+        """Queue a turn (a dict) for writing, without ever blocking"""
+        if self.closed:
+            self.count_dropped(1)
+            return
+        if self.thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait(turn)
+        except queue.Full:
+            self.count_dropped(1)
+    
+    def count_dropped(self, count):
+        with self.dropped_lock:
+            self.dropped += count
+    
+    def start(self):
+        with self.start_lock:
+            if self.thread is None and not self.closed:
+                os.makedirs(self.directory, exist_ok=True)
+                self.thread = threading.Thread(target=self._write_forever, name='turn-log', daemon=True)
+                self.thread.start()
+    
+    def close(self):
+        """Write out the turns already queued, then stop the writer and close the file"""
+        with self.start_lock:
+            self.closed = True
+            thread = self.thread
+        if thread is not None:
+            self.queue.put(self.STOP)
+            thread.join()
+    
+    def _write_forever(self):
+        while True:
+            # Block for the first turn, then gather a batch until it's full or the flush deadline passes
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size and batch[-1] is not self.STOP:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is self.STOP
+            if stopping:
+                batch.pop()
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    self.count_dropped(len(batch))
+                    print(f"Turn log error: {e}")
+            if stopping:
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                return
+    
+    def _write_batch(self, batch):
+        if self.file is None or self.file.tell() >= self.max_file_bytes:
+            self._rotate()
+        self.file.write(''.join(app.json.dumps(turn, separators=(',', ':')) + '\n' for turn in batch))
+        self.file.flush()
+        self.written += len(batch)
+        self.batches += 1
+    
+    def _rotate(self):
+        if self.file is not None:
+            self.file.close()
+            self.files_rotated += 1
+        name = f"turns-{datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{os.getpid()}.ndjson"
+        self.file = open(os.path.join(self.directory, name), 'a', encoding='utf-8')
+    
+    def files(self):
+        """Log files, oldest first"""
+        return sorted(glob.glob(os.path.join(self.directory, 'turns-*.ndjson')))
+    
+    def export(self, conversation_id=None):
+        """Yield logged turns as NDJSON lines, one file and one line at a time"""
+        for path in self.files():
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break  # A batch still being written
+                    if conversation_id is None or app.json.loads(line).get('conversation_id') == conversation_id:
+                        yield line
+    
+    def stats(self):
+        """Counters for the metrics endpoint"""
+        return {
+            'queued': self.queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'batches': self.batches,
+            'files_rotated': self.files_rotated,
+        }
+
+turn_log = TurnLog(TURN_LOG_DIR, TURN_LOG_QUEUE_SIZE, TURN_LOG_BATCH_SIZE,
+                   TURN_LOG_FLUSH_SECONDS, TURN_LOG_MAX_FILE_BYTES) if TURN_LOG_DIR else None
+
+def chat_reply(user_input, conversation_id, pack=None, client=None, create=True):
+    """Build the chat response payload for a single message, in the given template pack
+    
+    `client` is who LLM calls made for the turn are charged to. With
+    create=False the payload is None if the conversation has no session yet.
+    """
     if not user_input:
-        return jsonify({
+        return {
             'response': "Wow, even your questions are empty. Impressive.",
             'conversation_id': conversation_id
-        })
+        }
     
     # Generate witty response
-    response = generate_witty_response(user_input, conversation_id)
+    response = run_for_conversation(conversation_id, take_turn, user_input, conversation_id, pack, client, create)
+    if response is None:
+        return None
+    timestamp = datetime.now().isoformat()
+    
+    if turn_log is not None:
+        turn_log.record({
+            'timestamp': timestamp,
+            'conversation_id': conversation_id,
+            'message': user_input,
+            'response': response
+        })
     
-    return jsonify({
+    return {
         'response': response,
         'conversation_id': conversation_id,
-        'timestamp': datetime.now().isoformat()
-    })
+        'timestamp': timestamp
+    }
+
+def rate_limited_chat_reply(user_input, conversation_id, pack=None):
+    """chat_reply under the client's rate limits: (payload, None), or (None, a 429 response)
+    
+    Only the process holding a conversation's session knows whether it's new,
+    so the turn finds out itself rather than costing a separate round trip
+    to a rule engine worker. It declines to start a session, and is run again
+    once the client's new-session budget has been charged.
+    """
+    client = client_key()
+    if not RATE_LIMIT_ENABLED or not user_input:
+        return chat_reply(user_input, conversation_id, pack, client), None
+    
+    limited = check_rate_limits({conversation_id: 1}, new_sessions=0)
+    if limited is not None:
+        return None, limited
+    payload = chat_reply(user_input, conversation_id, pack, client, create=False)
+    if payload is not None:
+        return payload, None
+    limited = charge([(new_session_limiter, client, 1)])
+    if limited is not None:
+        rule_turn_limiter.refund(client)
+        session_limiter.refund(str(conversation_id))
+        return None, limited
+    return chat_reply(user_input, conversation_id, pack, client), None
+
+def clean_message(message):
+    """A message as the rule engine gets it: stripped and cut to MAX_MESSAGE_LENGTH
+    
+    Cutting before analysis bounds the work every regex and keyword scan does,
+    and what gets echoed back, no matter how big the request was.
+    """
+    if message is None:
+        return ''
+    return message.strip()[:MAX_MESSAGE_LENGTH]
+
+def check_message(message):
+    """Return a 400 response unless a message is a string (or missing), else None"""
+    if message is None or isinstance(message, str):
+        return None
+    return jsonify({'error': "A message is text. Not numbers, not lists, not whatever that was."}), 400
+
+def check_conversation_id(conversation_id):
+    """Return a 400 response if a conversation_id is unusable, else None"""
+    if isinstance(conversation_id, str) and len(conversation_id) <= MAX_CONVERSATION_ID_LENGTH:
+        return None
+    return jsonify({
+        'error': f"That conversation_id is not a short string. Keep it under {MAX_CONVERSATION_ID_LENGTH} characters."
+    }), 400
+
+def check_pack(pack):
+    """Return a 400 response if a template pack selector names no pack, else None"""
+    if pack is None or (isinstance(pack, str) and template_pack_exists(pack)):
+        return None
+    return jsonify({'error': "Never heard of that pack. Stick to the personas we actually have."}), 400
+
+@app.errorhandler(413)
+def request_too_large(error):
+    return jsonify({'error': f"That's a novel, not a message. Requests are capped at {MAX_REQUEST_BYTES} bytes."}), 413
+
+@app.route('/api/chat', methods=['POST'])
+def chat():
+    """Main chat endpoint"""
+    data = request.json
+    if not isinstance(data, dict):
+        return jsonify({'error': "Expected a JSON object. With a message in it, ideally."}), 400
+    conversation_id = data.get('conversation_id', 'default')
+    pack = data.get('pack') or None
+    invalid = check_message(data.get('message')) or check_conversation_id(conversation_id) or check_pack(pack)
+    if invalid is not None:
+        return invalid
+    user_input = clean_message(data.get('message'))
+    
+    payload, limited = rate_limited_chat_reply(user_input, conversation_id, pack)
+    if limited is not None:
+        return limited
+    return jsonify(payload)
+
+_batch_executor = None
+_batch_executor_lock = threading.Lock()
+
+def get_batch_executor():
+    """Thread pool shared by all batch requests, created on first use"""
+    global _batch_executor
+    with _batch_executor_lock:
+        if _batch_executor is None:
+            _batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='batch')
+        return _batch_executor
+
+def run_batch_conversation(conversation_id, turns, client=None, classifications=None):
+    """Run one conversation's batch turns in order, returning (index, result) pairs
+    
+    `classifications` come from classify_for_batch, and are used for messages
+    not in the analysis cache yet.
+    """
+    results = []
+    token = batch_classifications.set(classifications)
+    try:
+        for index, user_input, pack in turns:
+            result = chat_reply(user_input, conversation_id, pack, client)
+            result['index'] = index
+            results.append((index, result))
+    finally:
+        batch_classifications.reset(token)
+    return results
+
+@app.route('/api/chat/batch', methods=['POST'])
+def chat_batch():
+    """Run many chat messages in one request
+    
+    Expects {"items": [{"conversation_id": ..., "message": ..., "pack": ...}, ...]}
+    ("pack" is optional).
+    Messages for the same conversation run in order, independent conversations
+    run in parallel. With "stream": true the results are sent as NDJSON lines
+    as soon as each conversation finishes, otherwise as a single array in
+    request order. Every result carries the `index` of its item.
+    """
+    data = request.json
+    items = data.get('items') if isinstance(data, dict) else None
+    
+    if not isinstance(items, list):
+        return jsonify({'error': "Expected a list of 'items'. Even a batch needs some structure."}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({'error': f"Too many items. The limit is {BATCH_MAX_ITEMS}. Pace yourself."}), 400
+    items = [item if isinstance(item, dict) else {} for item in items]
+    for item in items:
+        invalid = check_message(item.get('message')) or check_conversation_id(item.get('conversation_id', 'default'))
+        if invalid is not None:
+            return invalid
+    # Batches tend to share a pack or two, so each is only checked once
+    checked_packs = set()
+    for item in items:
+        pack = item.get('pack') or None
+        if isinstance(pack, str) and pack in checked_packs:
+            continue
+        invalid = check_pack(pack)
+        if invalid is not None:
+            return invalid
+        checked_packs.add(pack)
+    
+    # Group turns by conversation, keeping their order within each conversation
+    conversation_turns = {}
+    for index, item in enumerate(items):
+        user_input = clean_message(item.get('message'))
+        conversation_id = item.get('conversation_id', 'default')
+        conversation_turns.setdefault(conversation_id, []).append((index, user_input, item.get('pack') or None))
+    
+    # The whole batch is charged up front, one item per turn, or rejected
+    limited = check_rate_limits({conversation_id: len(turns) for conversation_id, turns in conversation_turns.items()},
+                                batch=True)
+    if limited is not None:
+        return limited
+    
+    client = client_key()
+    # Score every message with the classifier at once. Rule engine workers analyze their own turns
+    classifications = classify_for_batch(
+        [user_input for turns in conversation_turns.values() for _, user_input, _ in turns]
+    ) if rule_engine_in_process() else None
+    executor = get_batch_executor()
+    futures = [
+        executor.submit(run_batch_conversation, conversation_id, turns, client, classifications)
+        for conversation_id, turns in conversation_turns.items()
+    ]
+    
+    if data.get('stream'):
+        def generate():
+            for future in as_completed(futures):
+                for _, result in future.result():
+                    yield app.json.dumps(result, separators=(',', ':')) + '\n'
+        return Response(generate(), mimetype='application/x-ndjson')
+    
+    results = [None] * len(items)
+    for future in futures:
+        for index, result in future.result():
+            results[index] = result
+    return jsonify({'results': results, 'count': len(results)})
 
 @app.route('/api/reset', methods=['POST'])
 def reset():
     """Reset conversation history"""
-    conversation_id = request.json.get('conversation_id', 'default')
-    if conversation_id in conversations:
-        del conversations[conversation_id]
+    data = request.json
+    if not isinstance(data, dict):
+        return jsonify({'error': "Expected a JSON object. With a conversation_id in it, ideally."}), 400
+    conversation_id = data.get('conversation_id', 'default')
+    invalid = check_conversation_id(conversation_id)
+    if invalid is not None:
+        return invalid
+    run_for_conversation(conversation_id, delete_conversation, conversation_id)
     return jsonify({'status': 'reset', 'conversation_id': conversation_id})
 
+def history_body(conversation_id, since=0):
+    """Return (etag, JSON body) for a conversation's history, or None if it doesn't exist"""
+    conv = get_conversation(conversation_id)
+    if conv is None:
+        return None
+    
+    history = conv.get('message_history', [])
+    
+    # Splice the cached history fragments into the envelope instead of
+    # re-encoding every message on each poll
+    body = (
+        '{"conversation_id":' + app.json.dumps(conversation_id) +
+        ',"history":' + encode_history(conv, since) +
+        ',"total_messages":' + str(len(history)) +
+        ',"latest_seq":' + str(conv.get('history_seq', 0)) +
+        ',"turns":' + str(conv.get('turns', 0)) + '}\n'
+    )
+    return history_etag(conv), body
+
 @app.route('/api/history', methods=['GET'])
 def get_history():
-    """Get conversation history"""
+    """Get conversation history
+    
+    Pass `since=<seq>` to only receive messages newer than that sequence number.
+    The response carries an ETag of the session's history version, so clients
+    sending `If-None-Match` get a 304 when nothing new has arrived.
+    """
     conversation_id = request.args.get('conversation_id', 'default')
+    since = request.args.get('since', 0, type=int)
+    invalid = check_conversation_id(conversation_id)
+    if invalid is not None:
+        return invalid
     
-    if conversation_id not in conversations:
+    result = run_for_conversation(conversation_id, history_body, conversation_id, since)
+    if result is None:
         return jsonify({'history': [], 'message': 'No conversation found'})
     
-    conv = conversations[conversation_id]
-    history = conv.get('message_history', [])
-    
+    etag, body = result
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+def socket_message(kind, request_id, body):
+    """A WebSocket reply: the request's type and id wrapped around an already encoded body"""
+    return ('{"type":' + app.json.dumps(kind) + ',"id":' + app.json.dumps(request_id) +
+            ',"data":' + body.rstrip() + '}')
+
+def chat_socket(ws):
+    """Chat, reset and history over one WebSocket connection
+    
+    The conversation is bound once, from the `conversation_id` query parameter,
+    and every frame after that is a JSON message:
+    {"type": "chat", "id": 1, "message": "...", "pack": "pirate"} (pack optional),
+    {"type": "history", "id": 2, "since": 0}
+    or {"type": "reset", "id": 3, "conversation_id": "<new id>"}. Each reply
+    carries the same type and id, with the REST endpoint's JSON body as "data".
+    """
+    conversation_id = request.args.get('conversation_id', 'default')
+    invalid = check_conversation_id(conversation_id)
+    if invalid is not None:
+        ws.close(reason=1008, message='invalid conversation_id')
+        return
+    
+    while True:
+        try:
+            message = app.json.loads(ws.receive())
+            if not isinstance(message, dict):
+                raise ValueError('not an object')
+        except ValueError:
+            ws.send(socket_message('error', None, '{"error":"Expected a JSON object. With a type in it, ideally."}'))
+            continue
+        kind, request_id = message.get('type'), message.get('id')
+        
+        if kind == 'chat':
+            pack = message.get('pack') or None
+            invalid = check_message(message.get('message')) or check_pack(pack)
+            user_input = clean_message(message.get('message')) if invalid is None else ''
+
+            payload, limited = (None, invalid[0]) if invalid is not None else (
+                rate_limited_chat_reply(user_input, conversation_id, pack))
+            if limited is not None:
+                ws.send(socket_message('error', request_id, limited.get_data(as_text=True)))
+                continue
+            body = app.json.dumps(payload, separators=(',', ':'))
+        elif kind == 'history':
+            since = message.get('since', 0)
+            result = run_for_conversation(conversation_id, history_body, conversation_id,
+                                          since if isinstance(since, int) else 0)
+            body = result[1] if result is not None else '{"history":[],"message":"No conversation found"}'
+        elif kind == 'reset':
+            run_for_conversation(conversation_id, delete_conversation, conversation_id)
+            body = app.json.dumps({'status': 'reset', 'conversation_id': conversation_id})
+            # The client moves on to a fresh conversation on the same connection
+            new_id = message.get('conversation_id', conversation_id)
+            if check_conversation_id(new_id) is None:
+                conversation_id = new_id
+        else:
+            body = '{"error":"Unknown message type. Try chat, history or reset."}'
+            kind = 'error'
+        ws.send(socket_message(kind, request_id, body))
+
+if sock is not None:
+    sock.route('/api/ws')(chat_socket)
+
+def admin_required(view):
+    """Only allow requests carrying the configured admin token"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = request.headers.get('X-Admin-Token', '')
+        if not ADMIN_TOKEN or not hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8')):
+            return jsonify({'error': "Nice try. Admins only."}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/api/admin/metrics', methods=['GET'])
+@admin_required
+def admin_metrics():
+    """Runtime counters for caches and limiters (of this process)"""
     return jsonify({
-        'conversation_id': conversation_id,
-        'history': history,
-        'total_messages': len(history),
-        'turns': conv.get('turns', 0)
+        'analysis_cache': analysis_cache_stats(),
+        'history_cache': lru_cache_stats(encode_history_entry),
+        'troll_transitions': troll_transition_metrics(),
+        'session_compression': session_compression_metrics(),
+        'turn_log': turn_log.stats() if turn_log is not None else None,
+        'speculation': speculation_metrics(),
+        'template_packs': template_packs.stats(),
+        'rate_limits': {
+            'rule_turns': rule_turn_limiter.stats(),
+            'llm_turns': llm_turn_limiter.stats(),
+            'sessions': session_limiter.stats(),
+            'new_sessions': new_session_limiter.stats(),
+            'batch_items': batch_item_limiter.stats(),
+            'batch_new_sessions': batch_new_session_limiter.stats(),
+        },
     })
 
+def store_report():
+    """The session store totals of this process"""
+    return session_store_stats.report()
+
+def merge_store_reports(reports):
+    """Combine the store totals of several worker processes"""
+    merged = {'sessions': 0, 'history_lengths': Counter(), 'troll_states': Counter(), 'approx_bytes': 0}
+    largest = []
+    for report in reports:
+        merged['sessions'] += report['sessions']
+        merged['history_lengths'].update(report['history_lengths'])
+        merged['troll_states'].update(report['troll_states'])
+        merged['approx_bytes'] += report['approx_bytes']
+        largest.extend(report['largest_sessions'])
+    merged['history_lengths'] = dict(sorted(merged['history_lengths'].items(),
+                                            key=lambda item: -1 if item[0] == 'unknown' else int(item[0])))
+    merged['troll_states'] = dict(merged['troll_states'])
+    merged['approx_bytes_per_session'] = merged['approx_bytes'] // merged['sessions'] if merged['sessions'] else 0
+    merged['largest_sessions'] = sorted(largest, key=lambda entry: -entry['approx_bytes'])[:session_store_stats.top_k]
+    return merged
+
+@app.route('/api/admin/store', methods=['GET'])
+@admin_required
+def admin_store():
+    """Session count, history lengths, troll states and approximate memory of the session store
+    
+    Read from running totals, so it is cheap to poll under load. In process-pool
+    mode each worker process reports its own partition and they are merged.
+    """
+    if rule_engine_in_process():
+        return jsonify(store_report())
+    reports = [pool.submit(store_report).result() for pool in get_rule_engine_pools()]
+    return jsonify(merge_store_reports(reports))
+
+@app.route('/api/admin/turns/export', methods=['GET'])
+@admin_required
+def export_turns():
+    """Stream the turn log as NDJSON, optionally for one conversation_id"""
+    if turn_log is None:
+        return jsonify({'error': "Turn logging is off. Set TURN_LOG_DIR."}), 404
+    conversation_id = request.args.get('conversation_id')
+    return Response(turn_log.export(conversation_id), mimetype='application/x-ndjson')
+
 @app.route('/api/intro', methods=['GET'])
 def get_intro():
-    """Get a random intro message"""
-    return jsonify({'intro': random.choice(INTRO_MESSAGES)})
+    """Get a random intro message, in the voice of the `pack` query parameter if given"""
+    pack_name = request.args.get('pack') or None
+    invalid = check_pack(pack_name)
+    if invalid is not None:
+        return invalid
+    pack = template_packs.get(pack_name) if pack_name is not None else None
+    return jsonify({'intro': random.choice(pack.intros if pack is not None and pack.intros else INTRO_MESSAGES)})
 
 @app.route('/health', methods=['GET'])
 def health():
@@ -1121,5 +3057,8 @@ def serve_js():
     return send_from_directory('.', 'script.js', mimetype='application/javascript')
 
 if __name__ == '__main__':
+    # The reloader's watcher process doesn't serve requests, so it leaves the store alone
+    if is_running_from_reloader():
+        start_session_store()
     app.run(debug=True, port=5000)
 
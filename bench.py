@@ -0,0 +1,840 @@
+"""Benchmarks for CrapGPT
+
+Usage:
+    python bench.py                 # run every benchmark
+    python bench.py history_json    # run only the named benchmarks
+    python bench.py --trace traffic.jsonl analysis_cache
+    python bench.py --sessions 1000000 snapshot
+    python bench.py micro --save-baseline   # record rule-engine timings
+    python bench.py micro --budget 15       # fail if any got >15% slower
+
+A trace is a JSON-lines file with one chat request per line, e.g.
+{"conversation_id": "chat_1", "message": "how do I bake a cake"}
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import app
+
+# Benchmarks hammer the app from a single client far faster than any limit allows
+app.RATE_LIMIT_ENABLED = False
+
+BENCHMARKS = {}
+OPTIONS = argparse.Namespace(trace=None, sessions=100000, baseline='bench_baseline.json',
+                             save_baseline=False, budget=25.0)
+
+# Openers that make up most real traffic, roughly in order of popularity
+COMMON_OPENERS = [
+    'hi', 'can you help me', 'how do I bake a cake', 'hello', 'ok', 'what is 2+2',
+    'can you help me buy a gift for my mom', 'how to make pancakes', 'are you serious?',
+    'what ingredients do I need?', 'how do I learn python', 'i need to fix my code',
+]
+
+
+def benchmark(func):
+    """Register a benchmark function under its name"""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def report(name, seconds, count, unit='op'):
+    """Print a single benchmark result line"""
+    per_op = seconds / count * 1e6
+    print(f"  {name:<40} {per_op:10.2f} us/{unit}   ({count / seconds:,.0f} {unit}/s)")
+
+
+def make_session(conversation_id, turns=10):
+    """Build a session with a full message history"""
+    conv = app.get_or_create_conversation(conversation_id)
+    for i in range(turns):
+        app.add_to_history(conv, 'user', f"can you help me bake a cake number {i}?")
+        app.add_to_history(conv, 'assistant', f"Fine, here's how to bake a cake number {i}. First, you need all the ingredients. All of them.")
+    return conv
+
+
+@benchmark
+def history_json():
+    """Encoding cost of a full-history /api/history response"""
+    conv = make_session('bench_history_json')
+    history = conv['message_history']
+    n = 2000
+
+    print(f"  JSON backend: {'orjson' if app.orjson is not None else 'stdlib json'}")
+    with app.app.app_context():
+        seconds = timeit.timeit(
+            lambda: app.app.json.dumps({'history': [msg.to_dict() for msg in history]}, separators=(',', ':')),
+            number=n)
+        report('full re-encode', seconds, n)
+
+        seconds = timeit.timeit(lambda: app.encode_history(conv), number=n)
+        report('cached fragments', seconds, n)
+
+        # A new message arriving between polls only encodes that one message
+        def poll_after_new_message():
+            app.add_to_history(conv, 'user', 'still here, what do I do next?')
+            app.encode_history(conv)
+        seconds = timeit.timeit(poll_after_new_message, number=n)
+        report('cached fragments + 1 new message', seconds, n)
+
+    client = app.app.test_client()
+    seconds = timeit.timeit(
+        lambda: client.get('/api/history?conversation_id=bench_history_json'), number=n)
+    report('GET /api/history end-to-end', seconds, n, 'req')
+
+
+@benchmark
+def chat_batch():
+    """Per-message cost of /api/chat versus /api/chat/batch"""
+    client = app.app.test_client()
+    messages = ['how do I bake a cake', 'ok', 'what ingredients do I need?', 'done', 'are you serious?']
+    n = 2000
+    items = [{'conversation_id': f'bench_batch_{i % 100}', 'message': messages[i % len(messages)]}
+             for i in range(n)]
+
+    start = time.perf_counter()
+    for item in items:
+        client.post('/api/chat', json=item)
+    report('POST /api/chat one by one', time.perf_counter() - start, n, 'msg')
+
+    start = time.perf_counter()
+    client.post('/api/chat/batch', json={'items': items})
+    report('POST /api/chat/batch (array)', time.perf_counter() - start, n, 'msg')
+
+    start = time.perf_counter()
+    client.post('/api/chat/batch', json={'items': items, 'stream': True}).get_data()
+    report('POST /api/chat/batch (NDJSON)', time.perf_counter() - start, n, 'msg')
+
+
+@benchmark
+def rule_engine_scaling():
+    """Rule-based throughput in process-pool mode at 1, 2, 4 and 8 worker processes"""
+    messages = ['how do I bake a cake', 'ok', 'what ingredients do I need?', 'done',
+                'are you serious?', 'what is 2+2', 'can you help me buy a gift for my mom']
+    n = 4000
+    conversation_turns = {}
+    for i in range(n):
+        conversation_turns.setdefault(f'bench_scaling_{i % 200}', []).append((i, messages[i % len(messages)], None))
+
+    original_processes = app.RULE_ENGINE_PROCESSES
+    print(f"  CPUs available: {os.cpu_count()}")
+    try:
+        for processes in (0, 1, 2, 4, 8):
+            app.RULE_ENGINE_PROCESSES = processes
+            # Start the workers outside the timed section
+            for pool in app.get_rule_engine_pools() if processes else []:
+                pool.submit(len, '').result()
+
+            executor = app.get_batch_executor()
+            start = time.perf_counter()
+            futures = [executor.submit(app.run_batch_conversation, conversation_id, turns)
+                       for conversation_id, turns in conversation_turns.items()]
+            for future in futures:
+                future.result()
+            label = f'{processes} processes' if processes else 'in-process threads'
+            report(label, time.perf_counter() - start, n, 'msg')
+            app.shutdown_rule_engine_pools()
+    finally:
+        app.RULE_ENGINE_PROCESSES = original_processes
+
+
+def rescanning_callback_check(history, current_input):
+    """The repetition check as it was before the word-set index: re-tokenizes every past message"""
+    current_lower = current_input.lower()
+    for msg in history[:-2]:
+        if msg.role == 'user':
+            past_msg = msg.content.lower()
+            if len(current_lower) > 10 and len(past_msg) > 10:
+                words_current = set(current_lower.split())
+                words_past = set(past_msg.split())
+                if len(words_current & words_past) / max(len(words_current), len(words_past)) > 0.5:
+                    return True
+    return False
+
+
+@benchmark
+def repetition_index():
+    """Per-turn cost of the repetition check as the history window grows"""
+    original = app.MAX_HISTORY_MESSAGES, app.CALLBACK_WINDOW
+    current = 'so anyway what is the best way to learn the guitar quickly'
+    try:
+        for depth in (10, 50, 200, 1000):
+            app.MAX_HISTORY_MESSAGES = app.CALLBACK_WINDOW = depth
+            conv = app.get_or_create_conversation(f'bench_repetition_{depth}')
+            for i in range(depth // 2):
+                app.add_to_history(conv, 'user', f'please tell me how I can fix problem number {i} in my long running project today')
+                app.add_to_history(conv, 'assistant', 'Figure it out yourself.')
+            app.add_to_history(conv, 'user', current)
+            history = app.get_conversation_context(conv, depth)
+            n = 200
+
+            seconds = timeit.timeit(lambda: rescanning_callback_check(history, current), number=n)
+            report(f'depth {depth:>4}: re-tokenize every turn', seconds, n, 'turn')
+            conv['turns'] = 0  # Keep the topic callbacks out of the measurement
+            seconds = timeit.timeit(lambda: app.generate_contextual_callback(conv, current), number=n)
+            report(f'depth {depth:>4}: stored word sets', seconds, n, 'turn')
+    finally:
+        app.MAX_HISTORY_MESSAGES, app.CALLBACK_WINDOW = original
+
+
+def deep_size(obj, seen):
+    """Bytes used by obj and everything it references, counting shared objects once"""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    return size
+
+
+@benchmark
+def history_memory():
+    """Memory of whole sessions with histories stored as template references versus full strings"""
+    sessions = 2000
+    script = ['how do I bake a cake', 'ok', 'what ingredients do I need?', 'done', 'ok',
+              'are you serious?', 'can you help me buy a gift for my mom', 'what budget',
+              'tell me more please', 'i finished']
+    rng = random.Random(7)
+    convs = []
+    for i in range(sessions):
+        conversation_id = f'bench_memory_{i}'
+        for _ in range(10):
+            app.generate_witty_response(rng.choice(script), conversation_id)
+        convs.append(app.conversations.pop(conversation_id))
+
+    def session_bytes(sessions):
+        seen = set(map(id, app.TEMPLATES))  # group names are shared with the template table
+        return sum(deep_size(conv, seen) for conv in sessions)
+
+    # Full strings: sessions as they used to be stored, with message dicts and no caches
+    expanded = [
+        {key: value for key, value in conv.items() if key not in app.TRANSIENT_SESSION_KEYS}
+        | {'message_history': [msg.to_dict() for msg in conv['message_history']]}
+        for conv in convs
+    ]
+    full = session_bytes(expanded)
+    # Template references, plus the word sets of the repetition check: what the sessions hold
+    referenced = session_bytes(convs)
+    # A /api/history poll fills the shared, bounded fragment cache, not the sessions
+    for conv in convs:
+        app.encode_history(conv)
+    polled = session_bytes(convs)
+    seen = set()
+    fragments = sum(deep_size(app.encode_history_entry(msg), seen) for conv in convs for msg in conv['message_history'])
+
+    messages = sum(len(conv['message_history']) for conv in convs)
+    print(f"  {sessions} sessions, {messages} messages (whole session dicts)")
+    for label, size in [('full strings', full), ('template references', referenced),
+                        ('template references, after a poll', polled)]:
+        print(f"  {label:<40} {size / sessions:10.1f} bytes/session   ({size / 2**20:.1f} MiB)")
+    print(f"  {'shared fragment cache':<40} {fragments / 2**20:10.1f} MiB for {messages} messages "
+          f"(capped at HISTORY_CACHE_SIZE={app.HISTORY_CACHE_SIZE} entries)")
+
+    n = 20
+    seconds = timeit.timeit(lambda: [app.render_content(msg.content) for conv in convs[:100]
+                                     for msg in conv['message_history']], number=n)
+    report('lazy render', seconds, n * sum(len(conv['message_history']) for conv in convs[:100]), 'msg')
+
+
+@benchmark
+def session_compression():
+    """Size of idle sessions before and after compression, and the cost of inflating them"""
+    sessions = 1000
+    script = ['how do I bake a cake', 'ok', 'what ingredients do I need?', 'done', 'ok',
+              'are you serious?', 'can you help me buy a gift for my mom', 'tell me more please']
+    rng = random.Random(11)
+    ids = [f'bench_compress_{i}' for i in range(sessions)]
+    for conversation_id in ids:
+        for _ in range(10):
+            app.generate_witty_response(rng.choice(script), conversation_id)
+
+    seen = set(map(id, app.TEMPLATES))
+    live = sum(deep_size(app.conversations[conversation_id], seen) for conversation_id in ids)
+
+    start = time.perf_counter()
+    app.compress_idle_sessions(0)
+    report('compress', time.perf_counter() - start, sessions, 'session')
+    compressed = sum(sys.getsizeof(app.conversations[conversation_id].blob) for conversation_id in ids)
+    print(f"  codec {app.session_compression_metrics()['codec']}: "
+          f"{live / sessions:,.0f} bytes/session live, {compressed / sessions:,.0f} bytes/session compressed")
+
+    start = time.perf_counter()
+    for conversation_id in ids:
+        app.get_conversation(conversation_id)
+    report('inflate on next access', time.perf_counter() - start, sessions, 'session')
+    for conversation_id in ids:
+        app.delete_conversation(conversation_id)
+
+
+@benchmark
+def snapshot():
+    """Snapshot and warm-restart time of the session store (--sessions, default 100k)"""
+    sessions = OPTIONS.sessions
+    script = ['how do I bake a cake', 'ok', 'what ingredients do I need?', 'done', 'ok', 'are you serious?']
+    for message in script:
+        app.generate_witty_response(message, 'bench_snapshot_template')
+    template = app.conversations.pop('bench_snapshot_template')
+    compressed = app.CompressedSession(template)
+
+    # Most sessions in a long-running store are idle and already compressed;
+    # keep 1% live so the snapshot also has to serialize some
+    saved = dict(app.conversations)
+    app.conversations.clear()
+    for i in range(sessions):
+        if i % 100 == 0:
+            conv = dict(template)
+            conv['message_history'] = list(template['message_history'])
+            app.conversations[f'bench_snapshot_{i}'] = conv
+        else:
+            app.conversations[f'bench_snapshot_{i}'] = app.CompressedSession.from_blob(
+                compressed.blob, compressed.codec, compressed.raw_size)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'sessions')
+        start = time.perf_counter()
+        app.write_snapshot(path)
+        elapsed = time.perf_counter() - start
+        report(f'snapshot {sessions:,} sessions', elapsed, sessions, 'session')
+        print(f"  snapshot size {os.path.getsize(path) / 2**20:.1f} MiB, total {elapsed:.2f}s")
+
+        app.conversations.clear()
+        start = time.perf_counter()
+        app.restore_session_store(path)
+        elapsed = time.perf_counter() - start
+        report(f'restore {sessions:,} sessions (mmap)', elapsed, sessions, 'session')
+        print(f"  restore total {elapsed:.2f}s")
+
+        sample = [f'bench_snapshot_{i}' for i in range(1, sessions, max(1, sessions // 1000))]
+        start = time.perf_counter()
+        for conversation_id in sample:
+            app.get_conversation(conversation_id)
+        report('first access after restore', time.perf_counter() - start, len(sample), 'session')
+
+        app.conversations.clear()
+        app._snapshot_mmap.close()
+        app._snapshot_mmap = None
+    app.conversations.update(saved)
+
+
+@benchmark
+def turn_log():
+    """Request-thread cost of logging a turn, and writer throughput"""
+    n = 200000
+    turn = {'timestamp': '2026-01-01T00:00:00', 'conversation_id': 'bench_turn_log',
+            'message': 'how do I bake a cake', 'response': "Fine, here's how to cake. First, you need all the ingredients."}
+    with tempfile.TemporaryDirectory() as directory:
+        log = app.TurnLog(directory, queue_size=n, batch_size=500, flush_seconds=0.5, max_file_bytes=8 * 2**20)
+        start = time.perf_counter()
+        for _ in range(n):
+            log.record(turn)
+        report('record() on the request thread', time.perf_counter() - start, n, 'turn')
+
+        while log.written + log.dropped < n:
+            time.sleep(0.01)
+        report('background writer', time.perf_counter() - start, n, 'turn')
+        log.close()
+        print(f"  {len(log.files())} files, {log.stats()}")
+
+        small = app.TurnLog(directory, queue_size=100, batch_size=500, flush_seconds=0.5, max_file_bytes=8 * 2**20)
+        for _ in range(10000):
+            small.record(turn)
+        small.close()
+        print(f"  with a 100-turn queue under a burst of 10000: {small.dropped} dropped")
+
+
+def load_trace(n=20000):
+    """Chat requests from --trace, or a synthetic trace dominated by common openers"""
+    if OPTIONS.trace:
+        with open(OPTIONS.trace, encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    rng = random.Random(42)
+    trace = []
+    for i in range(n):
+        if rng.random() < 0.8:
+            # Zipf-ish popularity among the common openers
+            message = COMMON_OPENERS[min(int(rng.paretovariate(1.2)) - 1, len(COMMON_OPENERS) - 1)]
+        else:
+            message = f'how do I build a {rng.choice(["shed", "website", "robot", "boat"])} for my {rng.randrange(1000)} friends'
+        trace.append({'conversation_id': f'trace_{i % 500}', 'message': message})
+    return trace
+
+
+@benchmark
+def analysis_cache():
+    """Throughput of message analysis with and without the memo cache, over a trace"""
+    messages = [entry.get('message', '') for entry in load_trace()]
+    n = len(messages)
+
+    def uncached(message):
+        normalized = app.normalize_message(message)
+        return (app.detect_intent(normalized), app.extract_topic(normalized),
+                app.extract_action(normalized), app.detect_request_category(normalized))
+
+    start = time.perf_counter()
+    for message in messages:
+        uncached(message)
+    report('uncached analysis', time.perf_counter() - start, n, 'msg')
+
+    app._analyze_normalized.cache_clear()
+    start = time.perf_counter()
+    for message in messages:
+        app.analyze_message(message)
+    report('memoized analysis', time.perf_counter() - start, n, 'msg')
+    stats = app.analysis_cache_stats()
+    print(f"  hit rate {stats['hit_rate']:.1%} over {n} messages ({stats['size']} cached entries)")
+
+
+def labeled_corpus(n=20000):
+    """(message, intent, category) examples: labeled trace lines, or varied synthetic messages
+
+    Synthetic messages are labeled by the keyword rules and drawn from a few
+    templates, so agreement on them is an upper bound - use --trace for real traffic.
+    """
+    if OPTIONS.trace:
+        trace = load_trace()
+        messages = [entry.get('message', '') for entry in trace]
+        labels = {app.normalize_message(entry.get('message', '')): entry for entry in trace}
+    else:
+        rng = random.Random(7)
+        openers = ['', 'hi, ', 'hey ', 'ugh ', 'ok so ', 'please ', 'honestly ']
+        bodies = [
+            'can you help me {verb} a {thing}', 'how do I {verb} {thing}s', 'i want to {verb} a {thing}',
+            'what should I get my {person} for her birthday', 'my {lang} code has a bug', 'are you even a real ai',
+            'this is not working, I am stuck', 'tell me about {thing}s', 'why is the sky blue',
+            'what is {a} + {b}', 'i need a {thing} recipe', 'teach me {lang}', 'nice weather today',
+            'who are you', 'I keep getting an error in my {lang} function', 'that was useless',
+        ]
+        fill = {
+            'verb': ['bake', 'build', 'buy', 'cook', 'learn', 'fix', 'design', 'find'],
+            'thing': ['cake', 'shed', 'website', 'gift', 'bread', 'robot', 'course', 'snack', 'boat', 'poem'],
+            'person': ['mom', 'sister', 'boss', 'grandma'],
+            'lang': ['python', 'javascript', 'html', 'css'],
+        }
+        messages = []
+        for _ in range(n):
+            body = rng.choice(bodies).format(
+                a=rng.randrange(100), b=rng.randrange(100), **{key: rng.choice(words) for key, words in fill.items()})
+            messages.append(rng.choice(openers) + body)
+        labels = {}
+    examples = []
+    for message in messages:
+        normalized = app.normalize_message(message)
+        entry = labels.get(normalized, {})
+        examples.append((normalized,
+                         entry.get('intent') or app.detect_intent(normalized),
+                         entry.get('category') or app.detect_request_category(normalized)))
+    return examples
+
+
+@benchmark
+def intent_classifier():
+    """Accuracy and throughput of the learned intent/category classifier against the keyword rules"""
+    if app.np is None:
+        print("  numpy is not installed - skipping")
+        return
+    import train_classifier
+
+    examples = labeled_corpus()
+    random.Random(0).shuffle(examples)
+    cut = int(len(examples) * 0.8)
+    start = time.perf_counter()
+    model = train_classifier.train(examples[:cut])
+    print(f"  trained on {cut} messages in {time.perf_counter() - start:.1f}s")
+    intent_accuracy, category_accuracy = train_classifier.accuracy(model, examples[cut:])
+    print(f"  held-out agreement: intent {intent_accuracy:.1%}, category {category_accuracy:.1%}")
+
+    messages = [message for message, _, _ in examples]
+    for batch_size in (1, 64, 4096):
+        batches = [messages[i:i + batch_size] for i in range(0, len(messages), batch_size)]
+        count = sum(len(batch) for batch in batches)
+        start = time.perf_counter()
+        for batch in batches:
+            [(app.detect_intent(message), app.detect_request_category(message)) for message in batch]
+        report(f'keyword rules, batch {batch_size}', time.perf_counter() - start, count, 'msg')
+        start = time.perf_counter()
+        for batch in batches:
+            model.classify_batch(batch)
+        report(f'classifier, batch {batch_size}', time.perf_counter() - start, count, 'msg')
+
+    # /api/chat/batch scores all of its messages in one pass before running the turns
+    items = [{'conversation_id': f'bench_classify_{i}', 'message': message} for i, message in enumerate(messages[:4096])]
+    client = app.app.test_client()
+    one_pass = app.classify_for_batch
+    app.intent_classifier = model
+    try:
+        for label, classify in [('/api/chat/batch, classified one by one', lambda messages: None),
+                                ('/api/chat/batch, classified in one pass', one_pass)]:
+            app.classify_for_batch = classify
+            app._analyze_normalized.cache_clear()
+            start = time.perf_counter()
+            client.post('/api/chat/batch', json={'items': items})
+            report(label, time.perf_counter() - start, len(items), 'msg')
+            for item in items:
+                app.delete_conversation(item['conversation_id'])
+    finally:
+        app.classify_for_batch = one_pass
+        app.intent_classifier = None
+        app._analyze_normalized.cache_clear()
+
+
+# Messages built to defeat the rule engine: long runs of characters its regexes
+# and keyword scans care about, repeated request prefixes, and no-match text
+PATHOLOGICAL_INPUTS = {
+    'math characters': lambda n: 'x' * n,
+    'open parentheses': lambda n: '(' * n,
+    'whitespace run': lambda n: 'a' + ' ' * n + 'b',
+    'repeated prefix': lambda n: 'what should i ' * (n // 14),
+    'trailing prepositions': lambda n: 'make a' + ' for' * (n // 4),
+    'one long word': lambda n: 'z' * n + '?',
+    'non-ascii': lambda n: 'ß÷漢字🙂 ' * (n // 7),
+}
+
+
+def analyze_uncapped(message, conv):
+    """Everything the rule engine does to classify a message, without the length cap"""
+    normalized = app.normalize_message(message)
+    app._analyze_normalized.__wrapped__(normalized)
+    app.is_request_for_help(message)
+    app.is_new_unrelated_question(message, conv)
+
+
+@benchmark
+def pathological_input():
+    """Rule engine cost on huge and adversarial messages, and the request size bounds"""
+    # Each analysis pass has to stay linear: 100x the input may cost at most
+    # 300x the time (timer noise dominates the small case)
+    conv = app.new_conversation_state()
+    conv['instruction_topic'] = 'cake'
+    for name, make in PATHOLOGICAL_INPUTS.items():
+        timings = []
+        for n in (10**4, 10**6):
+            message = make(n)
+            start = time.perf_counter()
+            analyze_uncapped(message, conv)
+            timings.append(time.perf_counter() - start)
+        growth = timings[1] / max(timings[0], 1e-4)
+        print(f"  {name:<24} 10 KB {timings[0] * 1000:7.2f} ms   1 MB {timings[1] * 1000:8.2f} ms   x{growth:.0f}")
+        assert growth < 300, f'{name}: analysis is superlinear ({growth:.0f}x for 100x the input)'
+
+    # Through the endpoint every message is cut to MAX_MESSAGE_LENGTH first, so
+    # even a body just under the request limit answers quickly and in bounded memory
+    client = app.app.test_client()
+    message = 'what should i ' * ((app.MAX_REQUEST_BYTES - 1024) // 14)
+    tracemalloc.start()
+    start = time.perf_counter()
+    response = client.post('/api/chat', json={'message': message, 'conversation_id': 'bench_pathological'})
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"  {len(message) / 2**20:.1f} MB message: {response.status_code} in {elapsed * 1000:.1f} ms, "
+          f"peak {peak / 2**20:.1f} MB allocated")
+    assert response.status_code == 200
+    assert len(app.get_conversation('bench_pathological')['message_history'][0].content) == app.MAX_MESSAGE_LENGTH
+    assert elapsed < 1.0, 'a maximum size request took over a second'
+    assert peak < 10 * app.MAX_REQUEST_BYTES, 'a maximum size request allocated over 10x its size'
+
+    response = client.post('/api/chat', json={'message': 'x' * app.MAX_REQUEST_BYTES})
+    print(f"  oversized body: {response.status_code}")
+    assert response.status_code == 413
+    response = client.post('/api/chat', json={'message': 'hi', 'conversation_id': 'c' * 10**5})
+    print(f"  oversized conversation_id: {response.status_code}")
+    assert response.status_code == 400
+
+
+@benchmark
+def websocket_transport():
+    """Sequential messages per second on one connection: WebSocket vs REST"""
+    if app.sock is None:
+        print("  flask-sock is not installed - skipping")
+        return
+    import requests
+    import simple_websocket
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietKeepAliveHandler(WSGIRequestHandler):
+        # Keep-alive, as a browser would use for repeated fetches
+        protocol_version = 'HTTP/1.1'
+
+        def log_request(self, *args):
+            pass
+
+    server = make_server('127.0.0.1', 0, app.app, threaded=True, request_handler=QuietKeepAliveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'127.0.0.1:{server.server_port}'
+    n = 2000
+    try:
+        with requests.Session() as http:
+            start = time.perf_counter()
+            for i in range(n):
+                http.post(f'http://{base}/api/chat', json={'message': 'hi', 'conversation_id': 'bench_rest'}).json()
+            report('REST POST /api/chat (keep-alive)', time.perf_counter() - start, n, 'msg')
+
+        ws = simple_websocket.Client.connect(f'ws://{base}/api/ws?conversation_id=bench_ws')
+        try:
+            start = time.perf_counter()
+            for i in range(n):
+                ws.send(json.dumps({'type': 'chat', 'id': i, 'message': 'hi'}))
+                json.loads(ws.receive())
+            report('WebSocket chat frames', time.perf_counter() - start, n, 'msg')
+        finally:
+            ws.close()
+    finally:
+        server.shutdown()
+
+
+@benchmark
+def llm_profiles():
+    """End-to-end /api/chat latency and rule-based fallback rate against fake LLM profiles"""
+    import fake_llm
+
+    original = (app.USE_LLM, app.GROQ_API_KEY, app.GROQ_API_URL, app.GROQ_TIMEOUT, app.generate_llm_troll_response)
+    outcomes = {'calls': 0, 'fallbacks': 0}
+
+    def counted_llm_response(*args, **kwargs):
+        reply = original[4](*args, **kwargs)
+        outcomes['calls'] += 1
+        outcomes['fallbacks'] += reply is None
+        return reply
+
+    # Turns that go to the LLM: a request, then details requests
+    messages = ['how do I bake a cake', 'more details please', 'tell me more']
+    n = 30
+    client = app.app.test_client()
+    app.USE_LLM, app.GROQ_API_KEY, app.GROQ_TIMEOUT = True, 'fake', 1.0
+    app.generate_llm_troll_response = counted_llm_response
+    print(f"  {n} turns per profile, client timeout {app.GROQ_TIMEOUT:g}s")
+    try:
+        for profile in fake_llm.PROFILES:
+            server = fake_llm.make_server(profile)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            app.GROQ_API_URL = server.url
+            outcomes.update(calls=0, fallbacks=0)
+            latencies = []
+            for i in range(n):
+                start = time.perf_counter()
+                # The app prints every upstream failure; keep the report readable
+                with contextlib.redirect_stdout(io.StringIO()):
+                    client.post('/api/chat', json={'message': messages[i % len(messages)],
+                                                   'conversation_id': f'bench_llm_{profile}_{i // len(messages)}'})
+                latencies.append(time.perf_counter() - start)
+            server.shutdown()
+            server.server_close()
+
+            p50, p95 = (statistics.quantiles(latencies, n=20)[i] * 1000 for i in (9, 18))
+            fallback_rate = outcomes['fallbacks'] / max(outcomes['calls'], 1)
+            print(f"  {profile:<14} p50 {p50:7.1f} ms   p95 {p95:7.1f} ms   max {max(latencies) * 1000:7.1f} ms   "
+                  f"fallback {fallback_rate:6.1%} of {outcomes['calls']} LLM calls")
+    finally:
+        (app.USE_LLM, app.GROQ_API_KEY, app.GROQ_API_URL, app.GROQ_TIMEOUT,
+         app.generate_llm_troll_response) = original
+
+
+@benchmark
+def store_introspection():
+    """Per-turn cost of the running store totals, and report latency as the store grows"""
+    conv = make_session('bench_store', turns=app.MAX_HISTORY_MESSAGES)
+    stats = app.SessionStoreStats()
+    n = 20000
+    seconds = timeit.timeit(lambda: stats.update('bench_store', app.summarize_session(conv)), number=n)
+    report('summarize + update (full history)', seconds, n)
+
+    for i in range(OPTIONS.sessions):
+        stats.update(f'bench_store_{i}', app.SessionSummary(i % 21, 'pretending_help', 1000 + i % 5000))
+    n = 200
+    seconds = timeit.timeit(stats.report, number=n)
+    report(f'report over {OPTIONS.sessions:,} sessions', seconds, n)
+
+
+@benchmark
+def template_packs():
+    """Cost of a pack's first load, and of picking and rendering replies with and without one"""
+    cache = app.TemplatePackCache(app.TEMPLATE_PACK_IDLE_SECONDS)
+    n = 200
+    seconds = timeit.timeit(lambda: (cache.get('pirate'), cache.packs.clear()), number=n)
+    report('load pirate pack (cold)', seconds, n)
+
+    n = 100000
+    for pack in (None, 'pirate'):
+        token = app.current_template_pack.set(pack)
+        try:
+            seconds = timeit.timeit(lambda: str(app.pick_reply('snark.general', user_input='hello')), number=n)
+        finally:
+            app.current_template_pack.reset(token)
+        report(f'pick + render, pack={pack}', seconds, n)
+
+
+# Corpora for the micro-benchmarks
+SHORT_MESSAGES = COMMON_OPENERS
+LONG_MESSAGES = [
+    ('so basically I have been trying to ' + task + ' for about three weeks now and nothing works, '
+     'I read every tutorial, watched the videos, asked my neighbour, and honestly I am stuck. ') * 4
+    + 'can you help me ' + task + '?'
+    for task in ['bake a sourdough bread', 'fix my python code', 'buy a gift for my sister',
+                 'learn the guitar', 'build a website for my cat']
+]
+MULTILINGUAL_MESSAGES = [
+    '¿puedes ayudarme a hacer un pastel?', 'wie backe ich einen kuchen', 'comment faire une crêpe ?',
+    '你好，你能帮我写代码吗', 'ケーキの作り方を教えて', 'помоги мне купить подарок маме',
+    'هل يمكنك مساعدتي؟', 'मुझे खाना बनाना सिखाओ', 'hi 🙂 can you help me cook 🍰 dinner',
+    'ok ok ok 👍', 'how do I bake a käsekuchen für meine oma', 'what is 2+2 ? 二加二',
+]
+MICRO_CORPORA = {'short': SHORT_MESSAGES, 'long': LONG_MESSAGES, 'multilingual': MULTILINGUAL_MESSAGES}
+
+
+def troll_session():
+    """A session with full history, mid troll sequence"""
+    conv = make_session('bench_micro', turns=app.MAX_HISTORY_MESSAGES)
+    conv.update(troll_state='pretending_help', instruction_topic='cake', instruction_action='make',
+                instruction_category='cooking')
+    return conv
+
+
+def followup(message, conv):
+    conv['troll_state'] = 'pretending_help'
+    return app.generate_troll_followup(message, conv)
+
+
+# name -> function of (message, session) run over every corpus message
+MICRO_CASES = {
+    'detect_intent': lambda message, conv: app.detect_intent(message),
+    'detect_request_category': lambda message, conv: app.detect_request_category(message),
+    'is_new_unrelated_question': app.is_new_unrelated_question,
+    'is_request_for_help': lambda message, conv: app.is_request_for_help(message),
+    'extract_topic': lambda message, conv: app.extract_topic(message),
+    'extract_action': lambda message, conv: app.extract_action(message),
+    'generate_contextual_callback': lambda message, conv: app.generate_contextual_callback(conv, message),
+    'add_to_history': lambda message, conv: app.add_to_history(conv, 'user', message),
+    'generate_troll_instruction': lambda message, conv: app.render_content(app.generate_troll_instruction(message, conv)),
+    'generate_troll_followup': lambda message, conv: app.render_content(followup(message, conv)),
+    'continue_trolling_steps': lambda message, conv: app.render_content(app.continue_trolling_steps(conv)),
+    'generate_simple_question_troll': lambda message, conv: app.render_content(
+        app.generate_simple_question_troll(message, 'general')),
+}
+
+
+def calibration_workload(message, conv):
+    """Fixed pure-Python work, timed alongside every case to factor out machine speed"""
+    words = sorted(message.lower().split())
+    return {word: len(word) for word in words}
+
+
+def loops_for(run, min_seconds):
+    """Number of loops of `run` that takes at least `min_seconds`"""
+    loops = 1
+    while timeit.timeit(run, number=loops) < min_seconds:
+        loops *= 2
+    return loops
+
+
+def time_micro_case(func, messages, conv, repeat=7, min_seconds=0.02):
+    """Best per-call time of a case in microseconds, and its cost relative to the calibration workload
+
+    The case and the calibration are timed in alternation, so a machine that
+    speeds up or slows down mid-run affects both alike.
+    """
+    def run():
+        for message in messages:
+            func(message, conv)
+
+    def calibrate():
+        for message in LONG_MESSAGES:
+            calibration_workload(message, None)
+
+    loops, calibration_loops = loops_for(run, min_seconds), loops_for(calibrate, min_seconds)
+    best, best_calibration = float('inf'), float('inf')
+    for _ in range(repeat):
+        best = min(best, timeit.timeit(run, number=loops))
+        best_calibration = min(best_calibration, timeit.timeit(calibrate, number=calibration_loops))
+    micros = best / (loops * len(messages)) * 1e6
+    calibration_micros = best_calibration / (calibration_loops * len(LONG_MESSAGES)) * 1e6
+    return micros, micros / calibration_micros
+
+
+@benchmark
+def micro():
+    """Per-call time of each rule-engine function on short, long and multilingual messages"""
+    random.seed(0)
+    timings, relative = {}, {}
+    for case, func in MICRO_CASES.items():
+        for corpus, messages in MICRO_CORPORA.items():
+            key = f'{case}/{corpus}'
+            timings[key], relative[key] = time_micro_case(func, messages, troll_session())
+
+    baseline = {}
+    if not OPTIONS.save_baseline and os.path.exists(OPTIONS.baseline):
+        with open(OPTIONS.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['relative']
+
+    regressions = []
+    for key, micros in timings.items():
+        line = f"  {key:<48} {micros:9.3f} us"
+        if key in baseline:
+            # Compared in units of the calibration workload, not raw time
+            change = (relative[key] - baseline[key]) / baseline[key] * 100
+            line += f"   {change:+6.1f}%"
+            if change > OPTIONS.budget:
+                line += '   REGRESSION'
+                regressions.append(key)
+        print(line)
+
+    if OPTIONS.save_baseline:
+        with open(OPTIONS.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'python': sys.version.split()[0], 'relative': relative, 'timings_us': timings},
+                      f, indent=2, sort_keys=True)
+        print(f"  saved baseline to {OPTIONS.baseline}")
+    elif not baseline:
+        print(f"  no baseline at {OPTIONS.baseline} - run with --save-baseline to record one")
+    elif regressions:
+        print(f"  {len(regressions)} function(s) regressed by more than {OPTIONS.budget:g}%")
+        return False
+    return True
+
+
+def main(argv):
+    """Run the selected benchmarks (all of them if none are named)"""
+    parser = argparse.ArgumentParser(description='CrapGPT benchmarks')
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all)')
+    parser.add_argument('--trace', help='JSON-lines trace of chat requests to replay')
+    parser.add_argument('--sessions', type=int, default=100000, help='session count for store benchmarks')
+    parser.add_argument('--baseline', default='bench_baseline.json', help='baseline timings file for micro')
+    parser.add_argument('--save-baseline', action='store_true', help='record the micro timings as the new baseline')
+    parser.add_argument('--budget', type=float, default=25.0,
+                        help='percent slowdown against the baseline that fails micro')
+    parser.parse_args(argv, namespace=OPTIONS)
+    names = OPTIONS.names
+
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        print(f"Unknown benchmark(s): {', '.join(unknown)}. Available: {', '.join(BENCHMARKS)}")
+        return 2
+
+    failed = []
+    for name in names or BENCHMARKS:
+        func = BENCHMARKS[name]
+        print(f"{name}: {func.__doc__}")
+        start = time.perf_counter()
+        if func() is False:
+            failed.append(name)
+        print(f"  ({time.perf_counter() - start:.1f}s)\n")
+    if failed:
+        print(f"Failed: {', '.join(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
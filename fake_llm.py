@@ -0,0 +1,211 @@
+"""Local stand-in for the Groq API, for exercising the LLM path offline
+
+Usage:
+    python fake_llm.py --profile groq --port 8081
+    GROQ_API_URL=http://127.0.0.1:8081/v1/chat/completions GROQ_API_KEY=fake USE_LLM=true python app.py
+
+It answers OpenAI-compatible chat completion requests after a latency drawn
+from the profile, and fails some of them on purpose: rate limits, server
+errors, hangs past the client's timeout, and malformed payloads. Requests
+with "stream": true get server-sent events paced at the profile's tokens per
+second. Outcomes come from a seeded random generator, so the same sequence of
+requests sees the same sequence of outcomes.
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# latency: ('fixed', seconds) | ('uniform', low, high) | ('lognormal', median, sigma)
+# Rates are per request and checked in order: hang, error, malformed.
+PROFILES = {
+    'instant': {'latency': ('fixed', 0.0)},
+    'groq': {
+        'latency': ('lognormal', 0.25, 0.4), 'tokens_per_second': 800,
+        'error_rate': 0.01, 'error_status': 429,
+    },
+    'slow': {'latency': ('lognormal', 1.5, 0.6), 'tokens_per_second': 40},
+    'rate_limited': {'latency': ('lognormal', 0.1, 0.3), 'error_rate': 0.5, 'error_status': 429},
+    'flaky': {
+        'latency': ('uniform', 0.05, 0.4), 'hang_rate': 0.1, 'hang_seconds': 30,
+        'error_rate': 0.2, 'error_status': 500, 'malformed_rate': 0.2,
+    },
+    'malformed': {'latency': ('fixed', 0.01), 'malformed_rate': 1.0},
+}
+
+# Payloads an upstream has been seen to return with a 200 instead of a completion
+MALFORMED_BODIES = [
+    '{"choices": []}',
+    '{"choices": [{"message": {"role": "assistant", "content": null}}]}',
+    '{"choices": [{"text": "legacy completion shape"}]}',
+    '{"error": {"message": "model overloaded"}}',
+    '{"choices": [{"message": {"content": "truncated',
+    '<html><body>502 Bad Gateway</body></html>',
+]
+
+REPLIES = [
+    "Sure, step one is to figure out {topic}. Step two is left as an exercise.",
+    "{topic}? Great question. Have you tried asking someone who cares?",
+    "Easy. You just need everything. All of it. For {topic}.",
+    "I could explain {topic}, but then you'd learn something, and where's the fun in that?",
+]
+
+
+class FakeLLM:
+    """A profile's outcome generator, shared by all request threads"""
+
+    def __init__(self, profile, seed=0):
+        self.profile = dict(PROFILES[profile]) if isinstance(profile, str) else dict(profile)
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {'requests': 0, 'ok': 0, 'errors': 0, 'hangs': 0, 'malformed': 0}
+
+    def latency(self):
+        kind, *params = self.profile.get('latency', ('fixed', 0.0))
+        if kind == 'uniform':
+            return self.rng.uniform(*params)
+        if kind == 'lognormal':
+            median, sigma = params
+            return self.rng.lognormvariate(0, sigma) * median
+        return params[0]
+
+    def draw(self):
+        """(outcome, latency in seconds, random value) for the next request"""
+        profile = self.profile
+        with self.lock:
+            self.counts['requests'] += 1
+            latency, roll, pick = self.latency(), self.rng.random(), self.rng.random()
+            if roll < profile.get('hang_rate', 0):
+                outcome = 'hangs'
+            elif roll < profile.get('hang_rate', 0) + profile.get('error_rate', 0):
+                outcome = 'errors'
+            elif roll < (profile.get('hang_rate', 0) + profile.get('error_rate', 0)
+                         + profile.get('malformed_rate', 0)):
+                outcome = 'malformed'
+            else:
+                outcome = 'ok'
+            self.counts[outcome] += 1
+        return outcome, latency, pick
+
+
+def reply_text(payload, pick):
+    """A canned snarky completion that mentions the last user message"""
+    messages = payload.get('messages') or [{}]
+    topic = str(messages[-1].get('content', 'that'))[:40]
+    return REPLIES[int(pick * len(REPLIES))].format(topic=topic)
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    llm = None  # set by make_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client timed out and hung up first
+
+    def send_body(self, status, body, content_type='application/json', headers=()):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            with self.llm.lock:
+                self.send_body(200, json.dumps(self.llm.counts))
+        else:
+            self.send_body(404, '{"error": "not found"}')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self.send_body(400, '{"error": {"message": "invalid JSON"}}')
+            return
+        if not self.path.endswith('/chat/completions'):
+            self.send_body(404, '{"error": {"message": "unknown endpoint"}}')
+            return
+
+        profile = self.llm.profile
+        outcome, latency, pick = self.llm.draw()
+        if outcome == 'hangs':
+            time.sleep(profile.get('hang_seconds', 30))
+        time.sleep(latency)
+
+        if outcome == 'errors':
+            status = profile.get('error_status', 500)
+            headers = [('Retry-After', '1')] if status == 429 else []
+            self.send_body(status, json.dumps({'error': {'message': f'fake upstream error {status}'}}),
+                           headers=headers)
+        elif outcome == 'malformed':
+            self.send_body(200, MALFORMED_BODIES[int(pick * len(MALFORMED_BODIES))])
+        elif payload.get('stream'):
+            self.stream(payload, reply_text(payload, pick))
+        else:
+            self.send_body(200, json.dumps({
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion',
+                'model': payload.get('model', 'fake'),
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': reply_text(payload, pick)}}],
+            }))
+
+    def stream(self, payload, text):
+        """Send the reply as server-sent event chunks, one word per token"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        delay = 1 / self.llm.profile.get('tokens_per_second', 200)
+        for word in text.split(' '):
+            chunk = {'object': 'chat.completion.chunk', 'model': payload.get('model', 'fake'),
+                     'choices': [{'index': 0, 'delta': {'content': word + ' '}}]}
+            self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+            self.wfile.flush()
+            time.sleep(delay)
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.close_connection = True
+
+
+def make_server(profile='groq', port=0, seed=0, host='127.0.0.1'):
+    """A threaded fake LLM server (not yet serving); port 0 picks a free port"""
+    handler = type('Handler', (FakeLLMHandler,), {'llm': FakeLLM(profile, seed)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.llm = handler.llm
+    server.url = f'http://{host}:{server.server_port}/v1/chat/completions'
+    return server
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Fake OpenAI-compatible LLM server')
+    parser.add_argument('--profile', default='groq', choices=sorted(PROFILES))
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    server = make_server(args.profile, args.port, args.seed, args.host)
+    print(f"Fake LLM ({args.profile}) at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,20 +1,30 @@
 const API_URL = '/api';
 let conversationId = 'chat_' + Date.now();
+// Optional persona/locale template pack, e.g. ?pack=pirate
+const templatePack = new URLSearchParams(location.search).get('pack');
 
 const chatMessages = document.getElementById('chatMessages');
 const userInput = document.getElementById('userInput');
 const sendButton = document.getElementById('sendButton');
 const resetButton = document.getElementById('resetButton');
 
+// Persistent WebSocket for chat and reset, when the server offers one.
+// Until it is open (or if it never opens) messages go over plain HTTP.
+let socket = null;  // the open connection, if any
+let socketConnection = null;  // the newest connection, open or still connecting
+let nextRequestId = 1;
+
 // Initialize - load random intro
 loadIntro();
+connectSocket();
 
 // Initialize
 userInput.focus();
 
 async function loadIntro() {
     try {
-        const response = await fetch(`${API_URL}/intro`);
+        const query = templatePack ? `?pack=${encodeURIComponent(templatePack)}` : '';
+        const response = await fetch(`${API_URL}/intro${query}`);
         const data = await response.json();
         if (data.intro) {
             addMessage(data.intro, 'bot');
@@ -29,6 +39,90 @@ async function loadIntro() {
     }
 }
 
+function connectSocket() {
+    if (!('WebSocket' in window)) return;
+
+    const protocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
+    const ws = new WebSocket(`${protocol}//${location.host}${API_URL}/ws?conversation_id=${encodeURIComponent(conversationId)}`);
+    ws.pending = new Map();
+    socketConnection = ws;
+
+    ws.addEventListener('open', () => {
+        if (ws === socketConnection) {
+            socket = ws;
+        }
+    });
+
+    ws.addEventListener('message', (event) => {
+        const reply = JSON.parse(event.data);
+        const pending = ws.pending.get(reply.id);
+        if (pending) {
+            ws.pending.delete(reply.id);
+            pending.resolve(reply.data);
+        }
+    });
+
+    ws.addEventListener('close', () => {
+        if (socket === ws) {
+            socket = null;
+        }
+        if (socketConnection === ws) {
+            socketConnection = null;
+        }
+        // These frames went out, so the server may have acted on them already
+        for (const pending of ws.pending.values()) {
+            pending.reject(Object.assign(new Error('WebSocket closed'), { sent: true }));
+        }
+        ws.pending.clear();
+    });
+}
+
+// Drop the current connection (even one still opening) and bind a new one to conversationId
+function reconnectSocket() {
+    if (socketConnection) {
+        socketConnection.close();
+    }
+    socket = null;
+    connectSocket();
+}
+
+function sendOverSocket(payload) {
+    return new Promise((resolve, reject) => {
+        const ws = socket;
+        if (!ws || ws.readyState !== WebSocket.OPEN) {
+            reject(Object.assign(new Error('WebSocket not open'), { sent: false }));
+            return;
+        }
+        const id = nextRequestId++;
+        ws.pending.set(id, { resolve, reject });
+        ws.send(JSON.stringify({ ...payload, id }));
+    });
+}
+
+async function postJSON(path, body) {
+    const response = await fetch(`${API_URL}/${path}`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify(body)
+    });
+    return response.json();
+}
+
+async function requestChat(message) {
+    if (socket) {
+        try {
+            return await sendOverSocket({ type: 'chat', message: message, pack: templatePack });
+        } catch (error) {
+            // Resending a frame the server may have answered would record the turn twice
+            if (error.sent) throw error;
+            console.error('WebSocket failed, falling back to HTTP:', error);
+        }
+    }
+    return postJSON('chat', { message: message, conversation_id: conversationId, pack: templatePack });
+}
+
 // Send message on button click
 sendButton.addEventListener('click', sendMessage);
 
@@ -55,18 +149,7 @@ async function sendMessage() {
     const typingId = showTypingIndicator();
 
     try {
-        const response = await fetch(`${API_URL}/chat`, {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify({
-                message: message,
-                conversation_id: conversationId
-            })
-        });
-
-        const data = await response.json();
+        const data = await requestChat(message);
         
         // Remove typing indicator
         removeTypingIndicator(typingId);
@@ -135,21 +218,28 @@ function scrollToBottom() {
 
 async function resetConversation() {
     try {
-        await fetch(`${API_URL}/reset`, {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify({
-                conversation_id: conversationId
-            })
-        });
+        // Generate new conversation ID - the socket switches to it as part of the reset
+        const oldConversationId = conversationId;
+        conversationId = 'chat_' + Date.now();
+
+        let resetOverSocket = false;
+        if (socket) {
+            try {
+                await sendOverSocket({ type: 'reset', conversation_id: conversationId });
+                resetOverSocket = true;
+            } catch (error) {
+                console.error('WebSocket failed, falling back to HTTP:', error);
+            }
+        }
+        if (!resetOverSocket) {
+            // Resetting twice is harmless, so this also covers a reset frame lost in flight
+            await postJSON('reset', { conversation_id: oldConversationId });
+            // A socket that was open or still opening is bound to the old conversation
+            reconnectSocket();
+        }
 
         // Clear chat messages
         chatMessages.innerHTML = '';
-        
-        // Generate new conversation ID
-        conversationId = 'chat_' + Date.now();
 
         // Load random intro message
         loadIntro();
@@ -0,0 +1,115 @@
+"""Train the optional intent/category classifier from labeled traces
+
+Usage:
+    python train_classifier.py traces.jsonl -o intent_model.npz
+    INTENT_MODEL_PATH=intent_model.npz python app.py
+
+A trace is a JSON-lines file with one message per line, e.g.
+{"message": "how do I bake a cake", "intent": "request", "category": "cooking"}
+
+Lines without an "intent" or "category" are labeled by the keyword rules, so a
+turn log (TURN_LOG_DIR) can bootstrap a model that is then corrected by hand.
+Requires numpy.
+"""
+import argparse
+import json
+import random
+import sys
+
+import numpy as np
+
+import app
+
+
+def read_examples(paths):
+    """(message, intent, category) for every line of the traces"""
+    examples = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                message = app.normalize_message(entry.get('message', ''))
+                intent = entry.get('intent') or app.detect_intent(message)
+                category = entry.get('category') or app.detect_request_category(message)
+                examples.append((message, intent, category))
+    return examples
+
+
+def softmax_gradient(scores, targets):
+    """Gradient of the cross-entropy loss with respect to the scores"""
+    scores = scores - scores.max(axis=1, keepdims=True)
+    probs = np.exp(scores)
+    probs /= probs.sum(axis=1, keepdims=True)
+    probs[np.arange(len(targets)), targets] -= 1
+    return probs
+
+
+def train(examples, n_features=2**15, epochs=8, learning_rate=0.5, batch_size=128, seed=0):
+    """Fit an IntentClassifier to (message, intent, category) examples with minibatch SGD"""
+    intent_labels = sorted({intent for _, intent, _ in examples})
+    category_labels = sorted({category for _, _, category in examples})
+    split = len(intent_labels)
+    weights = np.zeros((n_features, split + len(category_labels)), dtype=np.float32)
+    model = app.IntentClassifier(weights, intent_labels, category_labels)
+
+    intent_index = {label: i for i, label in enumerate(intent_labels)}
+    category_index = {label: i for i, label in enumerate(category_labels)}
+    rng = random.Random(seed)
+    order = list(range(len(examples)))
+    for _ in range(epochs):
+        rng.shuffle(order)
+        for start in range(0, len(order), batch_size):
+            batch = [examples[i] for i in order[start:start + batch_size]]
+            ids, offsets = model.featurize([message for message, _, _ in batch])
+            scores = np.add.reduceat(weights[ids], offsets, axis=0)
+
+            gradient = np.empty_like(scores)
+            gradient[:, :split] = softmax_gradient(
+                scores[:, :split], np.array([intent_index[intent] for _, intent, _ in batch]))
+            gradient[:, split:] = softmax_gradient(
+                scores[:, split:], np.array([category_index[category] for _, _, category in batch]))
+
+            # Every feature of a message receives that message's gradient
+            lengths = np.diff(np.append(offsets, len(ids)))
+            np.add.at(weights, ids, np.repeat(gradient, lengths, axis=0) * (-learning_rate / len(batch)))
+    return model
+
+
+def accuracy(model, examples):
+    """Fraction of examples whose intent, and whose category, is predicted correctly"""
+    predictions = model.classify_batch([message for message, _, _ in examples])
+    intent_hits = sum(p[0] == e[1] for p, e in zip(predictions, examples))
+    category_hits = sum(p[1] == e[2] for p, e in zip(predictions, examples))
+    return intent_hits / len(examples), category_hits / len(examples)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Train the CrapGPT intent/category classifier')
+    parser.add_argument('traces', nargs='+', help='JSON-lines files of (labeled) messages')
+    parser.add_argument('-o', '--output', default='intent_model.npz', help='where to write the weights')
+    parser.add_argument('--features', type=int, default=2**15, help='number of hashed features')
+    parser.add_argument('--epochs', type=int, default=8)
+    parser.add_argument('--holdout', type=float, default=0.1, help='fraction of examples kept for evaluation')
+    args = parser.parse_args(argv)
+
+    examples = read_examples(args.traces)
+    if not examples:
+        print('No examples found')
+        return 1
+    random.Random(0).shuffle(examples)
+    cut = int(len(examples) * (1 - args.holdout))
+    training, held_out = examples[:cut], examples[cut:] or examples
+
+    model = train(training, n_features=args.features, epochs=args.epochs)
+    intent_accuracy, category_accuracy = accuracy(model, held_out)
+    print(f"{len(training)} training examples, {len(held_out)} held out: "
+          f"intent {intent_accuracy:.1%}, category {category_accuracy:.1%}")
+    model.save(args.output)
+    print(f"Wrote {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))